@@ -343,4 +343,50 @@ class AMSpi:
         for dc_motor in dc_motors:
             if not self.stop_dc_motor(dc_motor):
                 return False
-        return True
\ No newline at end of file
+        return True
+
+    def disable_all_dc_motors(self):
+        """
+        Drop the enable pin of every motor without touching the shift register
+        or the PWM bookkeeping, so it may run while another thread drives the
+        motors. Running PWMs are set to a zero duty cycle rather than stopped;
+        stop_all_dc_motors cleans them up afterwards.
+
+        :return: None
+        """
+        for dc_motor in self._MOTORS.keys():
+            pin = self._MOTORS[dc_motor][self._PIN_]
+            if pin is None:
+                continue
+            pwm = self._MOTORS[dc_motor][self._PWM_]
+            if pwm is None:
+                GPIO.output(pin, GPIO.LOW)
+            else:
+                # noinspection PyUnresolvedReferences
+                pwm.ChangeDutyCycle(0)
+
+    def stop_all_dc_motors(self):
+        """
+        Stop all motors at once with a single shift register write
+
+        :return: False in case of an ERROR, True if everything is OK
+        :rtype: bool
+        """
+        if self._test_shift_pins() is False:
+            return False
+
+        # all direction bits cleared releases every motor in one write
+        self._shift_write(0)
+
+        for dc_motor in self._MOTORS.keys():
+            if self._MOTORS[dc_motor][self._PIN_] is None:
+                continue
+            if self._MOTORS[dc_motor][self._PWM_] is None:
+                GPIO.output(self._MOTORS[dc_motor][self._PIN_], GPIO.LOW)
+            else:
+                # noinspection PyUnresolvedReferences
+                self._MOTORS[dc_motor][self._PWM_].stop()
+                self._MOTORS[dc_motor][self._PWM_] = None
+            self._MOTORS[dc_motor][self._IS_RUNNING_] = False
+            self._MOTORS[dc_motor][self._RUNNING_DIRECTION_] = None
+        return True
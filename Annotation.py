@@ -87,12 +87,14 @@ class Annotator:
     # overlay each time we want to update.
     # We use a temp overlay object because if we remove the current overlay
     # first, it causes flickering (the overlay visibly disappears for a moment).
+    # The overlay and its update share one copy of the drawing.
+    pixels = self._buffer.tobytes()
     temp_overlay = self._camera.add_overlay(
-        self._buffer.tobytes(), format='rgba', layer=3, size=self._buffer_dims)
+        pixels, format='rgba', layer=3, size=self._buffer_dims)
     if self._overlay is not None:
       self._camera.remove_overlay(self._overlay)
     self._overlay = temp_overlay
-    self._overlay.update(self._buffer.tobytes())
+    self._overlay.update(pixels)
 
   def clear(self):
     """Clears the contents of the overlay, leaving only the plain background."""
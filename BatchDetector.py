@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch detection over many frames or crops of one model.
+
+If the model accepts a batch dimension other than 1, a dedicated interpreter
+is resized to the batch and invoked once. The bundled SSD models do not (their
+reshape before the post-process op is fixed to batch 1), so otherwise a pool
+of single-image interpreters runs the batch on a thread pool; `invoke` drops
+the GIL, so they really run side by side.
+
+Results are padded arrays: boxes (N, K, 4), classes (N, K), scores (N, K) and
+counts (N,). SSD outputs are sorted by score, so the first counts[i] rows of
+image i are its detections above the threshold; the rest are zeroed.
+"""
+
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from tflite_runtime.interpreter import Interpreter
+
+from Profiler import stage
+from TensorBinding import TensorBinding
+
+
+class BatchDetector:
+    def __init__(self, model, workers=4, max_batch=16):
+        """`model` is a ModelRegistry.SharedModel."""
+        self.model = model
+        self.workers = workers
+        self.max_batch = max_batch
+        self.batched = {}
+        self.lock = threading.Lock()
+        self.pool = None
+        self.executor = None
+        self.supports_batch = self._probe_batch()
+
+    def _new_interpreter(self, batch=None):
+        interpreter = Interpreter(model_content=self.model.content, num_threads=1)
+        if batch is not None:
+            detail = interpreter.get_input_details()[0]
+            interpreter.resize_tensor_input(detail['index'], [batch] + list(detail['shape'][1:]))
+        interpreter.allocate_tensors()
+        return interpreter
+
+    def _probe_batch(self):
+        try:
+            interpreter = self._new_interpreter(batch=2)
+            interpreter.invoke()
+        except (RuntimeError, ValueError):
+            return False
+        return all(d['shape'][0] == 2 for d in interpreter.get_output_details())
+
+    def _batched_interpreter(self, batch):
+        if batch not in self.batched:
+            self.batched[batch] = self._new_interpreter(batch)
+        return self.batched[batch]
+
+    def _ensure_pool(self):
+        if self.pool is None:
+            self.pool = queue.Queue()
+            for _ in range(self.workers):
+                self.pool.put(self._new_interpreter())
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def _detect_one(self, image):
+        interpreter = self.pool.get()
+        try:
+            binding = TensorBinding.of(interpreter)
+            binding.set_input(image)
+            with stage('invoke'):
+                binding.invoke()
+            count = int(binding.output(3))
+            return (binding.output(0)[:count].copy(), binding.output(1)[:count].copy(),
+                    binding.output(2)[:count].copy())
+        finally:
+            self.pool.put(interpreter)
+
+    def _run_batched(self, images):
+        interpreter = self._batched_interpreter(len(images))
+        detail = interpreter.get_input_details()[0]
+        if detail['dtype'] == np.uint8:
+            pixels = images
+        elif detail['dtype'] == np.int8:
+            pixels = (images.astype(np.int16) - 128).astype(np.int8)
+        else:
+            pixels = ((images - 127.5) / 127.5).astype(detail['dtype'])
+        interpreter.set_tensor(detail['index'], np.ascontiguousarray(pixels))
+        with stage('invoke'):
+            interpreter.invoke()
+        outputs = [interpreter.get_tensor(d['index']) for d in interpreter.get_output_details()[:4]]
+        counts = outputs[3].reshape(len(images)).astype(np.int32)
+        return [(outputs[0][i, :counts[i]], outputs[1][i, :counts[i]], outputs[2][i, :counts[i]])
+                for i in range(len(images))]
+
+    def detect(self, images, threshold=0.5):
+        """
+        Detects objects in a stacked uint8 array (N, H, W, 3) already sized to
+        the model input. Returns (boxes, classes, scores, counts).
+        """
+        images = np.asarray(images)
+        if images.ndim == 3:
+            images = images[np.newaxis]
+        per_image = []
+        with self.lock:
+            if self.supports_batch:
+                for start in range(0, len(images), self.max_batch):
+                    per_image += self._run_batched(images[start:start + self.max_batch])
+            else:
+                self._ensure_pool()
+                per_image = list(self.executor.map(self._detect_one, images))
+
+        size = max([len(scores) for _, _, scores in per_image] + [1])
+        boxes = np.zeros((len(images), size, 4), np.float32)
+        classes = np.zeros((len(images), size), np.float32)
+        scores = np.zeros((len(images), size), np.float32)
+        for i, (b, c, s) in enumerate(per_image):
+            boxes[i, :len(s)] = b
+            classes[i, :len(s)] = c
+            scores[i, :len(s)] = s
+        keep = scores >= threshold
+        boxes[~keep] = 0
+        classes[~keep] = 0
+        scores[~keep] = 0
+        return boxes, classes, scores, keep.sum(axis=1)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.pool = None
+        self.batched = {}
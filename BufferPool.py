@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Preallocated buffers for an allocation-free frame loop.
+
+In steady state every large array of the pipeline is reused:
+
+* BufferPool       - fixed set of same-shaped arrays recycled through a queue
+* FrameOutput      - picamera output that copies raw RGB frames into pooled
+                     frame buffers instead of building a new image per frame
+* Resizer          - frame (or crop) to model input area resize into
+                     preallocated buffers
+* DetectionBuffers - fixed detection arrays and result dicts per model
+
+Result dicts and their arrays are overwritten by the next frame, so code
+keeping detections across frames must copy them (Tracker does).
+"""
+
+import collections
+
+import numpy as np
+
+
+class BufferPool:
+    def __init__(self, shape, dtype=np.uint8, count=3):
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.buffers = [np.zeros(self.shape, dtype) for _ in range(count)]
+        self.free = collections.deque(self.buffers)
+
+    def acquire(self):
+        """Takes a free buffer. Raises IndexError when all are in use."""
+        return self.free.popleft()
+
+    def release(self, buffer):
+        self.free.append(buffer)
+
+
+class FrameOutput:
+    """
+    File-like picamera output for `format='rgb'` captures. picamera writes
+    each frame in chunks; `take` hands over the completed frame and starts
+    the next one in another pooled buffer. Give the taken frame back with
+    `release` once every stage is done with it.
+    """
+
+    def __init__(self, width, height, count=3):
+        self.pool = BufferPool((height, width, 3), np.uint8, count)
+        self.size = height * width * 3
+        self.current = self.pool.acquire()
+        self.flat = self.current.reshape(-1)
+        self.offset = 0
+
+    def write(self, data):
+        length = min(len(data), self.size - self.offset)
+        self.flat[self.offset:self.offset + length] = memoryview(data)[:length]
+        self.offset += length
+        return len(data)
+
+    def flush(self):
+        pass
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def take(self):
+        frame = self.current
+        self.current = self.pool.acquire()
+        self.flat = self.current.reshape(-1)
+        self.offset = 0
+        return frame
+
+    def release(self, frame):
+        self.pool.release(frame)
+
+
+Taps = collections.namedtuple(
+    'Taps', ['rows', 'cols', 'row_scale', 'col_scale', 'row_buffer', 'row_sum'])
+
+
+class Resizer:
+    """
+    Resizes (H, W, 3) uint8 frames, or a box of one, to a fixed (width,
+    height) by area: every output pixel is the mean of the block of source
+    pixels under it, block edges rounded to whole pixels. Rows and then
+    columns are summed one tap at a time, the k-th pixel of every block
+    gathered with np.take; taps past the end of the shorter blocks are
+    masked out. Any frame up to `src_shape` fits the buffers; the taps of
+    the last MAX_CONFIGS frame sizes and boxes (a frame's tiles, say) are
+    kept.
+    """
+    MAX_CONFIGS = 16
+
+    def __init__(self, src_shape, size):
+        max_height, max_width = src_shape[:2]
+        width, height = size
+        self.size = size
+        self.src_shape = tuple(src_shape)
+        # Sums of large blocks overflow 16 bits
+        largest = -(-max_height // height) * -(-max_width // width)
+        self.dtype = np.uint16 if largest * 256 <= np.iinfo(np.uint16).max else np.uint32
+        self.row_pixels = np.zeros(height * max_width * 3, np.uint8)
+        self.row_sums = np.zeros(height * max_width * 3, self.dtype)
+        self.tap = np.zeros((height, width, 3), self.dtype)
+        self.sum = np.zeros((height, width, 3), self.dtype)
+        self.mean = np.zeros((height, width, 3), np.float32)
+        self.out = np.zeros((height, width, 3), np.uint8)
+        self.configs = collections.OrderedDict()
+
+    @staticmethod
+    def _blocks(start, end, dst):
+        """First source index and size of the block behind every output index."""
+        src = end - start
+        edges = np.round(np.arange(dst + 1) * src / dst).astype(np.intp)
+        # Enlarging repeats source pixels as blocks of one
+        starts = start + np.minimum(edges[:-1], src - 1)
+        counts = np.maximum(edges[1:] - edges[:-1], 1)
+        return starts, counts
+
+    @staticmethod
+    def _taps(starts, counts, end, axes):
+        """(indices, mask) of the k-th pixel of every block; mask is True when all have one."""
+        return [(np.minimum(starts + k, end - 1),
+                 True if k < counts.min() else (counts > k)[axes])
+                for k in range(counts.max())]
+
+    def _configure(self, frame_height, frame_width, box):
+        """Taps, scales and buffer views for one frame size and box."""
+        max_height, max_width = self.src_shape[:2]
+        if frame_height > max_height or frame_width > max_width:
+            raise ValueError("%dx%d frame is larger than the resizer's %dx%d"
+                             % (frame_width, frame_height, max_width, max_height))
+        left, top, right, bottom = box
+        width, height = self.size
+        row_starts, row_counts = self._blocks(top, bottom, height)
+        col_starts, col_counts = self._blocks(left, right, width)
+        # Rows are gathered at full frame width, a box of a frame is not
+        # contiguous and np.take would copy it first
+        pixels = height * frame_width * 3
+        return Taps(
+            self._taps(row_starts, row_counts, bottom, (slice(None), None, None)),
+            self._taps(col_starts, col_counts, right, (None, slice(None), None)),
+            (1 / row_counts).astype(np.float32)[:, None, None],
+            (1 / col_counts).astype(np.float32)[None, :, None],
+            self.row_pixels[:pixels].reshape(height, frame_width, 3),
+            self.row_sums[:pixels].reshape(height, frame_width, 3))
+
+    def resize(self, frame, box=None, out=None):
+        """
+        Resizes `frame`, or only the pixel `box` (left, top, right, bottom) of
+        it, into `out`, by default the resizer's own output buffer. Returns out.
+        """
+        frame_height, frame_width = frame.shape[:2]
+        box = (0, 0, frame_width, frame_height) if box is None else tuple(box)
+        key = (frame_height, frame_width) + box
+        taps = self.configs.get(key)
+        if taps is None:
+            if len(self.configs) >= self.MAX_CONFIGS:
+                self.configs.popitem(last=False)
+            taps = self.configs[key] = self._configure(frame_height, frame_width, box)
+        else:
+            # Least recently used ones are dropped first
+            self.configs.move_to_end(key)
+        out = self.out if out is None else out
+        # take() copies through a temporary unless mode is 'clip' or 'wrap';
+        # the taps are in range anyway
+        taps.row_sum.fill(0)
+        for rows, mask in taps.rows:
+            np.take(frame, rows, axis=0, out=taps.row_buffer, mode='clip')
+            np.add(taps.row_sum, taps.row_buffer, out=taps.row_sum, where=mask)
+        self.sum.fill(0)
+        for cols, mask in taps.cols:
+            np.take(taps.row_sum, cols, axis=1, out=self.tap, mode='clip')
+            np.add(self.sum, self.tap, out=self.sum, where=mask)
+        np.multiply(self.sum, taps.row_scale, out=self.mean)
+        np.multiply(self.mean, taps.col_scale, out=self.mean)
+        np.rint(self.mean, out=self.mean)
+        np.copyto(out, self.mean, casting='unsafe')
+        return out
+
+
+class DetectionBuffers:
+    """Fixed arrays and detect_objects style result dicts for one model."""
+
+    def __init__(self, max_detections):
+        self.boxes = np.zeros((max_detections, 4), np.float32)
+        self.classes = np.zeros(max_detections, np.float32)
+        self.scores = np.zeros(max_detections, np.float32)
+        self.results = [{'bounding_box': self.boxes[i], 'class_id': 0, 'score': 0.0}
+                        for i in range(max_detections)]
+        self.count = 0
+
+    def fill(self, count):
+        """Points the first `count` result dicts at this frame's values."""
+        self.count = count
+        for i in range(count):
+            result = self.results[i]
+            result['class_id'] = int(self.classes[i])
+            result['score'] = float(self.scores[i])
+        return self.results[:count]
@@ -6,36 +6,114 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
-import io
-import re
+import queue
+import threading
 import time
 
 from Annotation import Annotator
+from BatchDetector import BatchDetector
+from BufferPool import DetectionBuffers, FrameOutput, Resizer
+from Cascade import CascadeStats, cascade_config, crop_boxes, gate_boxes
+from Governor import Governor
+from ModelRegistry import ModelError, default_registry, load_labels
+from Planner import range_from_box
+from Profiler import set_stage, stage
+from TensorBinding import TensorBinding
+from Tiling import merge_tiles, tile_boxes, tiling_config
+from Tracker import Tracker
+from VisionClient import VisionClient
 
 import numpy as np
-import picamera
 
+try:
+    import picamera
+except ImportError:
+    # Only the real camera needs it, the simulator passes its own
+    picamera = None
+
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from time import sleep
-from tflite_runtime.interpreter import Interpreter
 
 class Camera:
     CAMERA_WIDTH = 640
     CAMERA_HEIGHT = 480
+    # Capture resolution while a model runs tiled
+    TILED_WIDTH = 1280
+    TILED_HEIGHT = 960
+    # Frames between two prints of the cascade hit rates
+    STATS_EVERY = 100
+    # Seconds between two checks of the model files
+    WATCH_INTERVAL = 2.0
+
+    # Longest time to wait for auto exposure and white balance to settle
+    WARM_UP_TIMEOUT = 2.0
 
-    def __init__(self, models, exportLog=True):
+    def __init__(self, models, exportLog=True, camera=None):
         """
-        Load camera with fine resolution
+        Load camera with fine resolution. Models load in background threads
+        while the sensor settles; `startup_times` keeps the breakdown (ms).
+        `camera` replaces the PiCamera, e.g. with Simulator.SyntheticCamera.
         """
+        start = time.monotonic()
         self.interpreters = []
-        self.camera = picamera.PiCamera()
+        self.batch_detectors = {}
+        self.cascade_stats = CascadeStats()
+        # Warmed up models waiting to be swapped in between two frames
+        self.swaps = queue.SimpleQueue()
+        self.swap_loader = ThreadPoolExecutor(max_workers=1)
+        self.watching = threading.Event()
+        # Quality settings, changed by the governor (see apply_quality)
+        self.governor = None
+        self.vision_client = None
+        self.allow_tiling = True
+        self.cascade_mode = None
+        self.batch_workers = 4
+        self.framerate = 30
+        self.capture_request = None
+        self.startup_times = {}
+        self.exportLog = exportLog
+        loader = ThreadPoolExecutor(max_workers=1)
+        models_loaded = loader.submit(self.load_models, models)
+
+        self.camera = camera if camera is not None else picamera.PiCamera()
+        # Frames are captured at the normal size unless a model is running
+        # tiled, see request_capture
+        self.tiled_capture = any('tiling' in model for model in models)
         self.camera.resolution = (self.CAMERA_WIDTH, self.CAMERA_HEIGHT)
-        self.camera.framerate = 30
+        self.camera.framerate = self.framerate
         self.camera.start_preview()
-        self.exportLog = exportLog
+        self.startup_times['camera_open'] = (time.monotonic() - start) * 1000
+
         # Camera warm-up time
-        sleep(2)
-        self.load_models(models)
+        ready = self.wait_sensor_ready(self.WARM_UP_TIMEOUT)
+        self.startup_times['sensor_ready'] = (time.monotonic() - start) * 1000
+        if not ready:
+            print("Camera exposure did not settle in %.1fs" % self.WARM_UP_TIMEOUT)
+
+        models_loaded.result()
+        loader.shutdown()
+        self.startup_times['total'] = (time.monotonic() - start) * 1000
+        self.print_startup_times()
+
+    def wait_sensor_ready(self, timeout):
+        """
+        Polls exposure, gain and white balance until they are set and stop
+        changing between two polls. Returns False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        previous = None
+        while time.monotonic() < deadline:
+            state = (self.camera.exposure_speed, self.camera.analog_gain,
+                     self.camera.digital_gain) + tuple(self.camera.awb_gains)
+            if all(value > 0 for value in state) and state == previous:
+                return True
+            previous = state
+            time.sleep(0.05)
+        return False
+
+    def print_startup_times(self):
+        print("Startup: " + ", ".join(
+            "%s %.0fms" % (name, ms) for name, ms in self.startup_times.items()))
 
     def __enter__(self):
         return self
@@ -48,64 +126,403 @@ class Camera:
 
     def load_labels(self, path):
         """Loads the labels file. Supports files with or without index numbers."""
-        with open(path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            labels = {}
-            for row_number, content in enumerate(lines):
-                pair = re.split(r'[:\s]+', content.strip(), maxsplit=1)
-                if len(pair) == 2 and pair[0].strip().isdigit():
-                    labels[int(pair[0])] = pair[1].strip()
-                else:
-                    labels[row_number] = pair[0].strip()
-        return labels
+        return load_labels(path)
 
     def load_models(self, models):
-        for model in models:
-            interpreter = Interpreter(model['model_path'])
-            interpreter.allocate_tensors()
-            self.interpreters.append({
+        """
+        Models are looked up in the model registry, either by registry name
+        ('model') or by file ('model_path' and 'label_path'). Interpreters are
+        shared with any other pipeline using the same model. A 'detector'
+        callable (frame, threshold) -> results with its 'labels' replaces
+        the model altogether, which the simulator uses.
+        """
+        registry = default_registry()
+
+        def load(model):
+            start = time.monotonic()
+            if 'detector' in model:
+                shared = None
+            elif 'model' in model:
+                shared = registry.get(model['model'])
+            else:
+                shared = registry.get_by_path(model['model_path'], model['label_path'])
+            entry = {
                 'name': model['name'],
-                'shape': interpreter.get_input_details()[0]['shape'],
-                'labels': self.load_labels(model['label_path']),
-                'interpreter': interpreter,
-                'function': model['function']
-            })
+                'function': model['function'],
+                'detector': model.get('detector'),
+                # Registry model used at full quality and its lighter variant
+                'base_model': model.get('model'),
+                'light_model': model.get('light_model'),
+                'threshold': model.get('threshold', 0.5),
+                'cascade': cascade_config(model['cascade']) if 'cascade' in model else None,
+                'tiling': tiling_config(model['tiling']) if 'tiling' in model else None,
+                'tiled': False,
+                'misses': 0,
+                # Tracking is on unless the model sets 'tracking': False
+                'tracker': (Tracker(**model.get('tracking', {}))
+                            if model.get('tracking', True) is not False else None)
+            }
+            if shared is not None:
+                entry.update(self.model_fields(shared))
+            else:
+                entry.update(shape=None, labels=model['labels'], model=None,
+                             interpreter=None, lock=threading.Lock())
+            self.startup_times['model ' + model['name']] = (time.monotonic() - start) * 1000
+            return entry
+
+        # Interpreter creation is native code, so models load side by side
+        with ThreadPoolExecutor(max_workers=max(1, len(models))) as pool:
+            self.interpreters.extend(pool.map(load, models))
+        names = [entry['name'] for entry in self.interpreters]
+        for i, entry in enumerate(self.interpreters):
+            config = entry['cascade']
+            if config is None:
+                continue
+            if config['after'] not in names[:i]:
+                raise ValueError("%s: cascade gate %r must come earlier in the model list"
+                                 % (entry['name'], config['after']))
+            if config['score'] is None:
+                # Whatever the gate reports counts
+                config['score'] = self.interpreters[names.index(config['after'])]['threshold']
         return self.interpreters
 
+    def model_fields(self, shared):
+        """Entry fields that come from the registry model, replaced on a swap."""
+        return {
+            'shape': shared.shape,
+            'labels': shared.labels,
+            'model': shared,
+            'interpreter': shared.interpreter,
+            'lock': shared.lock
+        }
+
+    def watch_models(self, interval=None):
+        """
+        Watches the model files in the background. A model file replaced on
+        disk is reloaded and swapped in without stopping the pipeline.
+        """
+        interval = self.WATCH_INTERVAL if interval is None else interval
+        threading.Thread(target=self._watch_loop, args=(interval,), daemon=True).start()
+
+    def stop_watching(self):
+        self.watching.set()
+
+    def _watch_loop(self, interval):
+        registry = default_registry()
+        # A file must keep the same mtime for a whole interval, so one that
+        # is still being copied is not loaded half written
+        seen = {}
+        # Files that failed to load are not retried until they change again
+        rejected = {}
+        while not self.watching.wait(interval):
+            registry.scan()
+            changed = registry.changed()
+            for name, mtime in changed.items():
+                if seen.get(name) == mtime and rejected.get(name) != mtime:
+                    self.swap_loader.submit(self._prepare_reload, name, mtime, rejected)
+            seen = changed
+
+    def _prepare_reload(self, model_name, mtime, rejected):
+        registry = default_registry()
+        if not registry.get(model_name).changed():
+            return
+        try:
+            _, shared = registry.reload(model_name)
+        except ModelError as e:
+            print("Keeping the current model:", e)
+            rejected[model_name] = mtime
+            return
+        for entry in self.interpreters:
+            if entry['model'] is not None and entry['model'].name == model_name:
+                self._warm_up(shared)
+                self.swaps.put((entry['name'], shared))
+
+    def swap_model(self, name, model_name):
+        """
+        Switches entry `name` to registry model `model_name` (A/B tests).
+        The model loads in the background; it is used from the next frame
+        after it is ready.
+        """
+        return self.swap_loader.submit(self._prepare_swap, name, model_name)
+
+    def _prepare_swap(self, name, model_name):
+        try:
+            shared = default_registry().get(model_name)
+            self._warm_up(shared)
+        except ModelError as e:
+            print("Keeping the current model:", e)
+            return
+        self.swaps.put((name, shared))
+
+    def _warm_up(self, shared):
+        """The first invoke allocates scratch buffers, keep it out of the frame loop."""
+        with shared.lock:
+            TensorBinding.of(shared.interpreter).invoke()
+
+    def apply_swaps(self):
+        """Swaps ready models in; called between frames by execute_command."""
+        while True:
+            try:
+                name, shared = self.swaps.get_nowait()
+            except queue.Empty:
+                return
+            for i, entry in enumerate(self.interpreters):
+                if entry['name'] != name:
+                    continue
+                old = entry['model']
+                swapped = dict(entry)
+                swapped.update(self.model_fields(shared))
+                if swapped['tracker'] is not None:
+                    swapped['tracker'].reset()
+                self.interpreters[i] = swapped
+                detector = self.batch_detectors.pop(name, None)
+                print("Swapped model of", name, "to", shared.name, shared.model_path)
+                threading.Thread(target=self._release, args=(old, detector), daemon=True).start()
+
+    def _release(self, old, detector):
+        """Frees a swapped out model once the inference still running on it is done."""
+        if detector is not None:
+            detector.close()
+        in_use = any(entry['model'] is old for entry in self.interpreters)
+        if not in_use and default_registry().models.get(old.name) is not old:
+            # Waits for any other pipeline holding the lock mid-inference
+            old.release()
+
+    def govern(self, budget_ms=150.0, sensors=None):
+        """Lets a Governor trade quality for latency to hold `budget_ms` per frame."""
+        self.governor = Governor(self, budget_ms, sensors)
+        return self.governor
+
+    def use_server(self, host, port=None, robot_id='excavator', priority=0, budget_ms=100.0):
+        """
+        Sends frames to a shared VisionServer, which detects with the registry
+        models of every entry. Frames it cannot answer within `budget_ms` are
+        detected on board as before. Tiling and cascade crops only run on board:
+        the server gets a downscaled frame, too small for distant targets.
+        """
+        options = {} if port is None else {'port': port}
+        self.vision_client = VisionClient(host, robot_id=robot_id, priority=priority,
+                                          budget_ms=budget_ms, **options)
+        return self.vision_client
+
+    def remote_detect(self, frame):
+        """Server results per registry model name, or None to detect on board."""
+        models = {}
+        for entry in self.interpreters:
+            if entry['model'] is not None and not self.on_board(entry):
+                name = entry['model'].name
+                models[name] = min(entry['threshold'], models.get(name, 1.0))
+        if not models:
+            return None
+        remote = self.vision_client.detect(frame, models)
+        if remote is None:
+            return None
+        return {name: self.batch_results((boxes[np.newaxis], classes[np.newaxis],
+                                          scores[np.newaxis], [len(scores)]))[0]
+                for name, (boxes, classes, scores) in remote.items()}
+
+    def on_board(self, entry):
+        """True when the entry is tiled or runs cascade crops, which the server cannot do."""
+        config = entry['cascade']
+        crops = config is not None and (self.cascade_mode or config['mode']) == 'crops'
+        return entry['tiled'] or crops
+
+    def apply_quality(self, quality):
+        """Applies a Governor quality level between two frames."""
+        for entry in self.interpreters:
+            if entry['light_model'] is None or entry['base_model'] is None:
+                continue
+            wanted = entry['light_model'] if quality['light_models'] else entry['base_model']
+            if entry['model'].name != wanted:
+                self.swap_model(entry['name'], wanted)
+
+        self.allow_tiling = quality['tiling']
+        if not self.allow_tiling:
+            for entry in self.interpreters:
+                entry['tiled'] = False
+        self.cascade_mode = quality['cascade_mode']
+
+        if quality['workers'] != self.batch_workers:
+            self.batch_workers = quality['workers']
+            # Rebuilt with the new pool size on next use
+            detectors, self.batch_detectors = self.batch_detectors, {}
+            for detector in detectors.values():
+                threading.Thread(target=detector.close, daemon=True).start()
+
+        self.framerate = quality['framerate']
+        self.request_capture()
+
+    def request_capture(self):
+        """
+        Asks for the capture to restart at the tiled resolution while some
+        model runs tiled, at the normal one otherwise, and at the current
+        framerate. Applied between two captures by execute_command.
+        """
+        if self.tiled_capture and any(entry['tiled'] for entry in self.interpreters):
+            resolution = (self.TILED_WIDTH, self.TILED_HEIGHT)
+        else:
+            resolution = (self.CAMERA_WIDTH, self.CAMERA_HEIGHT)
+        if tuple(self.camera.resolution) != resolution or self.camera.framerate != self.framerate:
+            self.capture_request = (resolution, self.framerate)
+        else:
+            self.capture_request = None
+
     def set_input_tensor(self, interpreter, image):
         """Sets the input tensor."""
-        tensor_index = interpreter.get_input_details()[0]['index']
-        input_tensor = interpreter.tensor(tensor_index)()[0]
-        input_tensor[:, :] = image
+        TensorBinding.of(interpreter).set_input(image)
 
     def get_output_tensor(self, interpreter, index):
         """Returns the output tensor at the given index."""
-        output_details = interpreter.get_output_details()[index]
-        tensor = np.squeeze(interpreter.get_tensor(output_details['index']))
-        return tensor
+        return TensorBinding.of(interpreter).output(index)
 
     def detect_objects(self, interpreter, image, threshold):
         """Returns a list of detection results, each a dictionary of object info."""
-        self.set_input_tensor(interpreter, image)
-        interpreter.invoke()
-
-        # Get all output details
-        boxes = self.get_output_tensor(interpreter, 0)
-        classes = self.get_output_tensor(interpreter, 1)
-        scores = self.get_output_tensor(interpreter, 2)
-        count = int(self.get_output_tensor(interpreter, 3))
+        binding = TensorBinding.of(interpreter)
+        binding.set_input(image)
+        binding.invoke()
 
+        boxes, classes, scores = binding.detections(threshold)
         results = []
-        for i in range(count):
-            if scores[i] >= threshold:
-                result = {
-                    'bounding_box': boxes[i],
-                    'class_id': classes[i],
-                    'score': scores[i]
-                }
-                results.append(result)
+        for i in range(len(scores)):
+            result = {
+                'bounding_box': boxes[i],
+                'class_id': classes[i],
+                'score': scores[i]
+            }
+            results.append(result)
         return results
 
+    def detect_batch(self, name, images, threshold=0.5):
+        """
+        Runs model `name` over many frames or crops at once. `images` is a
+        stacked uint8 array (N, H, W, 3) or a list of PIL images, which are
+        resized to the model input. Returns batched (boxes, classes, scores,
+        counts) arrays, see BatchDetector.
+        """
+        entry = next(i for i in self.interpreters if i['name'] == name)
+        size = TensorBinding.of(entry['interpreter']).size
+        if isinstance(images, (list, tuple)):
+            images = np.stack([np.asarray(image.resize(size, Image.LANCZOS)) for image in images])
+        if name not in self.batch_detectors:
+            self.batch_detectors[name] = BatchDetector(entry['model'], workers=self.batch_workers)
+        return self.batch_detectors[name].detect(images, threshold)
+
+    def batch_results(self, batch):
+        """Splits batched detection arrays into detect_objects style result lists."""
+        boxes, classes, scores, counts = batch
+        return [[{'bounding_box': boxes[n, i], 'class_id': classes[n, i], 'score': scores[n, i]}
+                 for i in range(counts[n])] for n in range(len(counts))]
+
+    def detect_regions(self, entry, frame, regions, threshold, iou):
+        """
+        Detects on pixel regions (left, top, right, bottom) of an RGB frame
+        array as one batch and merges the boxes with cross-region NMS. The
+        regions are resized straight into the entry's pooled batch buffer.
+        """
+        size = TensorBinding.of(entry['interpreter']).size
+        resizer = entry.get('region_resizer')
+        if resizer is None or resizer.size != size or resizer.src_shape != frame.shape:
+            resizer = entry['region_resizer'] = Resizer(frame.shape, size)
+        batch = entry.get('region_batch')
+        if batch is None or len(batch) < len(regions) or batch.shape[1:3] != (size[1], size[0]):
+            batch = entry['region_batch'] = np.zeros((len(regions), size[1], size[0], 3), np.uint8)
+        with stage('resize'):
+            for i, region in enumerate(regions):
+                resizer.resize(frame, region, out=batch[i])
+        height, width = frame.shape[:2]
+        detections = self.detect_batch(entry['name'], batch[:len(regions)], threshold)
+        return merge_tiles(detections, regions, width, height, iou)
+
+    def detect_tiled(self, entry, frame, threshold):
+        """
+        Splits a high resolution frame into overlapping tiles, detects on all
+        of them as one batch and merges the boxes with cross-tile NMS.
+        """
+        config = entry['tiling']
+        height, width = frame.shape[:2]
+        tiles = tile_boxes(width, height, config['grid'], config['overlap'])
+        if config['full_frame']:
+            tiles.append((0, 0, width, height))
+        return self.detect_regions(entry, frame, tiles, threshold, config['iou'])
+
+    def detect_crops(self, entry, frame, boxes, threshold):
+        """Runs a cascade stage on crops around the gate's boxes, merged like tiles."""
+        config = entry['cascade']
+        height, width = frame.shape[:2]
+        crops = crop_boxes(boxes, width, height, config['margin'], config['min_crop'])
+        return self.detect_regions(entry, frame, crops, threshold, config['iou'])
+
+    def run_stage(self, entry, frame, frame_results, remote=None):
+        """
+        Detects with one model on an RGB frame array. Returns None when the
+        model is a cascade stage whose gate found nothing, so it was skipped.
+        A tiled stage is never gated: it looks for targets too small for the
+        gate to find. `remote` holds the vision server's results for this
+        frame, if any.
+        """
+        threshold = entry['threshold']
+        config = entry['cascade']
+        if entry['tiled']:
+            return self.detect_tiled(entry, frame, threshold)
+        if config is not None:
+            gate = next(i for i in self.interpreters if i['name'] == config['after'])
+            boxes = gate_boxes(frame_results.get(config['after'], []), gate['labels'], config)
+            if not boxes:
+                return None
+        if entry['detector'] is not None:
+            return entry['detector'](frame, threshold)
+        if config is not None and (self.cascade_mode or config['mode']) == 'crops':
+            return self.detect_crops(entry, frame, boxes, threshold)
+        if remote is not None and entry['model'].name in remote:
+            return [obj for obj in remote[entry['model'].name] if obj['score'] >= threshold]
+        return self.detect_pooled(entry, frame, threshold)
+
+    def detect_pooled(self, entry, frame, threshold):
+        """
+        detect_objects for the frame loop: resizes into the entry's own
+        buffers and returns its reused result dicts, so nothing is allocated
+        per frame once the buffers exist.
+        """
+        binding = TensorBinding.of(entry['interpreter'])
+        resizer = entry.get('resizer')
+        if resizer is None or resizer.size != binding.size or resizer.src_shape != frame.shape:
+            resizer = entry['resizer'] = Resizer(frame.shape, binding.size)
+        buffers = entry.get('buffers')
+        if buffers is None or len(buffers.scores) != len(binding.output(2)):
+            buffers = entry['buffers'] = DetectionBuffers(len(binding.output(2)))
+        with entry['lock']:
+            with stage('resize'):
+                binding.set_input(resizer.resize(frame))
+            with stage('invoke'):
+                binding.invoke()
+            with stage('post-process'):
+                return binding.detections_into(buffers, threshold)
+
+    def update_tiling(self, entry, results):
+        """
+        Tiling switches on after the target has been missed for `patience`
+        frames and off again once it is found big enough for the normal pass.
+        Frames the cascade gate skipped count as misses.
+        """
+        config = entry['tiling']
+        sides = [min(obj['bounding_box'][2] - obj['bounding_box'][0],
+                     obj['bounding_box'][3] - obj['bounding_box'][1])
+                 for obj in results if entry['labels'][obj['class_id']] == config['target']]
+        if entry['tiled']:
+            if sides and max(sides) >= config['min_box']:
+                entry['tiled'] = False
+                entry['misses'] = 0
+                print("Tiled detection off for", entry['name'])
+                self.request_capture()
+        elif sides:
+            entry['misses'] = 0
+        else:
+            entry['misses'] += 1
+            if entry['misses'] >= config['patience'] and self.allow_tiling:
+                entry['tiled'] = True
+                print("Tiled detection on for", entry['name'])
+                self.request_capture()
+
     def annotate_objects(self, annotator, results, labels):
         """Draws the bounding box and label for each object in the results."""
         for obj in results:
@@ -158,6 +575,8 @@ class Camera:
             # When pixel metric 2.1 distance will 155mm
             dist_obj['focal_distance'] = (
                 (dist_obj['width'] * 155) / 55 + dist_obj['height'] * 155 / 80) / 2
+            # Actual distance in mm, focal_distance grows as the object gets closer
+            dist_obj['range'] = range_from_box(obj['bounding_box'])
             if self.exportLog:
                 print("Focal distance: " +
                     str(round(dist_obj['focal_distance'], 1)) + "\n")
@@ -179,43 +598,93 @@ class Camera:
                 ", Percent: " + str(obj['score']) + "\n"
         print(result_str)
 
+    def process_frame(self, frame):
+        """Runs every model over one RGB frame array. Returns the time taken (ms)."""
+        self.apply_swaps()
+        start_time = time.monotonic()
+        frame_results = {}
+        stage_ms = {}
+        remote = None
+        if self.vision_client is not None:
+            with stage('send'):
+                remote = self.remote_detect(frame)
+            stage_ms['vision_server'] = (time.monotonic() - start_time) * 1000
+
+        for interpreter in self.interpreters:
+            stage_start = time.monotonic()
+            results = self.run_stage(interpreter, frame, frame_results, remote)
+            ran = results is not None
+            results = results if ran else []
+            frame_results[interpreter['name']] = results
+            self.cascade_stats.record(interpreter['name'], ran, bool(results))
+            with stage('post-process'):
+                if interpreter['tiling'] is not None:
+                    self.update_tiling(interpreter, results)
+                # Stable track IDs and smoothed boxes for the callback
+                if interpreter['tracker'] is not None:
+                    results = interpreter['tracker'].update(results)
+                # Annotate objects in terminal
+                if self.exportLog:
+                    self.print_objects(results, interpreter['labels'])
+                # Annotate object in view
+                # self.annotate_objects(annotator, result, interpreter['labels'])
+                # Detect size and distance
+                # TODO: improve with physical object with 1cm length
+                sizes = self.detect_sizes(results, interpreter['labels'])
+                distances = self.detect_distances(results, interpreter['labels'])
+            stage_ms[interpreter['name']] = (time.monotonic() - stage_start) * 1000
+            if bool(interpreter.get('function')):
+                interpreter['function'](
+                    results, interpreter['labels'], sizes, distances, interpreter['name'])
+
+        elapsed_ms = (time.monotonic() - start_time) * 1000
+        if self.governor is not None:
+            self.governor.frame_done(stage_ms, elapsed_ms)
+        return elapsed_ms
+
     def execute_command(self):
         with self.camera:
             try:
-                stream = io.BytesIO()
-                annotator = Annotator(self.camera)
-                for _ in self.camera.capture_continuous(
-                        stream, format='jpeg', use_video_port=True):
-                    stream.seek(0)
-                    image = Image.open(stream).convert('RGB')
-                    start_time = time.monotonic()
-
-                    for interpreter in self.interpreters:
-                        image = image.resize(
-                            (interpreter['shape'][1], interpreter['shape'][2]), Image.ANTIALIAS)
-                        results = self.detect_objects(
-                            interpreter['interpreter'], image, 0.5)
-                        # Annotate objects in terminal
-                        if self.exportLog:
-                            self.print_objects(results, interpreter['labels'])
-                        # Annotate object in view
-                        # self.annotate_objects(annotator, result, interpreter['labels'])
-                        # Detect size and distance
-                        # TODO: improve with physical object with 1cm length
-                        sizes = self.detect_sizes(results, interpreter['labels'])
-                        distances = self.detect_distances(results, interpreter['labels'])
-                        if bool(interpreter.get('function')):
-                            interpreter['function'](
-                                results, interpreter['labels'], sizes, distances, interpreter['name'])
-
-                    elapsed_ms = (time.monotonic() - start_time) * 1000
-
-                    annotator.clear()
-                    annotator.text([5, 0], '%.1fms' % (elapsed_ms))
-                    annotator.update()
-
-                    stream.seek(0)
-                    stream.truncate()
+                # Overlays only show on a running preview
+                annotator = Annotator(self.camera) if self.camera.preview is not None else None
+                frames = 0
+                self.request_capture()
+                while True:
+                    if self.capture_request is not None:
+                        # Resolution and framerate only change between captures
+                        resolution, framerate = self.capture_request
+                        self.capture_request = None
+                        self.camera.resolution = resolution
+                        self.camera.framerate = framerate
+                    # Raw RGB frames land in pooled buffers, no JPEG round trip
+                    width, height = self.camera.resolution
+                    output = FrameOutput(width, height)
+                    # Time spent waiting on the next frame
+                    set_stage('capture')
+                    for _ in self.camera.capture_continuous(
+                            output, format='rgb', use_video_port=True):
+                        if not output.complete:
+                            continue
+                        set_stage(None)
+                        frame = output.take()
+                        frames += 1
+                        # The governor may skip detection on some frames
+                        if self.governor is None or self.governor.should_detect():
+                            elapsed_ms = self.process_frame(frame)
+                            if annotator is not None:
+                                annotator.clear()
+                                annotator.text([5, 0], '%.1fms' % (elapsed_ms))
+                                annotator.update()
+                        if self.exportLog and frames % self.STATS_EVERY == 0:
+                            self.cascade_stats.print()
+                        output.release(frame)
+                        if self.capture_request is not None:
+                            break
+                        set_stage('capture')
+                    set_stage(None)
+                    if self.capture_request is None:
+                        # The capture ended without a settings change
+                        break
 
             finally:
                 self.camera.stop_preview()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cascaded detection: an expensive model only runs when a cheap one fires.
+
+A model entry with a 'cascade' setting names an earlier model in the list
+as its gate. On frames where the gate found nothing (above `score`, the
+gate's own threshold by default, and of one of `labels` when given) the
+model is skipped. Otherwise it runs over
+the whole frame ('frame' mode) or only on crops around the gate's boxes
+('crops' mode), which are batched and merged back like tiles. A skipped
+frame counts as a miss for tiling, and a stage running tiled is not gated,
+so a target too small for the gate is still searched for in tiles.
+
+CascadeStats counts, per stage, the frames it saw, how often it ran and
+how often it found something, to tune the gate thresholds from.
+"""
+
+import numpy as np
+
+DEFAULT_CASCADE = {
+    'after': None,     # name of the gating model, earlier in the model list
+    'labels': None,    # gate labels that count, any when None
+    'score': None,     # gate score that counts, the gate's threshold when None
+    'mode': 'frame',   # 'frame' or 'crops'
+    'margin': 0.5,     # crop padding, as a fraction of the gate box size
+    'min_crop': 0.25,  # smallest crop side, as a fraction of the frame
+    'iou': 0.5         # NMS threshold when merging crops
+}
+
+
+def cascade_config(config):
+    """Fills a per-model 'cascade' entry with the defaults."""
+    merged = dict(DEFAULT_CASCADE)
+    merged.update(config)
+    if merged['after'] is None:
+        raise ValueError("cascade needs the name of the gating model in 'after'")
+    return merged
+
+
+def gate_boxes(results, labels, config):
+    """Relative boxes of the gate's detections that open the next stage."""
+    return [obj['bounding_box'] for obj in results
+            if obj['score'] >= config['score']
+            and (config['labels'] is None or labels[obj['class_id']] in config['labels'])]
+
+
+def crop_boxes(boxes, width, height, margin, min_crop):
+    """Pixel crops (left, top, right, bottom) around relative gate boxes."""
+    boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+    center = (boxes[:, :2] + boxes[:, 2:]) / 2
+    side = np.maximum((boxes[:, 2:] - boxes[:, :2]) * (1 + 2 * margin), min_crop)
+    low = np.clip(center - side / 2, 0, 1)
+    high = np.clip(center + side / 2, 0, 1)
+    scale = np.array([height, width], np.float32)
+    low = np.floor(low * scale).astype(int)
+    high = np.maximum(np.ceil(high * scale).astype(int), low + 1)
+    return [(int(l[1]), int(l[0]), int(h[1]), int(h[0])) for l, h in zip(low, high)]
+
+
+class CascadeStats:
+    def __init__(self):
+        self.counts = {}
+
+    def record(self, name, ran, hit):
+        counts = self.counts.setdefault(name, {'frames': 0, 'runs': 0, 'hits': 0})
+        counts['frames'] += 1
+        counts['runs'] += int(ran)
+        counts['hits'] += int(hit)
+
+    def rates(self):
+        """Per stage run rate (runs/frames) and hit rate (hits/runs)."""
+        return {name: {'run_rate': c['runs'] / max(c['frames'], 1),
+                       'hit_rate': c['hits'] / max(c['runs'], 1)}
+                for name, c in self.counts.items()}
+
+    def print(self):
+        print("Cascade: " + ", ".join(
+            "%s ran %.0f%% hit %.0f%%" % (name, r['run_rate'] * 100, r['hit_rate'] * 100)
+            for name, r in self.rates().items()))
@@ -1,4 +1,7 @@
 from AMSpi import AMSpi
+from Planner import MotionPlanner
+from PoseEstimator import PoseEstimator
+import threading
 import time
 
 
@@ -7,6 +10,14 @@ class Excavator:
     RIGHT_CHAIN_MOTOR = AMSpi.DC_Motor_2
     BODY_MOTOR = AMSpi.DC_Motor_3
     SHOVEL_MOTOR = AMSpi.DC_Motor_4
+    ALL_MOTORS = (LEFT_CHAIN_MOTOR, RIGHT_CHAIN_MOTOR, BODY_MOTOR, SHOVEL_MOTOR)
+
+    # Longest time (seconds) any single command may keep a motor running
+    MAX_RUN = {LEFT_CHAIN_MOTOR: 10, RIGHT_CHAIN_MOTOR: 10, BODY_MOTOR: 6, SHOVEL_MOTOR: 6}
+    # Extra time allowed past a command's own duration before the watchdog stops it
+    DEADLINE_GRACE = 0.5
+    # Pause after stopping so the chains and gears come to rest
+    SETTLE_TIME = 0.1
 
     def __init__(self):
         self.motors = AMSpi()
@@ -16,9 +27,21 @@ class Excavator:
         self.motors.set_L293D_pins(5, 6, 13, 19)
 
         self.motors_memo = []
-
-        self.body_angle = 0
-        self.shovel_angle = 0
+        self.motor_states = {
+            motor: {'running': False, 'clockwise': True, 'speed': 0,
+                    'started_at': None, 'deadline': None}
+            for motor in self.ALL_MOTORS
+        }
+
+        self.pose = PoseEstimator(self.LEFT_CHAIN_MOTOR, self.RIGHT_CHAIN_MOTOR,
+                                  self.BODY_MOTOR, self.SHOVEL_MOTOR)
+        self.planner = MotionPlanner(self.pose)
+        self._abort = threading.Event()
+        # Held only around GPIO writes so the watchdog never waits long
+        self._gpio_lock = threading.Lock()
+        # Keeps motor_states and the pose consistent for readers on other
+        # threads (telemetry); never held across GPIO writes
+        self._state_lock = threading.Lock()
 
     def __enter__(self):
         return self
@@ -26,56 +49,142 @@ class Excavator:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.motors.clean_up()
 
+    def _run_motor(self, motor, clockwise, speed):
+        if motor not in self.motors_memo:
+            self.motors_memo.append(motor)
+        with self._gpio_lock:
+            self.motors.run_dc_motor(motor, clockwise=clockwise, speed=speed)
+        now = time.monotonic()
+        with self._state_lock:
+            self.pose.start(motor, clockwise, speed, now)
+            self.motor_states[motor].update(
+                running=True, clockwise=clockwise, speed=speed, started_at=now,
+                deadline=now + self.MAX_RUN[motor])
+
+    def _stop_motor(self, motor):
+        with self._gpio_lock:
+            self.motors.stop_dc_motor(motor)
+        with self._state_lock:
+            self.pose.stop(motor)
+            self.motor_states[motor].update(running=False, speed=0, started_at=None, deadline=None)
+
+    def set_deadline(self, motors, run_time):
+        """Lets the watchdog stop `motors` if they are still running after run_time."""
+        deadline = time.monotonic() + run_time + self.DEADLINE_GRACE
+        with self._state_lock:
+            for motor in motors:
+                state = self.motor_states[motor]
+                if state['running']:
+                    state['deadline'] = min(deadline, state['started_at'] + self.MAX_RUN[motor])
+
+    def emergency_stop(self):
+        """
+        Stops every motor with one shift register write. Safe to call from any
+        thread; interrupts a running plan as well.
+        """
+        self._abort.set()
+        # Dropping the enable pins cuts power at once and cannot corrupt a
+        # shift register write another thread is halfway through
+        self.motors.disable_all_dc_motors()
+        # Clearing the direction bits clocks the shift register, which has
+        # to wait for any write in progress
+        with self._gpio_lock:
+            self.motors.stop_all_dc_motors()
+        with self._state_lock:
+            for motor in self.ALL_MOTORS:
+                if self.motor_states[motor]['running']:
+                    self.pose.stop(motor)
+                    self.motor_states[motor].update(
+                        running=False, speed=0, started_at=None, deadline=None)
+
+    def snapshot(self):
+        """Copies of every motor state and the predicted pose, taken together."""
+        with self._state_lock:
+            states = {motor: dict(state) for motor, state in self.motor_states.items()}
+            return states, self.pose.predict()
+
+    @property
+    def body_angle(self):
+        return self.pose.predict().body_angle
+
+    @property
+    def shovel_angle(self):
+        return self.pose.predict().shovel_angle
+
+    def estimate_angles(self):
+        """Dead-reckoned (body_angle, shovel_angle), including motors still running."""
+        pose = self.pose.predict()
+        return pose.body_angle, pose.shovel_angle
+
     def execute(self, run_time=1):
+        self.set_deadline(self.motors_memo, run_time)
         time.sleep(run_time)
         for motor in self.motors_memo:
-            self.motors.stop_dc_motor(motor)
+            self._stop_motor(motor)
         self.motors_memo = []
-        time.sleep(1)
+        time.sleep(self.SETTLE_TIME)
+
+    def abort(self):
+        """Interrupts a running plan at the next opportunity."""
+        self._abort.set()
+
+    def _stop_running(self):
+        for motor in self.motors_memo:
+            self._stop_motor(motor)
+        self.motors_memo = []
+
+    def run_plan(self, plan, checkpoint=None):
+        """
+        Runs a Planner.Plan as one unit. `checkpoint` is called at each plan
+        checkpoint and may return False to abort; `abort()` interrupts at once.
+        Returns True if the plan finished.
+        """
+        self._abort.clear()
+        start = time.monotonic()
+        for at, kind, segment in plan.events():
+            if self._abort.wait(max(0, start + at - time.monotonic())):
+                self._stop_running()
+                return False
+            if kind == 'start':
+                self._run_motor(segment.motor, segment.clockwise, segment.speed)
+                self.set_deadline([segment.motor], segment.end - at)
+            elif kind == 'stop':
+                self._stop_motor(segment.motor)
+                self.motors_memo.remove(segment.motor)
+            elif checkpoint is not None and not checkpoint():
+                self._stop_running()
+                return False
+        return True
+
+    def grab(self, distance, bearing=0, dig=True, checkpoint=None):
+        """Turns to, drives up to and (with `dig`) digs at a target in a single plan."""
+        plan = self.planner.plan_grab(distance, bearing, dig=dig)
+        print("Executing grab plan", plan)
+        return self.run_plan(plan, checkpoint)
 
     def forward_left_chain(self, speed=100):
-        self.motors_memo.append(self.LEFT_CHAIN_MOTOR)
-        self.motors.run_dc_motor(self.LEFT_CHAIN_MOTOR,
-                                 clockwise=True,
-                                 speed=speed)
+        self._run_motor(self.LEFT_CHAIN_MOTOR, clockwise=True, speed=speed)
 
     def backward_left_chain(self, speed=100):
-        self.motors_memo.append(self.LEFT_CHAIN_MOTOR)
-        self.motors.run_dc_motor(self.LEFT_CHAIN_MOTOR,
-                                 clockwise=False,
-                                 speed=speed)
+        self._run_motor(self.LEFT_CHAIN_MOTOR, clockwise=False, speed=speed)
 
     def forward_right_chain(self, speed=100):
-        self.motors_memo.append(self.RIGHT_CHAIN_MOTOR)
-        self.motors.run_dc_motor(self.RIGHT_CHAIN_MOTOR,
-                                 clockwise=True,
-                                 speed=speed)
+        self._run_motor(self.RIGHT_CHAIN_MOTOR, clockwise=True, speed=speed)
 
     def backward_right_chain(self, speed=100):
-        self.motors_memo.append(self.RIGHT_CHAIN_MOTOR)
-        self.motors.run_dc_motor(self.RIGHT_CHAIN_MOTOR,
-                                 clockwise=False,
-                                 speed=speed)
+        self._run_motor(self.RIGHT_CHAIN_MOTOR, clockwise=False, speed=speed)
 
     def turn_left_body(self, speed=100):
-        self.motors_memo.append(self.BODY_MOTOR)
-        self.motors.run_dc_motor(self.BODY_MOTOR, clockwise=True, speed=speed)
+        self._run_motor(self.BODY_MOTOR, clockwise=True, speed=speed)
 
     def turn_right_body(self, speed=100):
-        self.motors_memo.append(self.BODY_MOTOR)
-        self.motors.run_dc_motor(self.BODY_MOTOR, clockwise=False, speed=speed)
+        self._run_motor(self.BODY_MOTOR, clockwise=False, speed=speed)
 
     def move_up_shovel(self, speed=100):
-        self.motors_memo.append(self.SHOVEL_MOTOR)
-        self.motors.run_dc_motor(self.SHOVEL_MOTOR,
-                                 clockwise=True,
-                                 speed=speed)
+        self._run_motor(self.SHOVEL_MOTOR, clockwise=True, speed=speed)
 
     def move_down_shovel(self, speed=100):
-        self.motors_memo.append(self.SHOVEL_MOTOR)
-        self.motors.run_dc_motor(self.SHOVEL_MOTOR,
-                                 clockwise=False,
-                                 speed=speed)
+        self._run_motor(self.SHOVEL_MOTOR, clockwise=False, speed=speed)
 
     def move_forward(self, speed=100):
         self.backward_left_chain()  # TODO: fix hardware issue
@@ -86,10 +195,10 @@ class Excavator:
         self.backward_right_chain(speed)
 
     def stop_all_motors(self):
-        self.motors.stop_dc_motors(
-            [self.LEFT_CHAIN_MOTOR, self.RIGHT_CHAIN_MOTOR, self.BODY_MOTOR, self.SHOVEL_MOTOR])
+        for motor in self.ALL_MOTORS:
+            self._stop_motor(motor)
         self.motors_memo = []
-        time.sleep(1)
+        time.sleep(self.SETTLE_TIME)
 
     def test_move(self):
         self.forward_left_chain()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Search pattern for the target when it is not in view.
+
+A coarse angular grid around the robot remembers how recently each sector
+was looked at. The camera direction (chassis heading plus body angle) is
+dead-reckoned from the motor history, from telemetry when the motor node
+streams it or from the commands issued otherwise, and every frame marks
+the sectors inside the field of view as seen. Frames taken while turning
+are blurred and count less. Memory fades so old sectors are worth another
+look, and a sector where the target was just lost is cleared so it is the
+first one revisited.
+
+`next_command` scores every turn the robot can make (chain or body, 1 to
+MAX_SECONDS seconds) by the unseen area it brings into view per second
+spent, over a fixed candidate set, so its cost per frame is bounded.
+"""
+
+import math
+import time
+
+import numpy as np
+
+from Planner import CAMERA_FOV, bearing_from_box
+from PoseEstimator import PoseEstimator
+
+# motor_node actions used for searching, as the (motor, clockwise) they run
+ACTIONS = {
+    'left': ('left_chain', True),
+    'right': ('right_chain', True),
+    'shovel-left': ('body', True),
+    'shovel-right': ('body', False)
+}
+
+
+def _wrap(angles):
+    """Wraps degrees into [-180, 180)."""
+    return (np.asarray(angles) + 180.0) % 360.0 - 180.0
+
+
+class Explorer:
+    BINS = 36  # 10 degree sectors
+    MEMORY = 60.0  # seconds for a seen sector to fade to 1/e
+    BLUR_WEIGHT = 0.3  # how much a frame taken while turning counts
+    BODY_LIMIT = 90.0  # furthest body angle the search may use
+    MAX_SECONDS = 6  # longest single turn, motor_node takes whole seconds
+    OVERHEAD = 0.5  # seconds lost per command (ack, settling, a new frame)
+    MIN_GAIN = 1.5  # unseen sectors worth a move
+
+    def __init__(self, fov=CAMERA_FOV, clock=time.monotonic):
+        self.fov = fov
+        self.clock = clock
+        self.bins = (np.arange(self.BINS) + 0.5) * 360.0 / self.BINS - 180.0
+        self.seen = np.zeros(self.BINS)
+        self.stamp = clock()
+        self.estimator = PoseEstimator('left_chain', 'right_chain', 'body', 'shovel', clock=clock)
+        self.running = {}
+        self.telemetry_fed = False
+        self.target_direction = None
+        self.moves = self._moves()
+
+    def _moves(self):
+        """(action, seconds, heading change, body change) of every candidate turn."""
+        moves = []
+        for action, (motor, clockwise) in ACTIONS.items():
+            for seconds in range(1, self.MAX_SECONDS + 1):
+                model = PoseEstimator('left_chain', 'right_chain', 'body', 'shovel',
+                                      clock=lambda: 0.0)
+                model.start(motor, clockwise, t=0.0)
+                pose = model.predict(t=float(seconds))
+                moves.append((action, seconds, pose.heading, pose.body_angle))
+        return moves
+
+    def sync(self, state, now=None):
+        """Feeds a decoded telemetry packet: motor starts and stops and the body angle."""
+        if state is None:
+            return
+        now = self.clock() if now is None else now
+        self.telemetry_fed = True
+        for name, motor in state['motors'].items():
+            if motor['running'] and self.running.get(name) != motor['clockwise']:
+                self.estimator.start(name, motor['clockwise'], motor['speed'] or 100, t=now)
+                self.running[name] = motor['clockwise']
+            elif not motor['running'] and name in self.running:
+                self.estimator.stop(name, t=now)
+                del self.running[name]
+        # The motor node's body estimate is the one corrected by its own model
+        self.estimator.correct(gain=1.0, body_angle=state['body_angle'])
+
+    def record(self, action, seconds):
+        """Integrates an issued command when there is no telemetry to follow."""
+        motor, clockwise = ACTIONS.get(action, (None, None))
+        if motor is not None and not self.telemetry_fed:
+            self.estimator.apply(motor, clockwise, 100, seconds)
+
+    def direction(self, now=None):
+        pose = self.estimator.predict(now)
+        return float(_wrap(pose.heading + pose.body_angle))
+
+    def update(self, results, labels, target, moving=False, now=None):
+        """
+        Marks the current view as seen and remembers where the target was.
+        `results` are the frame's detections, `target` the label searched for.
+        """
+        now = self.clock() if now is None else now
+        self.seen *= math.exp(-(now - self.stamp) / self.MEMORY)
+        self.stamp = now
+
+        view = self.direction(now)
+        in_view = np.abs(_wrap(self.bins - view)) <= self.fov / 2
+        weight = self.BLUR_WEIGHT if moving else 1.0
+        self.seen[in_view] = np.maximum(self.seen[in_view], weight)
+
+        found = [obj for obj in results if labels[obj['class_id']] == target]
+        if found:
+            best = max(found, key=lambda obj: obj['score'])
+            self.target_direction = view + bearing_from_box(best['bounding_box'])
+        elif self.target_direction is not None and not moving:
+            # Lost it: look there again first
+            near = np.abs(_wrap(self.bins - self.target_direction)) <= 360.0 / self.BINS
+            self.seen[near] = 0.0
+            self.target_direction = None
+
+    def next_command(self, now=None):
+        """
+        Best turn as a leased motor_node command, or None when every sector
+        was seen recently. The lease lets motor_node return at once and its
+        watchdog stop the turn, so the vision loop is not blocked.
+        """
+        now = self.clock() if now is None else now
+        pose = self.estimator.predict(now)
+        start = pose.heading + pose.body_angle
+        unseen = 1.0 - self.seen
+
+        moves = [m for m in self.moves if abs(pose.body_angle + m[3]) <= self.BODY_LIMIT]
+        turns = np.array([m[2] + m[3] for m in moves])
+        seconds = np.array([m[1] for m in moves], float)
+
+        # Sectors swept on the way (blurred) and in view at the end
+        half = self.fov / 2
+        offset = np.where(turns[:, None] >= 0,
+                          (self.bins[None, :] - start + half) % 360.0,
+                          (start - self.bins[None, :] + half) % 360.0)
+        swept = offset <= np.abs(turns)[:, None] + self.fov
+        final = np.abs(_wrap(self.bins[None, :] - (start + turns)[:, None])) <= half
+        gain = (np.where(final, 1.0, np.where(swept, self.BLUR_WEIGHT, 0.0)) * unseen).sum(axis=1)
+        score = gain / (seconds + self.OVERHEAD)
+
+        best = int(np.argmax(score))
+        if gain[best] < self.MIN_GAIN:
+            return None
+        action, duration = moves[best][0], moves[best][1]
+        self.record(action, duration)
+        return {"action": action, "value": str(duration), "lease": duration}
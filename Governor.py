@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Adaptive quality governor for the vision pipeline.
+
+The Pi throttles when it runs hot, and frame time then creeps past what the
+control loop can use. The governor samples CPU temperature, frequency,
+throttling and load, keeps a smoothed per-stage and end-to-end latency, and
+moves the camera along a ladder of quality levels to hold a latency budget:
+
+    level 0  full quality
+    level 1  light model variants where configured, fewer batch workers
+             (camera_node configures no `light_model`, so there it only
+             cuts the batch workers)
+    level 2  no tiled mode (640x480 capture), cascade stages on crops only
+    level 3  detection on every 2nd frame, lower framerate
+    level 4  detection on every 3rd frame, single batch worker
+
+It steps down at once when over budget, hot or throttled, and steps back
+up only after conditions stayed good for HOLD seconds.
+
+System files are read relative to `root`, so tests can point it at a
+folder of fixture files with the same layout.
+"""
+
+import os
+import time
+
+LEVELS = [
+    {'light_models': False, 'tiling': True, 'cascade_mode': None,
+     'detect_every': 1, 'framerate': 30, 'workers': 4},
+    {'light_models': True, 'tiling': True, 'cascade_mode': None,
+     'detect_every': 1, 'framerate': 30, 'workers': 3},
+    {'light_models': True, 'tiling': False, 'cascade_mode': 'crops',
+     'detect_every': 1, 'framerate': 20, 'workers': 2},
+    {'light_models': True, 'tiling': False, 'cascade_mode': 'crops',
+     'detect_every': 2, 'framerate': 15, 'workers': 2},
+    {'light_models': True, 'tiling': False, 'cascade_mode': 'crops',
+     'detect_every': 3, 'framerate': 10, 'workers': 1},
+]
+
+
+class SystemSensors:
+    TEMPERATURE = 'sys/class/thermal/thermal_zone0/temp'  # millidegrees C
+    FREQUENCY = 'sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq'  # kHz
+    MAX_FREQUENCY = 'sys/devices/system/cpu/cpu0/cpufreq/scaling_max_freq'  # kHz
+    # Raspberry Pi firmware flags, bit 2 is "throttled now"
+    THROTTLED = 'sys/devices/platform/soc/soc:firmware/get_throttled'
+    LOADAVG = 'proc/loadavg'
+
+    def __init__(self, root='/'):
+        self.root = root
+
+    def _read(self, path):
+        try:
+            with open(os.path.join(self.root, path), 'r') as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _number(self, path, base=10):
+        value = self._read(path)
+        try:
+            return int(value, base) if value is not None else None
+        except ValueError:
+            return None
+
+    def read(self):
+        """Current readings; a value is None when its file is not there."""
+        temperature = self._number(self.TEMPERATURE)
+        throttled = self._number(self.THROTTLED, 16)
+        loadavg = self._read(self.LOADAVG)
+        return {
+            'temperature': temperature / 1000 if temperature is not None else None,
+            'frequency': self._number(self.FREQUENCY),
+            'max_frequency': self._number(self.MAX_FREQUENCY),
+            'throttled': bool(throttled & 0x4) if throttled is not None else None,
+            'load': float(loadavg.split()[0]) / (os.cpu_count() or 1) if loadavg else None
+        }
+
+
+class Governor:
+    TEMP_HIGH = 78.0  # degrees C, the Pi 4 soft limit is 80
+    TEMP_OK = 70.0
+    LOAD_HIGH = 1.5  # runnable tasks per core
+    HEADROOM = 0.7  # latency under this share of the budget counts as good
+    HOLD = 5.0  # seconds of good conditions before stepping up
+    SETTLE = 1.0  # seconds a new level runs before stepping down again
+    SAMPLE_PERIOD = 1.0  # seconds between system samples
+    SMOOTHING = 0.2
+
+    def __init__(self, camera, budget_ms=150.0, sensors=None, clock=time.monotonic):
+        self.camera = camera
+        self.budget_ms = budget_ms
+        self.sensors = sensors or SystemSensors()
+        self.clock = clock
+        self.level = 0
+        self.latency_ms = None
+        self.stage_ms = {}
+        self.system = {}
+        self.sampled_at = None
+        self.good_since = None
+        self.changed_at = None
+        self.frame = 0
+
+    def should_detect(self):
+        """False on the frames skipped at the current detection frequency."""
+        self.frame += 1
+        return self.frame % LEVELS[self.level]['detect_every'] == 0
+
+    def frame_done(self, stage_ms, total_ms, now=None):
+        """Feeds one frame's latencies (per stage and end to end) and adapts."""
+        now = self.clock() if now is None else now
+        for name, ms in stage_ms.items():
+            previous = self.stage_ms.get(name, ms)
+            self.stage_ms[name] = previous + self.SMOOTHING * (ms - previous)
+        if self.latency_ms is None:
+            self.latency_ms = total_ms
+        self.latency_ms += self.SMOOTHING * (total_ms - self.latency_ms)
+        if self.sampled_at is None or now - self.sampled_at >= self.SAMPLE_PERIOD:
+            self.system = self.sensors.read()
+            self.sampled_at = now
+        self.adapt(now)
+
+    def _pressure(self):
+        """Reason to step down, or None."""
+        if self.latency_ms > self.budget_ms:
+            return "latency %.0fms over %.0fms" % (self.latency_ms, self.budget_ms)
+        temperature = self.system.get('temperature')
+        if temperature is not None and temperature >= self.TEMP_HIGH:
+            return "temperature %.1fC" % temperature
+        if self.system.get('throttled'):
+            return "CPU throttled"
+        frequency, max_frequency = self.system.get('frequency'), self.system.get('max_frequency')
+        if frequency and max_frequency and frequency < max_frequency * 0.75 \
+                and self.latency_ms > self.budget_ms * self.HEADROOM:
+            return "CPU at %d MHz" % (frequency // 1000)
+        load = self.system.get('load')
+        if load is not None and load >= self.LOAD_HIGH and self.latency_ms > self.budget_ms * self.HEADROOM:
+            return "load %.1f per core" % load
+        return None
+
+    def _relaxed(self):
+        temperature = self.system.get('temperature')
+        return (self.latency_ms < self.budget_ms * self.HEADROOM
+                and (temperature is None or temperature < self.TEMP_OK)
+                and not self.system.get('throttled'))
+
+    def adapt(self, now):
+        reason = self._pressure()
+        if reason is not None:
+            self.good_since = None
+            settled = self.changed_at is None or now - self.changed_at >= self.SETTLE
+            if settled and self.level < len(LEVELS) - 1:
+                self.set_level(self.level + 1, reason)
+                self.changed_at = now
+                # Give the new level a fresh latency estimate
+                self.latency_ms = None
+        elif self._relaxed():
+            if self.good_since is None:
+                self.good_since = now
+            elif now - self.good_since >= self.HOLD and self.level > 0:
+                self.set_level(self.level - 1, "latency %.0fms" % self.latency_ms)
+                self.good_since = now
+                self.changed_at = now
+                self.latency_ms = None
+        else:
+            self.good_since = None
+
+    def set_level(self, level, reason=''):
+        slowest = max(self.stage_ms, key=self.stage_ms.get, default=None)
+        print("Quality level %d -> %d (%s), slowest stage %s" % (self.level, level, reason, slowest))
+        self.level = level
+        self.camera.apply_quality(LEVELS[level])
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Registry of the TFLite models under ./trained_model.
+
+Every folder holding a `.tflite` file is a model, named after the folder.
+Labels come from the `.txt` file next to it and, when present, the AutoML
+manifest (`metadata.json` or `tflite_metadata.json`) describes the input
+shape, quantization type and output tensors; these are validated against the
+interpreter when it is created.
+
+Interpreters are created lazily on first use and shared: asking twice for
+the same model returns the same `SharedModel`, so the model is held in
+memory once however many pipelines use it. The interpreter is built from
+the file's bytes rather than from `model_path`: TFLite would memory-map
+the path, and a new file copied over it while the camera runs would change
+the pages under the running interpreter (SIGBUS once the file is
+truncated). An interpreter must not run two `invoke` calls at once, so
+users sharing a model hold `SharedModel.lock` while setting inputs,
+invoking and reading outputs.
+
+A model file replaced on disk shows up in `changed()`; `reload` builds and
+validates a fresh `SharedModel` for it and only then registers it, so a
+broken file never replaces a working model.
+"""
+
+import glob
+import json
+import os
+import re
+import threading
+
+import numpy as np
+
+from tflite_runtime.interpreter import Interpreter
+
+from TensorBinding import TensorBinding
+
+MODEL_DIR = './trained_model'
+MANIFEST_NAMES = ('metadata.json', 'tflite_metadata.json')
+INFERENCE_TYPES = {'QUANTIZED_UINT8': np.uint8, 'FLOAT': np.float32, 'FLOAT32': np.float32}
+
+
+class ModelError(Exception):
+    pass
+
+
+def load_labels(path):
+    """Loads the labels file. Supports files with or without index numbers."""
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+        labels = {}
+        for row_number, content in enumerate(lines):
+            pair = re.split(r'[:\s]+', content.strip(), maxsplit=1)
+            if len(pair) == 2 and pair[0].strip().isdigit():
+                labels[int(pair[0])] = pair[1].strip()
+            else:
+                labels[row_number] = pair[0].strip()
+    return labels
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class SharedModel:
+    """A lazily created interpreter shared by every pipeline using the model."""
+
+    def __init__(self, name, model_path, label_path, manifest=None, num_threads=None):
+        self.name = name
+        self.model_path = model_path
+        self.label_path = label_path
+        self.manifest = manifest
+        self.num_threads = num_threads
+        self.lock = threading.RLock()
+        self.mtime = _mtime(model_path)
+        self._interpreter = None
+        self._content = None
+        self._labels = None
+
+    @property
+    def content(self):
+        """The model file's bytes, read once; every interpreter of the model is built from them."""
+        if self._content is None:
+            with self.lock:
+                if self._content is None:
+                    with open(self.model_path, 'rb') as f:
+                        self._content = f.read()
+        return self._content
+
+    @property
+    def interpreter(self):
+        if self._interpreter is None:
+            with self.lock:
+                if self._interpreter is None:
+                    interpreter = Interpreter(model_content=self.content,
+                                              num_threads=self.num_threads)
+                    interpreter.allocate_tensors()
+                    self.validate(interpreter)
+                    self._interpreter = interpreter
+        return self._interpreter
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = load_labels(self.label_path)
+        return self._labels
+
+    @property
+    def shape(self):
+        return self.interpreter.get_input_details()[0]['shape']
+
+    @property
+    def loaded(self):
+        return self._interpreter is not None
+
+    def validate(self, interpreter):
+        """Checks the interpreter's tensors against the manifest and the detection layout."""
+        inputs = interpreter.get_input_details()
+        outputs = interpreter.get_output_details()
+        if len(inputs) != 1 or len(inputs[0]['shape']) != 4 or inputs[0]['shape'][3] != 3:
+            raise ModelError("%s: expected one NHWC RGB input, got %s"
+                             % (self.name, [d['shape'].tolist() for d in inputs]))
+        if len(outputs) < 4:
+            raise ModelError("%s: expected 4 detection outputs (boxes, classes, scores, count), got %d"
+                             % (self.name, len(outputs)))
+        if self.manifest is None:
+            return
+        shape = self.manifest.get('inputShape')
+        if shape is not None and list(inputs[0]['shape']) != list(shape):
+            raise ModelError("%s: input shape %s does not match manifest %s"
+                             % (self.name, inputs[0]['shape'].tolist(), shape))
+        dtype = INFERENCE_TYPES.get(self.manifest.get('inferenceType'))
+        if dtype is not None and inputs[0]['dtype'] != dtype:
+            raise ModelError("%s: input type %s does not match manifest %s"
+                             % (self.name, inputs[0]['dtype'].__name__, self.manifest['inferenceType']))
+        names = self.manifest.get('outputTensors')
+        if names is not None and [d['name'] for d in outputs[:len(names)]] != names:
+            raise ModelError("%s: output tensors %s do not match manifest %s"
+                             % (self.name, [d['name'] for d in outputs], names))
+
+    def changed(self):
+        """True when the model file on disk is not the one this model was built from."""
+        mtime = _mtime(self.model_path)
+        return mtime is not None and mtime != self.mtime
+
+    def release(self):
+        with self.lock:
+            if self._interpreter is not None:
+                TensorBinding.drop(self._interpreter)
+            self._interpreter = None
+            self._content = None
+
+
+class ModelRegistry:
+    def __init__(self, model_dir=MODEL_DIR, num_threads=None):
+        self.model_dir = model_dir
+        self.num_threads = num_threads
+        self.models = {}
+        self.scan()
+
+    def scan(self):
+        """Registers every model folder not known yet. Returns the new names."""
+        found = []
+        for model_path in sorted(glob.glob(os.path.join(self.model_dir, '*', '*.tflite'))):
+            folder = os.path.dirname(model_path)
+            name = os.path.basename(folder)
+            if name in self.models:
+                continue
+            labels = sorted(glob.glob(os.path.join(folder, '*.txt')))
+            if not labels:
+                print("Skipping model without labels:", model_path)
+                continue
+            self.register(name, model_path, labels[0], self._read_manifest(folder))
+            found.append(name)
+        return found
+
+    def _read_manifest(self, folder):
+        for manifest_name in MANIFEST_NAMES:
+            path = os.path.join(folder, manifest_name)
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        return None
+
+    def register(self, name, model_path, label_path, manifest=None):
+        self.models[name] = SharedModel(name, model_path, label_path, manifest, self.num_threads)
+        return self.models[name]
+
+    def changed(self):
+        """{name: new file mtime} of the registered models whose file was replaced on disk."""
+        return {name: _mtime(model.model_path)
+                for name, model in list(self.models.items()) if model.changed()}
+
+    def reload(self, name):
+        """
+        Builds the interpreter of a replaced model file and registers it in
+        place of the old model. Returns (old, new); raises ModelError (and
+        keeps the old model) when the new file does not validate.
+        """
+        old = self.get(name)
+        new = SharedModel(name, old.model_path, old.label_path,
+                          self._read_manifest(os.path.dirname(old.model_path)), self.num_threads)
+        try:
+            # Creating the interpreter loads and validates the new file
+            new.interpreter
+        except (OSError, RuntimeError, ValueError) as e:
+            raise ModelError("%s: cannot load %s: %s" % (name, old.model_path, e))
+        self.models[name] = new
+        return old, new
+
+    def get(self, name):
+        if name not in self.models:
+            raise ModelError("Unknown model %r, known models: %s" % (name, sorted(self.models)))
+        return self.models[name]
+
+    def get_by_path(self, model_path, label_path):
+        """Returns the registered model for a file path, registering it if needed."""
+        real_path = os.path.realpath(model_path)
+        for model in self.models.values():
+            if os.path.realpath(model.model_path) == real_path:
+                return model
+        name = os.path.basename(os.path.dirname(real_path))
+        if not name or name in self.models:
+            name = real_path
+        return self.register(name, model_path, label_path,
+                             self._read_manifest(os.path.dirname(model_path)))
+
+
+_default_registry = None
+
+
+def default_registry():
+    """Process wide registry, so every pipeline shares the same interpreters."""
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = ModelRegistry()
+    return _default_registry
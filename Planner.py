@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Motion-primitive planner compiling a whole approach-and-dig manoeuvre into one
+time-parameterised multi-motor schedule.
+
+Instead of one blocking command per round trip (turn, stop, forward, shovel),
+the planner emits segments `(start, end, motor, clockwise, speed)` that the
+Excavator runs as a single unit. The chassis turns on the spot to face the
+target while the body swings back in line with it, then the chains drive
+straight; shovel motion never overlaps anything else. Checkpoints mark the
+moments between phases where the plan may be aborted.
+"""
+
+import math
+
+from collections import namedtuple
+
+Segment = namedtuple('Segment', ['start', 'end', 'motor', 'clockwise', 'speed'])
+
+# Horizontal field of view of the Pi camera v2 in degrees
+CAMERA_FOV = 62.2
+# Frame width / height of the capture modes (640x480 and 1280x960)
+CAMERA_ASPECT = 4 / 3
+# Size of the target in mm, the object Camera.detect_sizes is calibrated for
+TARGET_WIDTH = 55.0
+TARGET_HEIGHT = 80.0
+
+
+def bearing_from_box(bounding_box, fov=CAMERA_FOV):
+    """Bearing in degrees (left is positive) of a relative [ymin, xmin, ymax, xmax] box."""
+    ymin, xmin, ymax, xmax = bounding_box
+    center = (xmin + xmax) / 2
+    return (0.5 - center) * fov
+
+
+def range_from_box(bounding_box, fov=CAMERA_FOV, aspect=CAMERA_ASPECT,
+                   width=TARGET_WIDTH, height=TARGET_HEIGHT):
+    """
+    Distance in mm from the camera to a target of known size, from its
+    relative [ymin, xmin, ymax, xmax] box and the pinhole model. A box cut
+    by the frame edge looks too small, so the side giving the nearer range
+    is used.
+    """
+    ymin, xmin, ymax, xmax = bounding_box
+    # Focal length in frame widths
+    focal = 0.5 / math.tan(math.radians(fov) / 2)
+    ranges = []
+    if xmax > xmin:
+        ranges.append(focal * width / (xmax - xmin))
+    if ymax > ymin:
+        ranges.append(focal * aspect * height / (ymax - ymin))
+    if not ranges:
+        return math.inf
+    # Along the optical axis so far, the target is off to the side
+    return min(ranges) / math.cos(math.radians(bearing_from_box(bounding_box, fov)))
+
+
+class Plan:
+    def __init__(self, segments, checkpoints):
+        self.segments = sorted(segments, key=lambda s: s.start)
+        self.checkpoints = sorted(set(checkpoints))
+
+    @property
+    def duration(self):
+        return max([s.end for s in self.segments] + self.checkpoints + [0])
+
+    def events(self):
+        """
+        Time-ordered (time, kind, segment) tuples, kind being 'start', 'stop'
+        or 'check'. At equal times stops come first so a motor is never
+        driven by two segments at once.
+        """
+        order = {'stop': 0, 'check': 1, 'start': 2}
+        events = [(s.start, 'start', s) for s in self.segments]
+        events += [(s.end, 'stop', s) for s in self.segments]
+        events += [(t, 'check', None) for t in self.checkpoints]
+        return sorted(events, key=lambda e: (e[0], order[e[1]]))
+
+    def __repr__(self):
+        return 'Plan(%.2fs, %d segments)' % (self.duration, len(self.segments))
+
+
+class MotionPlanner:
+    REACH = 120.0  # mm from the chassis origin to the shovel tip on the ground
+    TRAVEL_ANGLE = 20.0  # shovel angle that keeps it clear while driving
+    DIG_ANGLE = -30.0  # shovel angle at the bottom of a dig
+    BEARING_TOLERANCE = 3.0  # deg, smaller errors are not worth a turn
+    TRAVEL_TOLERANCE = 10.0  # mm, shorter drives are not worth it
+
+    def __init__(self, estimator):
+        """Uses the calibrated rates and motor mapping of a PoseEstimator."""
+        self.estimator = estimator
+        self.motors = {name: motor for motor, name in estimator.names.items()}
+
+    def _segment(self, name, start, amount, speed=100):
+        """Segment moving a part by a signed amount (mm or deg) from start."""
+        rate = self.estimator.rates[name] * speed / 100
+        positive = self.estimator.POSITIVE_CLOCKWISE[name]
+        clockwise = positive if amount >= 0 else not positive
+        return Segment(start, start + abs(amount) / rate, self.motors[name], clockwise, speed)
+
+    def plan_grab(self, distance, bearing, pose=None, dig=True):
+        """
+        Plans turning towards a target `distance` mm away at `bearing` degrees
+        (left is positive) from where the camera looks, driving up to it and,
+        with `dig`, digging. Targets already closer than REACH are backed off.
+        """
+        pose = pose or self.estimator.predict()
+        segments = []
+        checkpoints = [0.0]
+        t = 0.0
+
+        # Lift the shovel clear before anything moves under it
+        if pose.shovel_angle < self.TRAVEL_ANGLE:
+            raise_shovel = self._segment('shovel', t, self.TRAVEL_ANGLE - pose.shovel_angle)
+            segments.append(raise_shovel)
+            t = raise_shovel.end
+            checkpoints.append(t)
+        shovel_angle = max(pose.shovel_angle, self.TRAVEL_ANGLE)
+
+        # The camera looks along the body, the chains drive along the chassis:
+        # turn the chassis on the spot to the target while the body swings
+        # back in line with it
+        phase_end = t
+        turn = pose.body_angle + bearing
+        if abs(turn) > self.BEARING_TOLERANCE:
+            arc = math.radians(turn) * self.estimator.TRACK_WIDTH / 2
+            for name, amount in (('left_chain', -arc), ('right_chain', arc)):
+                spin = self._segment(name, t, amount)
+                segments.append(spin)
+                phase_end = max(phase_end, spin.end)
+        if abs(pose.body_angle) > self.BEARING_TOLERANCE:
+            straighten = self._segment('body', t, -pose.body_angle)
+            segments.append(straighten)
+            phase_end = max(phase_end, straighten.end)
+        if phase_end > t:
+            checkpoints.append(phase_end)
+            t = phase_end
+
+        travel = distance - self.REACH
+        if abs(travel) > self.TRAVEL_TOLERANCE:
+            for name in ('left_chain', 'right_chain'):
+                drive = self._segment(name, t, travel)
+                segments.append(drive)
+                phase_end = max(phase_end, drive.end)
+            checkpoints.append(phase_end)
+
+        if dig:
+            dig_down = self._segment('shovel', phase_end, self.DIG_ANGLE - shovel_angle)
+            segments.append(dig_down)
+            checkpoints.append(dig_down.end)
+        return Plan(segments, checkpoints)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dead-reckoning pose estimation for the excavator.
+
+The estimator is fed with motor start/stop events (or finished commands from
+a log) and integrates them with calibrated per-motor rates:
+
+* chains   - differential drive, giving chassis position (mm) and heading (deg)
+* body     - yaw of the body relative to the chassis (deg, left is positive)
+* shovel   - shovel angle (deg, up is positive), limited by mechanical stops
+
+Between events every velocity is constant, so `predict` is a closed-form step
+from the last settled state and is cheap enough to call on every frame.
+Vision measurements can pull the estimate back with `correct`.
+"""
+
+import math
+import time
+
+from collections import deque, namedtuple
+
+Pose = namedtuple('Pose', ['x', 'y', 'heading', 'body_angle', 'shovel_angle'])
+
+
+class PoseEstimator:
+    # Calibrated rates at full duty cycle
+    CHAIN_SPEED = 80.0  # mm/s of chain travel
+    TRACK_WIDTH = 150.0  # mm between the chain centres
+    BODY_RATE = 30.0  # deg/s
+    SHOVEL_RATE = 12.0  # deg/s
+    SHOVEL_LIMITS = (-40.0, 40.0)
+
+    # Spin direction moving each part forward, left or up.
+    # The left chain is mounted mirrored (see Excavator.move_forward).
+    POSITIVE_CLOCKWISE = {
+        'left_chain': False,
+        'right_chain': True,
+        'body': True,
+        'shovel': True
+    }
+
+    def __init__(self, left_chain, right_chain, body, shovel,
+                 clock=time.monotonic, log_size=256):
+        self.names = {left_chain: 'left_chain', right_chain: 'right_chain',
+                      body: 'body', shovel: 'shovel'}
+        self.rates = {
+            'left_chain': self.CHAIN_SPEED,
+            'right_chain': self.CHAIN_SPEED,
+            'body': self.BODY_RATE,
+            'shovel': self.SHOVEL_RATE
+        }
+        self.clock = clock
+        # Signed rate of every part while it runs, 0 when stopped
+        self.velocity = dict.fromkeys(self.rates, 0.0)
+        self.started = {}
+        # Finished commands as (motor, clockwise, speed, duration)
+        self.log = deque(maxlen=log_size)
+        self.pose = Pose(0.0, 0.0, 0.0, 0.0, 0.0)
+        self.stamp = clock()
+
+    def calibrate(self, motor, rate):
+        """Sets the full duty rate (mm/s for chains, deg/s otherwise) of a motor."""
+        self.settle()
+        self.rates[self.names[motor]] = rate
+
+    def _signed_rate(self, name, clockwise, speed):
+        sign = 1.0 if clockwise == self.POSITIVE_CLOCKWISE[name] else -1.0
+        return sign * self.rates[name] * speed / 100
+
+    def _step(self, pose, velocity, dt):
+        """Integrates constant velocities over dt seconds."""
+        if dt <= 0:
+            return pose
+        v_left, v_right = velocity['left_chain'], velocity['right_chain']
+        speed = (v_left + v_right) / 2
+        omega = (v_right - v_left) / self.TRACK_WIDTH
+        heading = math.radians(pose.heading)
+        if abs(omega) < 1e-9:
+            x = pose.x + speed * math.cos(heading) * dt
+            y = pose.y + speed * math.sin(heading) * dt
+        else:
+            # Exact arc for a differential drive turning at constant rate
+            turned = heading + omega * dt
+            x = pose.x + speed / omega * (math.sin(turned) - math.sin(heading))
+            y = pose.y - speed / omega * (math.cos(turned) - math.cos(heading))
+        low, high = self.SHOVEL_LIMITS
+        shovel = min(high, max(low, pose.shovel_angle + velocity['shovel'] * dt))
+        return Pose(x, y,
+                    pose.heading + math.degrees(omega * dt),
+                    pose.body_angle + velocity['body'] * dt,
+                    shovel)
+
+    def settle(self, t=None):
+        """Folds the motion since the last event into the stored pose."""
+        t = self.clock() if t is None else t
+        self.pose = self._step(self.pose, self.velocity, t - self.stamp)
+        self.stamp = t
+        return self.pose
+
+    def start(self, motor, clockwise, speed=100, t=None):
+        """Records that a motor started (or changed direction or duty)."""
+        t = self.clock() if t is None else t
+        self.stop(motor, t)
+        name = self.names[motor]
+        self.velocity[name] = self._signed_rate(name, clockwise, speed)
+        self.started[motor] = (t, clockwise, speed)
+
+    def stop(self, motor, t=None):
+        """Records that a motor stopped."""
+        t = self.clock() if t is None else t
+        self.settle(t)
+        self.velocity[self.names[motor]] = 0.0
+        if motor in self.started:
+            started_at, clockwise, speed = self.started.pop(motor)
+            self.log.append((motor, clockwise, speed, t - started_at))
+
+    def apply(self, motor, clockwise, speed, duration):
+        """Integrates a finished command from a log entry on its own."""
+        name = self.names[motor]
+        velocity = dict.fromkeys(self.velocity, 0.0)
+        velocity[name] = self._signed_rate(name, clockwise, speed)
+        self.pose = self._step(self.pose, velocity, duration)
+        self.log.append((motor, clockwise, speed, duration))
+
+    def predict(self, t=None):
+        """Pose at time t (now by default) without changing the estimator."""
+        t = self.clock() if t is None else t
+        return self._step(self.pose, self.velocity, t - self.stamp)
+
+    def correct(self, gain=0.5, **measured):
+        """
+        Blends vision measurements into the estimate.
+
+        `measured` takes any Pose field, e.g. correct(body_angle=12.0).
+        A gain of 1 trusts the measurement fully, 0 ignores it.
+        """
+        pose = self.settle()
+        blended = {field: value + gain * (measured[field] - value)
+                   for field, value in pose._asdict().items() if field in measured}
+        self.pose = pose._replace(**blended)
+        return self.pose
+
+    def reset(self, pose=None):
+        self.settle()
+        self.pose = pose or Pose(0.0, 0.0, 0.0, 0.0, 0.0)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sampling profiler that can be switched on inside a running node.
+
+A background thread reads every thread's stack (sys._current_frames) RATE
+times a second and counts identical stacks; nothing is hooked into the
+profiled code, so timing stays as it is. The frame loop marks what it is
+doing with `stage('invoke')` and friends, and every sample carries the
+stage of its thread as a [stage] frame right under the thread name.
+
+Stopping writes <directory>/<name>-<time>.collapsed, one "frame;frame;... count"
+line per stack as flamegraph.pl and speedscope read it:
+
+    MainThread;[invoke];camera_node.py:main;Camera.py:execute_command;... 412
+
+A node switches the profiler on and off on SIGUSR2, or through a control
+port on localhost taking "start [rate] [seconds]", "stop" and "status":
+
+    python3 Profiler.py --port 65434 start --rate 200 --seconds 30
+"""
+
+import argparse
+import contextlib
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+# Stage of every thread that is in one, by thread ident
+_stages = {}
+
+
+def set_stage(name):
+    """Sets the stage of the calling thread, None leaves it. Returns the previous one."""
+    ident = threading.get_ident()
+    previous = _stages.get(ident)
+    if name is None:
+        _stages.pop(ident, None)
+    else:
+        _stages[ident] = name
+    return previous
+
+
+@contextlib.contextmanager
+def stage(name):
+    previous = set_stage(name)
+    try:
+        yield
+    finally:
+        set_stage(previous)
+
+
+class Profiler:
+    RATE = 100  # samples per second
+    DIRECTORY = 'profiles'
+
+    def __init__(self, name, directory=DIRECTORY, rate=RATE):
+        self.name = name
+        self.directory = directory
+        self.rate = rate
+        self.counts = {}
+        self.samples = 0
+        self.started = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.control = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, rate=None, seconds=None):
+        """Starts sampling, for `seconds` if given. Returns False when already running."""
+        with self.lock:
+            if self.running:
+                return False
+            self.rate = rate or self.rate
+            self.counts = {}
+            self.samples = 0
+            self.started = time.time()
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, args=(seconds,), name='profiler',
+                                           daemon=True)
+            self.thread.start()
+        print("Profiling %s at %g samples per second" % (self.name, self.rate))
+        return True
+
+    def stop(self):
+        """Stops sampling and writes the profile. Returns its path, None when not running."""
+        with self.lock:
+            if not self.running:
+                return None
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            return self.write()
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _run(self, seconds):
+        interval = 1.0 / self.rate
+        until = None if seconds is None else time.monotonic() + seconds
+        while not self.stopped.wait(interval):
+            self.sample()
+            if until is not None and time.monotonic() >= until:
+                # stop() joins this thread, so it has to run on another one
+                threading.Thread(target=self.stop, daemon=True).start()
+                break
+
+    def sample(self):
+        """Counts the current stack of every other thread."""
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            key = (names.get(ident, str(ident)), _stages.get(ident), tuple(codes))
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    @staticmethod
+    def _label(code):
+        return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+    def collapsed(self):
+        """The profile as collapsed stack lines, heaviest first."""
+        lines = []
+        for (thread, stage_name, codes), count in self.counts.items():
+            frames = [thread] + (['[%s]' % stage_name] if stage_name else [])
+            frames += [self._label(code) for code in reversed(codes)]
+            lines.append((count, ';'.join(frames).replace(' ', '_')))
+        lines.sort(reverse=True)
+        return ['%s %d' % (stack, count) for count, stack in lines]
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '%s-%s.collapsed'
+                            % (self.name, time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))))
+        with open(path, 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
+        print("Profile of %d samples written to %s" % (self.samples, path))
+        return path
+
+    def install_signal(self, signum=signal.SIGUSR2):
+        """Toggles the profiler on `signum`; call from the main thread."""
+        # Writing the profile in the handler could wait on a lock the
+        # interrupted main thread holds
+        signal.signal(signum, lambda *_: threading.Thread(target=self.toggle, daemon=True).start())
+
+    def serve(self, port, host='127.0.0.1'):
+        """Takes start/stop/status lines on a local control port."""
+        self.control = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.control.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.control.bind((host, port))
+        self.control.listen()
+        threading.Thread(target=self._serve, name='profiler-control', daemon=True).start()
+        return self.control.getsockname()[1]
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.control.accept()
+            except OSError:
+                break
+            with conn:
+                try:
+                    request = conn.recv(256).decode('utf-8', 'replace')
+                    conn.sendall((self.command(request) + '\n').encode('utf-8'))
+                except OSError as e:
+                    print("Profiler control connection lost:", e)
+
+    def command(self, request):
+        """Runs one control line and returns the reply."""
+        words = request.split()
+        action = words[0] if words else ''
+        try:
+            numbers = [float(word) for word in words[1:3]]
+        except ValueError:
+            return 'error: start takes a rate and a duration in seconds'
+        if action == 'start':
+            rate = numbers[0] if numbers else None
+            seconds = numbers[1] if len(numbers) > 1 else None
+            if rate is not None and not rate > 0:
+                return 'error: rate must be positive'
+            return 'started' if self.start(rate, seconds) else 'error: already running'
+        if action == 'stop':
+            path = self.stop()
+            return 'written %s' % path if path else 'error: not running'
+        if action == 'status':
+            return ('running, %d samples' % self.samples) if self.running else 'stopped'
+        return 'error: unknown command %r' % action
+
+    def close(self):
+        self.stop()
+        if self.control is not None:
+            self.control.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Controls the profiler of a running node')
+    parser.add_argument('action', choices=['start', 'stop', 'status'])
+    parser.add_argument('--port', type=int, required=True,
+                        help='65434 for the camera node, 65435 for the motor node')
+    parser.add_argument('--rate', type=float, default=Profiler.RATE, help='samples per second')
+    parser.add_argument('--seconds', type=float, help='stops by itself after this long')
+    args = parser.parse_args()
+
+    request = args.action
+    if args.action == 'start':
+        request += ' %g' % args.rate + (' %g' % args.seconds if args.seconds else '')
+    with socket.create_connection(('127.0.0.1', args.port), timeout=5) as conn:
+        conn.sendall(request.encode('utf-8'))
+        print(conn.recv(1024).decode('utf-8').strip())
+
+
+if __name__ == '__main__':
+    main()
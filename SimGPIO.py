@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Simulated RPi.GPIO for running AMSpi and Excavator off the Pi.
+
+SimGPIO implements the calls AMSpi makes and models the Arduino motor
+shield behind them: the 74HC595 shift register (data shifted in on a rising
+clock, put on the outputs on a rising latch) holding two direction bits per
+motor, and the L293D enable pins driven high or by PWM. `motor` decodes
+the result into the state each motor is actually driven with.
+
+`install` makes `import RPi.GPIO` return the simulation, and points an
+AMSpi module that was imported already at it.
+"""
+
+import sys
+import types
+
+
+class SimPWM:
+    def __init__(self, gpio, pin, frequency):
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+
+    def start(self, duty):
+        self.gpio.set_duty(self.pin, duty)
+
+    def ChangeDutyCycle(self, duty):
+        self.gpio.set_duty(self.pin, duty)
+
+    def stop(self):
+        self.gpio.set_duty(self.pin, None)
+
+
+class SimGPIO:
+    """The part of the RPi.GPIO interface AMSpi uses, wired to a model of the shield."""
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self):
+        self.listeners = []
+        self.wiring = None
+        self.reset()
+
+    def reset(self):
+        self.levels = {}
+        self.duties = {}
+        self.shift = 0
+        self.latched = 0
+
+    def wire(self, amspi):
+        """Reads shift register pins, enable pins and direction bits from an AMSpi."""
+        self.wiring = {
+            'latch': amspi._DIR_LATCH,
+            'clock': amspi._DIR_CLK,
+            'data': amspi._DIR_SER,
+            'motors': {motor: (settings[amspi._PIN_], settings[amspi._DIRECTION_][:2])
+                       for motor, settings in amspi._MOTORS.items()}
+        }
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode, initial=None):
+        if initial is not None:
+            self.levels[pin] = initial
+
+    def output(self, pin, value):
+        rising = value and not self.levels.get(pin, self.LOW)
+        self.levels[pin] = value
+        if self.wiring is None:
+            return
+        if pin == self.wiring['clock']:
+            # The 74HC595 shifts the data pin in on a rising clock...
+            if rising:
+                self.shift = ((self.shift << 1) | bool(self.levels.get(self.wiring['data']))) & 0xFF
+        elif pin == self.wiring['latch']:
+            # ...and puts the shifted byte on its outputs on a rising latch
+            if rising:
+                self.latched = self.shift
+                self._changed()
+        elif pin != self.wiring['data']:
+            self._changed()
+
+    def PWM(self, pin, frequency):
+        return SimPWM(self, pin, frequency)
+
+    def set_duty(self, pin, duty):
+        if duty is None:
+            self.duties.pop(pin, None)
+        else:
+            self.duties[pin] = duty
+        self._changed()
+
+    def cleanup(self):
+        self.reset()
+        self._changed()
+
+    def _changed(self):
+        for listener in self.listeners:
+            listener()
+
+    def motor(self, motor):
+        """(running, clockwise, duty) of a motor as the shield drives it."""
+        pin, (clockwise_bit, counter_bit) = self.wiring['motors'][motor]
+        clockwise = bool(self.latched & clockwise_bit)
+        counter = bool(self.latched & counter_bit)
+        if pin in self.duties:
+            duty = self.duties[pin]
+        else:
+            duty = 100 if self.levels.get(pin) else 0
+        # Both bits set brakes the motor, none releases it
+        return duty > 0 and clockwise != counter, clockwise, duty
+
+    def install(self):
+        """Makes `import RPi.GPIO` return this object, also for an AMSpi imported already."""
+        package = types.ModuleType('RPi')
+        package.GPIO = self
+        sys.modules['RPi'] = package
+        sys.modules['RPi.GPIO'] = self
+        if 'AMSpi' in sys.modules:
+            sys.modules['AMSpi'].GPIO = self
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Closed-loop simulator running the whole excavator stack faster than real time.
+
+The real code runs unchanged from camera_node.find_object down to the GPIO
+writes; only the edges of the system are simulated:
+
+* SimGPIO         - stands in for RPi.GPIO under AMSpi (see SimGPIO.py) and
+                    decodes the shift register and enable pin writes into
+                    the state of every motor
+* VirtualClock    - replaces time.monotonic, time.time and time.sleep. Time
+                    only moves when the code sleeps, in small steps that
+                    drive the world and the motor watchdog
+* World           - ground truth: chassis, body and shovel integrated from
+                    the decoded motor states with per-run rate errors, the
+                    target on the ground and the grab check
+* SyntheticCamera - picamera stand-in rendering the target at its projected
+                    size and position, one frame per framerate period
+* Simulator       - wires one scenario together: Excavator, Watchdog and
+                    motor_node's command handler, camera_node's find_object
+                    and Explorer, and a Camera fed by the synthetic camera
+
+Detection defaults to an oracle working from the projected box, with misses,
+jitter, blur while moving and an inference latency charged to the virtual
+clock, so hundreds of scenarios run in seconds. With `real_models` the
+TFLite models run on the rendered frames instead, and the wall time each
+frame takes on this machine is charged to the virtual clock. See
+simulate.py for batch runs.
+"""
+
+import math
+import random
+import time
+
+import numpy as np
+
+from PIL import Image
+
+from SimGPIO import SimGPIO
+
+# AMSpi binds RPi.GPIO when imported, so the simulated one goes in first
+GPIO = SimGPIO()
+GPIO.install()
+
+import camera_node  # noqa: E402
+from Camera import Camera  # noqa: E402
+from Excavator import Excavator  # noqa: E402
+from Explorer import Explorer  # noqa: E402
+from Planner import CAMERA_FOV, MotionPlanner  # noqa: E402
+from PoseEstimator import PoseEstimator  # noqa: E402
+from Telemetry import decode, encode  # noqa: E402
+from Watchdog import Watchdog  # noqa: E402
+from motor_node import MotorNode, build_instructions  # noqa: E402
+
+
+class VirtualClock:
+    STEP = 0.01  # seconds between two world and watchdog updates
+    EPOCH = 1.6e9  # what time.time() reads at virtual time 0
+
+    def __init__(self, step=STEP):
+        self.now = 0.0
+        self.step = step
+        # Called with the new time after every step
+        self.listeners = []
+        self.saved = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.uninstall()
+
+    def install(self):
+        self.saved = (time.monotonic, time.time, time.sleep)
+        time.monotonic, time.time, time.sleep = self.monotonic, self.time, self.sleep
+
+    def uninstall(self):
+        if self.saved is not None:
+            time.monotonic, time.time, time.sleep = self.saved
+            self.saved = None
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.EPOCH + self.now
+
+    def sleep(self, seconds, until=None):
+        """Advances time by `seconds`, stopping early once `until()` is true."""
+        end = self.now + max(0.0, seconds)
+        while end - self.now > 1e-9:
+            if until is not None and until():
+                return
+            self.now = min(end, self.now + self.step)
+            for listener in self.listeners:
+                listener(self.now)
+
+
+class SimEvent:
+    """threading.Event whose wait() passes virtual time, for Excavator.run_plan."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.flag = False
+
+    def set(self):
+        self.flag = True
+
+    def clear(self):
+        self.flag = False
+
+    def is_set(self):
+        return self.flag
+
+    def wait(self, timeout=None):
+        if not self.flag and timeout:
+            self.clock.sleep(timeout, until=self.is_set)
+        return self.flag
+
+
+class World:
+    TARGET_WIDTH = 55.0  # mm, the object Camera.detect_sizes is calibrated for
+    TARGET_HEIGHT = 80.0
+    CAMERA_HEIGHT = 60.0  # mm above the ground
+    NEAR = 50.0  # mm, anything closer to the lens is not seen
+    DIG_ANGLE = -20.0  # shovel angle at which a dig counts
+    TOLERANCE = 40.0  # mm between shovel tip and target for a successful grab
+
+    def __init__(self, target, clock, gpio, rng, rate_error=0.05):
+        self.target = target
+        self.clock = clock
+        self.gpio = gpio
+        # The real rates differ from the calibration the estimator assumes
+        self.truth = PoseEstimator(Excavator.LEFT_CHAIN_MOTOR, Excavator.RIGHT_CHAIN_MOTOR,
+                                   Excavator.BODY_MOTOR, Excavator.SHOVEL_MOTOR,
+                                   clock=clock.monotonic)
+        for motor in Excavator.ALL_MOTORS:
+            name = self.truth.names[motor]
+            self.truth.calibrate(motor, self.truth.rates[name] * max(0.5, rng.gauss(1.0, rate_error)))
+        self.driven = dict.fromkeys(Excavator.ALL_MOTORS, None)
+        self.grabbed_at = None
+        self.attempts = 0
+        self.errors = []
+        self.digging = False
+
+    def sync(self):
+        """Follows the motor states decoded from the GPIO writes."""
+        now = self.clock.monotonic()
+        for motor in Excavator.ALL_MOTORS:
+            running, clockwise, duty = self.gpio.motor(motor)
+            state = (clockwise, duty) if running else None
+            if state == self.driven[motor]:
+                continue
+            if state is None:
+                self.truth.stop(motor, now)
+            else:
+                self.truth.start(motor, clockwise, duty, now)
+            self.driven[motor] = state
+
+    def pose(self, now=None):
+        return self.truth.predict(now)
+
+    def moving(self):
+        velocity = self.truth.velocity
+        return bool(velocity['left_chain'] or velocity['right_chain'] or velocity['body'])
+
+    def tip_error(self, pose):
+        """Distance (mm) between the shovel tip on the ground and the target."""
+        direction = math.radians(pose.heading + pose.body_angle)
+        tip_x = pose.x + MotionPlanner.REACH * math.cos(direction)
+        tip_y = pose.y + MotionPlanner.REACH * math.sin(direction)
+        return math.hypot(self.target[0] - tip_x, self.target[1] - tip_y)
+
+    def step(self, now):
+        """Counts a dig each time the shovel goes down past DIG_ANGLE."""
+        pose = self.truth.predict(now)
+        if pose.shovel_angle > 0:
+            self.digging = False
+        elif not self.digging and pose.shovel_angle <= self.DIG_ANGLE \
+                and self.truth.velocity['shovel'] < 0:
+            self.digging = True
+            self.attempts += 1
+            error = self.tip_error(pose)
+            self.errors.append(error)
+            if error <= self.TOLERANCE and self.grabbed_at is None:
+                self.grabbed_at = now
+
+    def view(self, width, height, fov=CAMERA_FOV):
+        """
+        Pixel box (left, top, right, bottom) of the target in a width x height
+        frame and its distance along the optical axis, or None behind the lens.
+        """
+        pose = self.pose()
+        direction = math.radians(pose.heading + pose.body_angle)
+        dx, dy = self.target[0] - pose.x, self.target[1] - pose.y
+        # Camera frame: forward along the view, left positive
+        forward = dx * math.cos(direction) + dy * math.sin(direction)
+        left = -dx * math.sin(direction) + dy * math.cos(direction)
+        if forward < self.NEAR:
+            return None
+        focal = width / 2 / math.tan(math.radians(fov) / 2)
+        center = width / 2 - focal * left / forward
+        half_width = focal * self.TARGET_WIDTH / forward / 2
+        bottom = height / 2 + focal * self.CAMERA_HEIGHT / forward
+        top = bottom - focal * self.TARGET_HEIGHT / forward
+        return (center - half_width, top, center + half_width, bottom), forward
+
+
+class SyntheticCamera:
+    """
+    picamera.PiCamera stand-in. `capture_continuous` renders a frame every
+    framerate period of virtual time until `finished()` says the run is over,
+    calling `on_frame` before each. With `charge_processing` the wall time
+    spent on a frame passes on the virtual clock as well.
+    """
+    SKY = (150, 160, 170)
+    GROUND = (90, 80, 60)
+    TARGET = (230, 120, 20)
+
+    def __init__(self, world, clock, on_frame=None, finished=None, sprite=None,
+                 charge_processing=False):
+        self.world = world
+        self.clock = clock
+        self.on_frame = on_frame
+        self.finished = finished or (lambda: False)
+        self.sprite = sprite
+        self.charge_processing = charge_processing
+        self.resolution = (640, 480)
+        self.framerate = 30
+        # Settled exposure, gain and white balance (see Camera.wait_sensor_ready)
+        self.exposure_speed = 20000
+        self.analog_gain = 1.0
+        self.digital_gain = 1.0
+        self.awb_gains = (1.5, 1.2)
+        # No display, so Camera draws no overlays
+        self.preview = None
+        self.background = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def render(self, width, height):
+        if self.background is None or self.background.shape[:2] != (height, width):
+            self.background = np.empty((height, width, 3), np.uint8)
+            self.background[:height // 2] = self.SKY
+            self.background[height // 2:] = self.GROUND
+            self.frame = np.empty_like(self.background)
+        np.copyto(self.frame, self.background)
+        view = self.world.view(width, height)
+        if view is not None:
+            left, top, right, bottom = (int(round(v)) for v in view[0])
+            x0, y0 = max(left, 0), max(top, 0)
+            x1, y1 = min(right, width), min(bottom, height)
+            if x1 > x0 and y1 > y0:
+                if self.sprite is None:
+                    self.frame[y0:y1, x0:x1] = self.TARGET
+                else:
+                    sprite = np.asarray(self.sprite.resize((right - left, bottom - top)))
+                    self.frame[y0:y1, x0:x1] = sprite[y0 - top:y1 - top, x0 - left:x1 - left]
+        return self.frame
+
+    def capture_continuous(self, output, format='rgb', use_video_port=True):
+        width, height = self.resolution
+        next_frame = self.clock.monotonic()
+        while not self.finished():
+            self.clock.sleep(next_frame - self.clock.monotonic())
+            next_frame = max(next_frame + 1.0 / self.framerate, self.clock.monotonic())
+            if self.on_frame is not None:
+                self.on_frame()
+            # picamera hands over raw bytes
+            output.write(self.render(width, height).reshape(-1))
+            started = time.perf_counter()
+            yield output
+            if self.charge_processing:
+                self.clock.sleep(time.perf_counter() - started)
+
+
+class OracleDetector:
+    """Detections straight from the projected target box, as a Camera 'detector'."""
+    MIN_PIXELS = 8  # smaller boxes are never found
+    JITTER = 2.0  # pixels of box noise
+    BLUR_MISS = 0.3  # extra miss rate while the chains or body move
+
+    def __init__(self, world, clock, rng, latency=0.12, miss_rate=0.1):
+        self.world = world
+        self.clock = clock
+        self.rng = rng
+        self.latency = latency
+        self.miss_rate = miss_rate
+
+    def __call__(self, frame, threshold):
+        height, width = frame.shape[:2]
+        # The frame was taken before the inference time passes
+        view = self.world.view(width, height)
+        moving = self.world.moving()
+        self.clock.sleep(self.latency)
+        if view is None:
+            return []
+        box = np.array(view[0], np.float32) + \
+            np.array([self.rng.gauss(0, self.JITTER) for _ in range(4)], np.float32)
+        left, top, right, bottom = box
+        side = min(right - left, bottom - top)
+        visible = (min(right, width) - max(left, 0)) * (min(bottom, height) - max(top, 0))
+        if side < self.MIN_PIXELS or visible < (right - left) * (bottom - top) / 2:
+            return []
+        if self.rng.random() < self.miss_rate + (self.BLUR_MISS if moving else 0.0):
+            return []
+        score = min(0.95, 0.45 + side / 80) * (0.8 if moving else 1.0) + self.rng.gauss(0, 0.05)
+        if score < threshold:
+            return []
+        relative = np.clip([top / height, left / width, bottom / height, right / width], 0, 1)
+        return [{'bounding_box': relative.astype(np.float32), 'class_id': 0, 'score': float(score)}]
+
+
+class SimLink:
+    """Socket for CameraNode.send_command, handing messages to motor_node in process."""
+
+    def __init__(self, node, instructions, watchdog, addr=('simulator', 0)):
+        self.node = node
+        self.instructions = instructions
+        self.watchdog = watchdog
+        self.addr = addr
+        self.reply = b''
+        self.commands = 0
+
+    def sendall(self, data):
+        self.commands += 1
+        self.reply = self.node.handle(data, self.addr, self.instructions, self.watchdog)
+
+    def recv(self, size):
+        return self.reply
+
+    def close(self):
+        self.watchdog.release(self.addr)
+
+
+class Simulator:
+    def __init__(self, models=None, timeout=120.0, latency=0.12, miss_rate=0.1,
+                 rate_error=0.05, real_models=False, sprite=None):
+        """
+        `models` is a camera_node style model list, camera_node.tl_models by
+        default. Each run ends at a grab or after `timeout` virtual seconds.
+        """
+        self.models = models if models is not None else camera_node.tl_models
+        self.timeout = timeout
+        self.latency = latency
+        self.miss_rate = miss_rate
+        self.rate_error = rate_error
+        self.real_models = real_models
+        self.sprite = Image.open(sprite).convert('RGB') if sprite else None
+
+    def camera_models(self, world, clock, rng):
+        """The model list with trackers on the virtual clock and oracle detectors."""
+        models = []
+        for model in self.models:
+            model = dict(model)
+            model['tracking'] = dict(model.get('tracking') or {}, clock=clock.monotonic) \
+                if model.get('tracking', True) is not False else False
+            if not self.real_models:
+                # The oracle sees small targets without tiles
+                for key in ('model', 'model_path', 'label_path', 'light_model', 'tiling'):
+                    model.pop(key, None)
+                model['detector'] = OracleDetector(world, clock, rng, self.latency, self.miss_rate)
+                model['labels'] = {0: model['name']}
+            models.append(model)
+        return models
+
+    def run(self, seed, distance, bearing):
+        """
+        Runs one scenario with the target `distance` mm away at `bearing`
+        degrees (left is positive). Returns a dict of its outcome.
+        """
+        rng = random.Random(seed)
+        clock = VirtualClock()
+        angle = math.radians(bearing)
+        target = (distance * math.cos(angle), distance * math.sin(angle))
+        wall_start = time.perf_counter()
+        with clock:
+            GPIO.reset()
+            excavator = Excavator()
+            GPIO.wire(excavator.motors)
+            # Bound to the real clock when the estimator was built
+            excavator.pose.clock = clock.monotonic
+            excavator.pose.stamp = clock.monotonic()
+            excavator._abort = SimEvent(clock)
+            world = World(target, clock, GPIO, rng, self.rate_error)
+            GPIO.listeners = [world.sync]
+            watchdog = Watchdog(excavator)
+            clock.listeners = [world.step, watchdog.check]
+
+            link = SimLink(MotorNode(listen=False), build_instructions(excavator), watchdog)
+            camera_node.cnode.socket = link
+            camera_node.telemetry.state = None
+            camera_node.locked_track = None
+            camera_node.explorer = Explorer(clock=clock.monotonic)
+
+            frames = [0]
+
+            def on_frame():
+                frames[0] += 1
+                camera_node.telemetry.state = decode(encode(frames[0], excavator))
+
+            deadline = [math.inf]
+            synthetic = SyntheticCamera(
+                world, clock, on_frame, sprite=self.sprite, charge_processing=self.real_models,
+                finished=lambda: world.grabbed_at is not None or clock.monotonic() >= deadline[0])
+            camera = Camera(self.camera_models(world, clock, rng), exportLog=False, camera=synthetic)
+            start = clock.monotonic()
+            deadline[0] = start + self.timeout
+            try:
+                camera.execute_command()
+            finally:
+                excavator.emergency_stop()
+                camera.swap_loader.shutdown(wait=False)
+            end = clock.monotonic()
+        pose = world.pose(end)
+        return {
+            'seed': seed,
+            'distance': distance,
+            'bearing': bearing,
+            'grabbed': world.grabbed_at is not None,
+            'time_to_grab': world.grabbed_at - start if world.grabbed_at is not None else None,
+            'attempts': world.attempts,
+            'best_error': min(world.errors) if world.errors else None,
+            'final_error': world.tip_error(pose),
+            'frames': frames[0],
+            'commands': link.commands,
+            'sim_seconds': end - start,
+            'wall_seconds': time.perf_counter() - wall_start
+        }
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Motor state telemetry streamed from motor_node to the vision loop.
+
+Every packet is a fixed-size little endian record:
+
+    magic(2s) seq(I) timestamp(d) [flags(B) duty(B)] x 4 motors body(f) shovel(f)
+
+flags bit 0 is "running" and bit 1 is "clockwise". Motors are listed in
+MOTOR_NAMES order, which follows the AMSpi motor numbering used by Excavator.
+"""
+
+import struct
+import threading
+import time
+
+from Transport import Listener, connect
+
+MAGIC = b'EX'
+MOTOR_NAMES = ('left_chain', 'right_chain', 'body', 'shovel')
+PACKET = struct.Struct('<2sId' + 'BB' * len(MOTOR_NAMES) + 'ff')
+
+_RUNNING = 1
+_CLOCKWISE = 2
+
+
+def encode(seq, excavator):
+    """Packs the current excavator state into a telemetry packet."""
+    # Motor flags and angles of one moment, not torn by a command in between
+    states, pose = excavator.snapshot()
+    fields = []
+    for motor in excavator.ALL_MOTORS:
+        state = states[motor]
+        flags = (_RUNNING if state['running'] else 0) | \
+            (_CLOCKWISE if state['clockwise'] else 0)
+        fields += [flags, int(state['speed'] or 0)]
+    return PACKET.pack(MAGIC, seq & 0xFFFFFFFF, time.time(), *fields,
+                       pose.body_angle, pose.shovel_angle)
+
+
+def decode(packet):
+    """Unpacks a telemetry packet into a dictionary."""
+    values = PACKET.unpack(packet)
+    if values[0] != MAGIC:
+        raise ValueError("Not a telemetry packet")
+    motors = {}
+    for i, name in enumerate(MOTOR_NAMES):
+        flags, duty = values[3 + 2 * i], values[4 + 2 * i]
+        motors[name] = {
+            'running': bool(flags & _RUNNING),
+            'clockwise': bool(flags & _CLOCKWISE),
+            'speed': duty
+        }
+    return {
+        'seq': values[1],
+        'timestamp': values[2],
+        'motors': motors,
+        'body_angle': values[-2],
+        'shovel_angle': values[-1]
+    }
+
+
+class TelemetryPublisher:
+    """Streams excavator state at a fixed rate to every subscribed client."""
+
+    def __init__(self, excavator, host, port, rate=20):
+        self.excavator = excavator
+        self.period = 1.0 / rate
+        self.listener = Listener(host, port)
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self.running = True
+        for target in (self._accept_loop, self._publish_loop):
+            threading.Thread(target=target, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.listener.close()
+        with self.lock:
+            for conn in self.subscribers:
+                conn.close()
+            self.subscribers = []
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, addr = self.listener.accept()
+            except ValueError:
+                # Listener closed by stop()
+                break
+            except OSError as e:
+                if self.running:
+                    print("Telemetry accept failed:", e)
+                continue
+            # A subscriber that stops reading must not stall the others
+            conn.settimeout(self.period)
+            print("Telemetry subscriber connected", addr)
+            with self.lock:
+                self.subscribers.append(conn)
+
+    def _publish_loop(self):
+        seq = 0
+        next_time = time.monotonic()
+        while self.running:
+            packet = encode(seq, self.excavator)
+            with self.lock:
+                for conn in list(self.subscribers):
+                    try:
+                        conn.sendall(packet)
+                    except OSError:
+                        conn.close()
+                        self.subscribers.remove(conn)
+            seq += 1
+            next_time += self.period
+            time.sleep(max(0, next_time - time.monotonic()))
+
+
+class TelemetrySubscriber:
+    """Keeps the latest telemetry packet received from the motor node."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.state = None
+        self.conn = None
+
+    def start(self):
+        try:
+            self.conn = connect(self.host, self.port)
+        except OSError as e:
+            print("Telemetry is not available:", e)
+            return False
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        return True
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+    def _read_loop(self):
+        buffer = b''
+        while True:
+            try:
+                data = self.conn.recv(4096)
+            except (OSError, ValueError):
+                break
+            if not data:
+                break
+            buffer += data
+            # TCP may split or merge packets; only the newest whole one matters
+            count = len(buffer) // PACKET.size
+            if count:
+                last = buffer[(count - 1) * PACKET.size:count * PACKET.size]
+                buffer = buffer[count * PACKET.size:]
+                try:
+                    self.state = decode(last)
+                except ValueError:
+                    buffer = b''
+        self.state = None
+
+    def is_running(self, name, clockwise=None):
+        """True if the named motor is running (in the given direction, if any)."""
+        if self.state is None:
+            return False
+        motor = self.state['motors'][name]
+        if clockwise is not None and motor['clockwise'] != clockwise:
+            return False
+        return motor['running']
+
+    def chains_moving(self):
+        return self.is_running('left_chain') or self.is_running('right_chain')
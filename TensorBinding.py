@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cached input/output bindings for a TFLite detection interpreter.
+
+`get_input_details()`/`get_output_details()` build fresh dictionaries on
+every call, so they are resolved once per interpreter here: tensor indices,
+dtypes, shapes and quantization parameters, plus the `interpreter.tensor()`
+accessors used to reach the tensor memory without copies.
+
+TFLite refuses to `invoke` while numpy views of its buffers are alive, so
+views are only taken inside these methods and never handed out past the
+next invoke: `detections` returns fresh arrays holding the kept rows only,
+`detections_into` copies them into preallocated buffers instead.
+
+Bindings are cached per interpreter but only hold a weak proxy to it, so
+a released interpreter (a swapped out model) is freed with its arena and
+its binding goes with it.
+"""
+
+import weakref
+
+import numpy as np
+
+_bindings = weakref.WeakKeyDictionary()
+
+
+class TensorBinding:
+    def __init__(self, interpreter, mean=127.5, std=127.5):
+        """`mean`/`std` normalise pixels for float models."""
+        # A strong reference would keep the cache key, and so the
+        # interpreter, alive for good
+        self.interpreter = weakref.proxy(interpreter)
+        detail = interpreter.get_input_details()[0]
+        self.input_index = detail['index']
+        self.input_dtype = detail['dtype']
+        _, self.height, self.width, _ = detail['shape']
+        self.input_scale, self.input_zero_point = detail['quantization']
+        self.mean = mean
+        self.std = std
+
+        self.output_indices = []
+        self.output_quantization = []
+        for detail in interpreter.get_output_details():
+            self.output_indices.append(detail['index'])
+            scale, zero_point = detail['quantization']
+            # Only integer outputs need dequantizing, float ones report scale 0
+            quantized = scale != 0 and np.issubdtype(detail['dtype'], np.integer)
+            self.output_quantization.append((scale, zero_point) if quantized else None)
+
+    @classmethod
+    def of(cls, interpreter):
+        """Returns the binding of an interpreter, creating it on first use."""
+        binding = _bindings.get(interpreter)
+        if binding is None:
+            binding = _bindings[interpreter] = cls(interpreter)
+        return binding
+
+    @classmethod
+    def drop(cls, interpreter):
+        """Forgets the binding of an interpreter that is being released."""
+        _bindings.pop(interpreter, None)
+
+    @property
+    def size(self):
+        """(width, height) expected by PIL's resize."""
+        return self.width, self.height
+
+    def set_input(self, image):
+        """Writes an RGB PIL image or HxWx3 uint8 array into the input tensor."""
+        pixels = np.asarray(image)
+        # interpreter.tensor() closures hold the interpreter, so they are
+        # made per call instead of kept
+        view = self.interpreter.tensor(self.input_index)()[0]
+        if self.input_dtype == np.uint8:
+            # Quantized models take raw pixels as they are
+            view[...] = pixels
+        elif self.input_dtype == np.int8:
+            np.subtract(pixels, 128, out=view, casting='unsafe')
+        else:
+            np.subtract(pixels, self.mean, out=view, casting='unsafe')
+            view *= 1.0 / self.std
+        del view
+
+    def invoke(self):
+        self.interpreter.invoke()
+
+    def output(self, index):
+        """Output tensor `index` with the batch axis dropped, dequantized if needed."""
+        tensor = self.interpreter.tensor(self.output_indices[index])()[0]
+        quantization = self.output_quantization[index]
+        if quantization is not None:
+            scale, zero_point = quantization
+            return (tensor.astype(np.float32) - zero_point) * scale
+        return tensor
+
+    def detections(self, threshold):
+        """
+        Runs the usual SSD post-process outputs (boxes, classes, scores, count)
+        through a vectorized threshold. Returns new (boxes, classes, scores)
+        arrays that do not reference interpreter memory.
+        """
+        count = int(self.output(3))
+        scores = self.output(2)[:count]
+        keep = np.flatnonzero(scores >= threshold)
+        return self.output(0)[keep], self.output(1)[keep], scores[keep]
+
+    def detections_into(self, buffers, threshold):
+        """
+        Same as `detections` but written into a BufferPool.DetectionBuffers,
+        so no new arrays are made. Returns its result dicts for this frame.
+        """
+        count = min(int(self.output(3)), len(buffers.scores))
+        keep = np.flatnonzero(self.output(2)[:count] >= threshold)
+        kept = len(keep)
+        np.take(self.output(0), keep, axis=0, out=buffers.boxes[:kept], mode='clip')
+        np.take(self.output(1), keep, out=buffers.classes[:kept], mode='clip')
+        np.take(self.output(2), keep, out=buffers.scores[:kept], mode='clip')
+        return buffers.fill(kept)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tiled detection helpers for small, distant objects.
+
+A high resolution frame is split into an overlapping grid of tiles, each
+tile is run through the detector at the model's input size and the boxes
+are mapped back to relative coordinates of the whole frame, where the
+duplicates found by neighbouring tiles are removed with non-maximum
+suppression. Boxes are [ymin, xmin, ymax, xmax] like the model outputs.
+"""
+
+import numpy as np
+
+DEFAULT_TILING = {
+    'grid': (2, 2),      # columns, rows
+    'overlap': 0.2,      # fraction of a tile shared with its neighbour
+    'full_frame': True,  # also run the whole frame, for objects bigger than a tile
+    'iou': 0.5,          # NMS threshold when merging tiles
+    'min_box': 0.15,     # target side (relative) big enough for the normal pass
+    'patience': 3        # frames without the target before tiling turns on
+}
+
+
+def tiling_config(config):
+    """Fills a per-model 'tiling' entry with the defaults."""
+    merged = dict(DEFAULT_TILING)
+    merged.update(config)
+    return merged
+
+
+def tile_boxes(width, height, grid, overlap):
+    """Pixel crop boxes (left, top, right, bottom) covering the frame."""
+    cols, rows = grid
+    tile_w = width / (cols - (cols - 1) * overlap)
+    tile_h = height / (rows - (rows - 1) * overlap)
+    step_x = tile_w * (1 - overlap)
+    step_y = tile_h * (1 - overlap)
+    boxes = []
+    for row in range(rows):
+        for col in range(cols):
+            left = int(round(col * step_x))
+            top = int(round(row * step_y))
+            boxes.append((left, top, min(width, int(round(left + tile_w))),
+                          min(height, int(round(top + tile_h)))))
+    return boxes
+
+
+def to_frame(boxes, tile, width, height):
+    """Maps tile relative boxes (..., 4) to frame relative boxes."""
+    left, top, right, bottom = tile
+    scale = np.array([bottom - top, right - left] * 2, np.float32)
+    offset = np.array([top, left] * 2, np.float32)
+    frame = (boxes * scale + offset) / np.array([height, width] * 2, np.float32)
+    return np.clip(frame, 0, 1)
+
+
+def iou_matrix(a, b):
+    """IoU between every box of a (N, 4) and b (M, 4)."""
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def nms(boxes, scores, classes, iou_threshold):
+    """
+    Class aware non-maximum suppression. The IoU matrix is computed once;
+    a box is kept when no higher scoring kept box of its class overlaps it.
+    Returns the kept indices, best score first.
+    """
+    order = np.argsort(-scores)
+    boxes, classes = boxes[order], classes[order]
+    overlaps = iou_matrix(boxes, boxes) >= iou_threshold
+    overlaps &= classes[:, None] == classes[None, :]
+    # Only higher scoring boxes may suppress
+    overlaps = np.triu(overlaps, k=1)
+    keep = np.ones(len(order), bool)
+    for i in range(len(order)):
+        if keep[i]:
+            keep[i + 1:] &= ~overlaps[i, i + 1:]
+    return order[keep]
+
+
+def merge_tiles(batch, tiles, width, height, iou_threshold):
+    """
+    Merges batched tile detections (boxes, classes, scores, counts) into one
+    detect_objects style result list in frame relative coordinates.
+    """
+    boxes, classes, scores, counts = batch
+    valid = np.arange(boxes.shape[1])[None, :] < counts[:, None]
+    frame_boxes = np.concatenate([to_frame(boxes[i], tile, width, height)
+                                  for i, tile in enumerate(tiles)])[valid.ravel()]
+    classes = classes[valid]
+    scores = scores[valid]
+    keep = nms(frame_boxes, scores, classes, iou_threshold)
+    return [{'bounding_box': frame_boxes[i], 'class_id': classes[i], 'score': scores[i]}
+            for i in keep]
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-target tracking between the detector and the control callbacks.
+
+Every frame the detections are associated with the existing tracks by
+IoU against the tracks' predicted boxes, using an optimal (Hungarian)
+assignment of the class-aware cost matrix. Matched tracks smooth their box
+with an exponential filter and keep a velocity estimate in relative frame
+units per second; unmatched detections start new tracks and tracks missing
+for `max_misses` frames are dropped. Track IDs are never reused.
+"""
+
+import itertools
+import time
+
+import numpy as np
+
+from Tiling import iou_matrix
+
+# Cost of an impossible pair (other class or no overlap), kept finite so
+# the assignment stays well defined
+_NO_MATCH = 1e6
+
+
+def linear_sum_assignment(cost):
+    """
+    Minimum cost assignment of a (N, M) matrix, same result as SciPy's
+    linear_sum_assignment (which is not available on the Pi image). Shortest
+    augmenting path Hungarian method with the column scans vectorized,
+    O(min(N, M)^2 * max(N, M)). Returns (rows, cols) index arrays.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return np.zeros(0, int), np.zeros(0, int)
+
+    # 1-based potentials and column owners, column 0 is the virtual start
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    owner = np.zeros(m + 1, int)
+    way = np.zeros(m + 1, int)
+    for row in range(1, n + 1):
+        owner[0] = row
+        column = 0
+        min_reduced = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, bool)
+        while True:
+            used[column] = True
+            current = owner[column]
+            free = ~used
+            free[0] = False
+            reduced = cost[current - 1] - u[current] - v[1:]
+            better = free[1:] & (reduced < min_reduced[1:])
+            min_reduced[1:][better] = reduced[better]
+            way[1:][better] = column
+            candidates = np.where(free, min_reduced, np.inf)
+            next_column = int(np.argmin(candidates))
+            delta = candidates[next_column]
+            u[owner[used]] += delta
+            v[used] -= delta
+            min_reduced[free] -= delta
+            column = next_column
+            if owner[column] == 0:
+                break
+        # Flip the augmenting path
+        while column:
+            previous = way[column]
+            owner[column] = owner[previous]
+            column = previous
+
+    cols = np.flatnonzero(owner[1:])
+    rows = owner[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+class Track:
+    def __init__(self, track_id, result, now):
+        self.id = track_id
+        self.class_id = result['class_id']
+        self.box = np.array(result['bounding_box'], np.float32)
+        self.velocity = np.zeros(4, np.float32)
+        self.score = float(result['score'])
+        self.hits = 1
+        self.misses = 0
+        self.last_seen = now
+
+    def predict(self, now):
+        return self.box + self.velocity * (now - self.last_seen)
+
+    def result(self):
+        """detect_objects style result with the track fields added."""
+        return {
+            'bounding_box': self.box.copy(),
+            'class_id': self.class_id,
+            'score': self.score,
+            'track_id': self.id,
+            'velocity': self.velocity.copy(),
+            'hits': self.hits
+        }
+
+
+class Tracker:
+    def __init__(self, iou_threshold=0.3, alpha=0.6, beta=0.4, max_misses=5, min_hits=1,
+                 clock=time.monotonic):
+        """
+        `alpha` weighs the new box against the prediction, `beta` the new
+        velocity against the previous one. Tracks are reported once they
+        were seen `min_hits` times and only on frames they are matched. The
+        default reports a new track on first sight: find_object explores
+        whenever it gets nothing, which turns an unconfirmed target out of view.
+        """
+        self.iou_threshold = iou_threshold
+        self.alpha = alpha
+        self.beta = beta
+        self.max_misses = max_misses
+        self.min_hits = min_hits
+        self.clock = clock
+        self.tracks = []
+        self._ids = itertools.count(1)
+
+    def update(self, results, now=None):
+        """Associates one frame of detections. Returns the matched tracks' results."""
+        now = self.clock() if now is None else now
+        matched_tracks = set()
+        matched_results = set()
+
+        if self.tracks and results:
+            predicted = np.array([track.predict(now) for track in self.tracks], np.float32)
+            boxes = np.array([result['bounding_box'] for result in results], np.float32)
+            track_classes = np.array([track.class_id for track in self.tracks])
+            result_classes = np.array([result['class_id'] for result in results])
+            ious = iou_matrix(predicted, boxes)
+            ious[track_classes[:, None] != result_classes[None, :]] = 0
+            cost = np.where(ious >= self.iou_threshold, 1 - ious, _NO_MATCH)
+            # Only tracks and detections with a possible partner take part
+            track_rows = np.flatnonzero((cost < _NO_MATCH).any(axis=1))
+            result_cols = np.flatnonzero((cost < _NO_MATCH).any(axis=0))
+            rows, cols = linear_sum_assignment(cost[np.ix_(track_rows, result_cols)])
+            for t, r in zip(track_rows[rows], result_cols[cols]):
+                if cost[t, r] < _NO_MATCH:
+                    self._correct(self.tracks[t], results[r], predicted[t], now)
+                    matched_tracks.add(int(t))
+                    matched_results.add(int(r))
+
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+        for r, result in enumerate(results):
+            if r not in matched_results:
+                self.tracks.append(Track(next(self._ids), result, now))
+
+        return [track.result() for track in self.tracks
+                if track.misses == 0 and track.hits >= self.min_hits]
+
+    def _correct(self, track, result, predicted, now):
+        measured = np.asarray(result['bounding_box'], np.float32)
+        box = self.alpha * measured + (1 - self.alpha) * predicted
+        dt = now - track.last_seen
+        if dt > 0:
+            velocity = (box - track.box) / dt
+            track.velocity = self.beta * velocity + (1 - self.beta) * track.velocity
+        track.box = box
+        track.score = float(result['score'])
+        track.hits += 1
+        track.misses = 0
+        track.last_seen = now
+
+    def get(self, track_id):
+        return next((track for track in self.tracks if track.id == track_id), None)
+
+    def reset(self):
+        self.tracks = []
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Transports between camera_node and motor_node.
+
+Both nodes normally run on the same Pi, so besides plain TCP the motor node
+also offers a shared-memory transport: two single-producer single-consumer
+ring buffers (one per direction) living in `multiprocessing.shared_memory`,
+with an eventfd per ring used as a wakeup. A unix socket is only used for the
+handshake (passing the ring names and the eventfds) and to notice when the
+peer goes away.
+
+`Listener` and `connect` hide which transport is in use: connections expose
+the same `recv`/`sendall`/`settimeout`/`close` calls as a socket, so node code
+does not need to care. When the peer is remote, the unix socket is missing or
+the platform lacks eventfd support, plain TCP is used.
+
+The unix socket lives in a directory only the user running the nodes can
+enter ($XDG_RUNTIME_DIR, else a 0700 folder in /tmp), so no other local
+user can plant or replace it; both nodes must run as the same user to use
+shared memory.
+"""
+
+import json
+import os
+import select
+import socket
+import stat
+import struct
+import time
+
+from multiprocessing import resource_tracker, shared_memory
+
+LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+# Seconds a client may take to map the rings; accept waits for it
+HANDSHAKE_TIMEOUT = 0.5
+
+SHM_SUPPORTED = (hasattr(os, 'eventfd') and hasattr(socket, 'AF_UNIX')
+                 and hasattr(socket, 'send_fds'))
+
+
+def runtime_dir():
+    """
+    Private directory for the unix sockets, created if needed. Raises
+    PermissionError when it exists but others could write to it.
+    """
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    path = os.path.join(base, 'excavator') if base else '/tmp/excavator-%d' % os.getuid()
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError("%s is not a private directory of this user" % path)
+    return path
+
+
+def unix_path(port):
+    """Path of the unix socket used for the shared-memory handshake."""
+    return os.path.join(runtime_dir(), '%d.sock' % port)
+
+
+class ShmRing:
+    """
+    Single-producer single-consumer message ring in shared memory.
+
+    Header holds `head` (bytes ever written), `tail` (bytes ever read), the
+    data capacity and the pid of the creating process. Only the producer moves `head` and only the consumer moves
+    `tail`, so no lock is needed. Messages are stored as a 4 byte length
+    followed by the payload and may wrap around the end of the buffer.
+    """
+    _HEADER = struct.Struct('QQQQ')
+    _COUNTER = struct.Struct('Q')
+    _LENGTH = struct.Struct('I')
+
+    def __init__(self, name=None, capacity=64 * 1024):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=self._HEADER.size + capacity)
+            self._HEADER.pack_into(self.shm.buf, 0, 0, 0, capacity, os.getpid())
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Only the creating process is responsible for unlinking
+            if self._HEADER.unpack_from(self.shm.buf, 0)[3] != os.getpid():
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name = self.shm.name
+        self.capacity = self._HEADER.unpack_from(self.shm.buf, 0)[2]
+        self._data = self.shm.buf[self._HEADER.size:]
+
+    def _copy_in(self, pos, data):
+        offset = pos % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self._data[offset:offset + first] = data[:first]
+        if first < len(data):
+            self._data[:len(data) - first] = data[first:]
+
+    def _copy_out(self, pos, size):
+        offset = pos % self.capacity
+        first = min(size, self.capacity - offset)
+        chunk = bytes(self._data[offset:offset + first])
+        if first < size:
+            chunk += bytes(self._data[:size - first])
+        return chunk
+
+    def put(self, data):
+        """Appends a message. Returns False when there is not enough room."""
+        need = self._LENGTH.size + len(data)
+        if need > self.capacity:
+            raise ValueError("Message of %d bytes does not fit in ring of %d bytes"
+                             % (len(data), self.capacity))
+        head, tail, _, _ = self._HEADER.unpack_from(self.shm.buf, 0)
+        if need > self.capacity - (head - tail):
+            return False
+        self._copy_in(head, self._LENGTH.pack(len(data)))
+        self._copy_in(head + self._LENGTH.size, data)
+        # Publish the message only after its bytes are in place
+        self._COUNTER.pack_into(self.shm.buf, 0, head + need)
+        return True
+
+    def get(self):
+        """Pops the oldest message, or returns None when the ring is empty."""
+        head, tail, _, _ = self._HEADER.unpack_from(self.shm.buf, 0)
+        if head == tail:
+            return None
+        size = self._LENGTH.unpack(self._copy_out(tail, self._LENGTH.size))[0]
+        data = self._copy_out(tail + self._LENGTH.size, size)
+        self._COUNTER.pack_into(self.shm.buf, 8, tail + self._LENGTH.size + size)
+        return data
+
+    def close(self, unlink=False):
+        self._data.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class ShmConnection:
+    """Socket-like, message oriented connection over a pair of ShmRings."""
+
+    def __init__(self, ctrl, tx_ring, rx_ring, tx_event, rx_event):
+        self._ctrl = ctrl
+        self._tx_ring = tx_ring
+        self._rx_ring = rx_ring
+        self._tx_event = tx_event
+        self._rx_event = rx_event
+        self._timeout = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @classmethod
+    def connect(cls, path):
+        """Client side of the handshake done by ShmListener.accept."""
+        ctrl = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            ctrl.connect(path)
+            msg, fds, _, _ = socket.recv_fds(ctrl, 1024, 2)
+            if len(fds) != 2:
+                raise ConnectionError("Handshake did not carry eventfds")
+            names = json.loads(msg.decode('utf-8'))
+            tx_ring = ShmRing(names['cmd'])
+            rx_ring = ShmRing(names['reply'])
+            # Tell the server the rings are mapped so it can unlink them
+            ctrl.sendall(b'\x01')
+        except Exception:
+            ctrl.close()
+            raise
+        return cls(ctrl, tx_ring, rx_ring, fds[0], fds[1])
+
+    def fileno(self):
+        return self._rx_event
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def sendall(self, data):
+        deadline = None if self._timeout is None else time.monotonic() + self._timeout
+        while not self._tx_ring.put(data):
+            # Consumer is behind; it frees room without signalling us
+            if deadline is not None and time.monotonic() > deadline:
+                raise socket.timeout("timed out")
+            time.sleep(0.0005)
+        os.eventfd_write(self._tx_event, 1)
+
+    def recv(self, bufsize=None):
+        """
+        Returns the next whole message, or b'' once the peer has gone away.
+        Unlike a stream socket, messages are never split or coalesced.
+        """
+        deadline = None if self._timeout is None else time.monotonic() + self._timeout
+        while True:
+            data = self._rx_ring.get()
+            if data is not None:
+                return data
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([self._rx_event, self._ctrl], [], [], wait)
+            if not ready:
+                raise socket.timeout("timed out")
+            if self._rx_event in ready:
+                os.eventfd_read(self._rx_event)
+            elif not self._ctrl.recv(1):
+                # Peer closed; drain anything it sent before leaving
+                data = self._rx_ring.get()
+                return b'' if data is None else data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._ctrl.close()
+        os.close(self._tx_event)
+        os.close(self._rx_event)
+        self._tx_ring.close()
+        self._rx_ring.close()
+
+
+class ShmListener:
+    """Unix socket that hands shared-memory connections out to clients."""
+
+    def __init__(self, path, capacity=64 * 1024):
+        self.path = path
+        self.capacity = capacity
+        self.accepted = 0
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def accept(self):
+        ctrl, _ = self.socket.accept()
+        cmd_ring = ShmRing(capacity=self.capacity)
+        reply_ring = ShmRing(capacity=self.capacity)
+        cmd_event = os.eventfd(0)
+        reply_event = os.eventfd(0)
+        try:
+            # A client that connects and stays silent must not hold up accept
+            ctrl.settimeout(HANDSHAKE_TIMEOUT)
+            names = json.dumps({'cmd': cmd_ring.name, 'reply': reply_ring.name})
+            socket.send_fds(ctrl, [names.encode('utf-8')], [cmd_event, reply_event])
+            if ctrl.recv(1) != b'\x01':
+                raise ConnectionError("Client left during the handshake")
+            ctrl.settimeout(None)
+        except OSError:
+            ctrl.close()
+            os.close(cmd_event)
+            os.close(reply_event)
+            cmd_ring.close(unlink=True)
+            reply_ring.close(unlink=True)
+            raise
+        else:
+            # Both sides have the segments mapped, the names are no longer needed
+            cmd_ring.shm.unlink()
+            reply_ring.shm.unlink()
+        conn = ShmConnection(ctrl, reply_ring, cmd_ring, reply_event, cmd_event)
+        # Numbered so clients connected at the same time have distinct addresses
+        self.accepted += 1
+        return conn, 'shm:%s#%d' % (self.path, self.accepted)
+
+    def close(self):
+        self.socket.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class Listener:
+    """
+    Accepts clients over TCP and, for same-host clients, over shared memory.
+    `accept` returns whichever connection arrives first.
+    """
+
+    def __init__(self, host, port, shm=True):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen()
+        self.shm_listener = None
+        if shm and SHM_SUPPORTED:
+            try:
+                self.shm_listener = ShmListener(unix_path(port))
+            except OSError as e:
+                print("Shared memory transport unavailable, TCP only:", e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def accept(self):
+        listeners = [self.socket]
+        if self.shm_listener is not None:
+            listeners.append(self.shm_listener)
+        ready, _, _ = select.select(listeners, [], [])
+        return ready[0].accept()
+
+    def close(self):
+        self.socket.close()
+        if self.shm_listener is not None:
+            self.shm_listener.close()
+
+
+def connect(host, port, shm=True):
+    """
+    Connects to a Listener, preferring shared memory when the host is local.
+    Falls back to TCP if the shared-memory handshake is not possible.
+    """
+    if shm and SHM_SUPPORTED and host in LOCAL_HOSTS:
+        try:
+            path = unix_path(port)
+            if os.path.exists(path):
+                return ShmConnection.connect(path)
+        except (OSError, ValueError) as e:
+            print("Shared memory transport unavailable, using TCP:", e)
+    return socket.create_connection((host, port))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Robot side of the shared vision server (see VisionServer.py).
+
+detect() sends one JPEG frame with the models to run and waits at most the
+frame budget for the answer. It returns None whenever the server cannot
+help with this frame (unreachable, too slow, frame dropped as late), and
+the camera then detects on board. After FAILURES misses in a row the
+client stops asking for RETRY_AFTER seconds, so a slow or lost server costs
+at most a few frame budgets; a broken connection is reopened after that.
+"""
+
+import io
+import socket
+import threading
+import time
+
+from PIL import Image
+from VisionServer import OK, PORT, pack_frame, pack_hello, read_message, unpack_result, write_message
+
+
+class VisionClient:
+    FAILURES = 3  # misses in a row before detecting on board for a while
+    RETRY_AFTER = 5.0  # seconds on board before asking the server again
+    CONNECT_TIMEOUT = 0.5  # seconds
+    QUALITY = 85  # JPEG quality
+    MAX_WIDTH = 640  # larger (tiled capture) frames are sent downscaled
+
+    def __init__(self, host, port=PORT, robot_id='excavator', priority=0, budget_ms=100.0,
+                 quality=QUALITY):
+        # The hello message carries both in one byte each
+        if not 0 <= priority <= 255:
+            raise ValueError("priority must be 0 to 255, got %r" % priority)
+        if len(robot_id.encode('utf-8')) > 255:
+            raise ValueError("robot_id must be at most 255 bytes in UTF-8")
+        self.host = host
+        self.port = port
+        self.robot_id = robot_id
+        self.priority = priority
+        self.budget_ms = budget_ms
+        self.quality = quality
+        self.conn = None
+        self.seq = 0
+        self.reply = None
+        self.cond = threading.Condition()
+        self.failures = 0
+        self.retry_at = 0.0
+        self.counts = dict.fromkeys(['sent', 'ok', 'late', 'timeout', 'on_board'], 0)
+        self.round_trip_ms = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def connect(self):
+        try:
+            conn = socket.create_connection((self.host, self.port), self.CONNECT_TIMEOUT)
+            conn.settimeout(None)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            write_message(conn, pack_hello(self.robot_id, self.priority))
+        except OSError as e:
+            print("Vision server %s:%d unreachable: %s" % (self.host, self.port, e))
+            return False
+        self.conn = conn
+        threading.Thread(target=self._read_replies, args=(conn,), name='vision-client',
+                         daemon=True).start()
+        return True
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def _read_replies(self, conn):
+        try:
+            while True:
+                seq, server_ms, results = unpack_result(read_message(conn))
+                with self.cond:
+                    # Answers to frames we gave up on are of no use any more
+                    if seq == self.seq:
+                        self.reply = results
+                        self.cond.notify_all()
+        except (OSError, ValueError):
+            pass
+        with self.cond:
+            if self.conn is conn:
+                self.conn = None
+            self.cond.notify_all()
+
+    def available(self):
+        return time.monotonic() >= self.retry_at
+
+    def encode(self, frame):
+        image = Image.fromarray(frame)
+        if image.width > self.MAX_WIDTH:
+            image = image.reduce(-(-image.width // self.MAX_WIDTH))
+        data = io.BytesIO()
+        image.save(data, 'JPEG', quality=self.quality)
+        return data.getvalue()
+
+    def _failed(self, reason):
+        self.counts[reason] += 1
+        self.failures += 1
+        if self.failures >= self.FAILURES or self.conn is None:
+            self.retry_at = time.monotonic() + self.RETRY_AFTER
+            print("Vision server %s, detecting on board for %.0fs" % (reason, self.RETRY_AFTER))
+
+    def detect(self, frame, models):
+        """
+        Detects on an RGB frame array with `models`, a dict of registry model
+        names to score thresholds. Returns {name: (boxes, classes, scores)}
+        or None when the frame has to be detected on board.
+        """
+        start = time.monotonic()
+        if not self.available():
+            self.counts['on_board'] += 1
+            return None
+        if self.conn is None and not self.connect():
+            self._failed('timeout')
+            return None
+        jpeg = self.encode(frame)
+        remaining = self.budget_ms / 1000 - (time.monotonic() - start)
+        with self.cond:
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            self.reply = None
+            seq = self.seq
+        try:
+            write_message(self.conn, pack_frame(seq, remaining * 1000, models, jpeg))
+        except (OSError, AttributeError):
+            self.close()
+            self._failed('timeout')
+            return None
+        self.counts['sent'] += 1
+        with self.cond:
+            self.cond.wait_for(lambda: self.reply is not None or self.conn is None,
+                               max(remaining, 0))
+            results = self.reply
+        if results is None:
+            self._failed('timeout')
+            return None
+        if any(status != OK for status, _, _, _ in results.values()):
+            self._failed('late')
+            return None
+        self.failures = 0
+        self.counts['ok'] += 1
+        self.round_trip_ms += (time.monotonic() - start) * 1000
+        return {name: (boxes, classes, scores) for name, (_, boxes, classes, scores) in results.items()}
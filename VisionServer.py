@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared vision server doing the inference for a fleet of excavators.
+
+Robots (VisionClient) stream JPEG frames over TCP with the registry models
+to run, a score threshold per model and a time budget. The server decodes
+each frame once, resizes it per model and queues it on that model's
+batcher, which runs frames from every robot as one BatchDetector call:
+
+* a batch waits at most `max_wait` to fill up, less when a deadline is near
+* frames run by robot priority (higher first), then earliest deadline, and
+  a batch only grows while the frames in it still make their deadlines
+* a frame that cannot finish before its deadline is answered LATE at once,
+  so the robot falls back to on-board detection instead of waiting
+* only the newest `max_pending` frames of a robot wait per model; older
+  ones are answered SUPERSEDED, the control loop only needs the latest
+
+Every message is a 4 byte little endian length followed by the payload:
+
+    hello   magic(2s) priority(B) id_length(B) id
+    frame   magic(2s) seq(I) budget_ms(f) models(B) [name threshold(f)] x models jpeg
+    result  magic(2s) seq(I) server_ms(f) models(B)
+            [name status(B) count(H) boxes(4f x count) classes(f x count) scores(f x count)] x models
+
+where a name is its length (B) followed by UTF-8 bytes. Boxes are relative
+[ymin, xmin, ymax, xmax] like detect_objects returns.
+
+    python3 VisionServer.py --port 65440 --max-batch 8
+"""
+
+import argparse
+import io
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from BatchDetector import BatchDetector
+from ModelRegistry import ModelError, default_registry
+from PIL import Image
+from TensorBinding import TensorBinding
+
+PORT = 65440
+MAX_MESSAGE = 8 * 1024 * 1024
+
+LENGTH = struct.Struct('<I')
+HELLO = struct.Struct('<2sBB')
+FRAME = struct.Struct('<2sIfB')
+THRESHOLD = struct.Struct('<f')
+RESULT = struct.Struct('<2sIfB')
+MODEL_RESULT = struct.Struct('<BH')
+
+HELLO_MAGIC = b'VH'
+FRAME_MAGIC = b'VF'
+RESULT_MAGIC = b'VR'
+
+# Result status per model
+OK = 0
+LATE = 1
+SUPERSEDED = 2
+FAILED = 3
+STATUS_NAMES = {OK: 'ok', LATE: 'late', SUPERSEDED: 'superseded', FAILED: 'failed'}
+
+
+def recv_exact(conn, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def read_message(conn):
+    size = LENGTH.unpack(recv_exact(conn, LENGTH.size))[0]
+    if size > MAX_MESSAGE:
+        raise ValueError("Message of %d bytes is too long" % size)
+    return recv_exact(conn, size)
+
+
+def write_message(conn, payload):
+    conn.sendall(LENGTH.pack(len(payload)) + payload)
+
+
+def _pack_name(name):
+    data = name.encode('utf-8')
+    return bytes([len(data)]) + data
+
+
+def _unpack_name(payload, pos):
+    size = payload[pos]
+    return payload[pos + 1:pos + 1 + size].decode('utf-8'), pos + 1 + size
+
+
+def _check_magic(magic, expected):
+    if magic != expected:
+        raise ValueError("Expected a %r message, got %r" % (expected, magic))
+
+
+def pack_hello(robot_id, priority=0):
+    data = robot_id.encode('utf-8')
+    return HELLO.pack(HELLO_MAGIC, priority, len(data)) + data
+
+
+def unpack_hello(payload):
+    magic, priority, size = HELLO.unpack_from(payload)
+    _check_magic(magic, HELLO_MAGIC)
+    return payload[HELLO.size:HELLO.size + size].decode('utf-8'), priority
+
+
+def pack_frame(seq, budget_ms, models, jpeg):
+    """`models` maps registry model names to score thresholds."""
+    parts = [FRAME.pack(FRAME_MAGIC, seq, budget_ms, len(models))]
+    for name, threshold in models.items():
+        parts += [_pack_name(name), THRESHOLD.pack(threshold)]
+    parts.append(jpeg)
+    return b''.join(parts)
+
+
+def unpack_frame(payload):
+    """Returns (seq, budget_ms, models, jpeg)."""
+    magic, seq, budget_ms, count = FRAME.unpack_from(payload)
+    _check_magic(magic, FRAME_MAGIC)
+    pos = FRAME.size
+    models = {}
+    for _ in range(count):
+        name, pos = _unpack_name(payload, pos)
+        models[name] = THRESHOLD.unpack_from(payload, pos)[0]
+        pos += THRESHOLD.size
+    return seq, budget_ms, models, payload[pos:]
+
+
+def pack_result(seq, server_ms, results):
+    """`results` maps model names to (status, boxes, classes, scores)."""
+    parts = [RESULT.pack(RESULT_MAGIC, seq, server_ms, len(results))]
+    for name, (status, boxes, classes, scores) in results.items():
+        parts += [_pack_name(name), MODEL_RESULT.pack(status, len(scores)),
+                  np.asarray(boxes, '<f4').tobytes(), np.asarray(classes, '<f4').tobytes(),
+                  np.asarray(scores, '<f4').tobytes()]
+    return b''.join(parts)
+
+
+def unpack_result(payload):
+    """Returns (seq, server_ms, {name: (status, boxes (N, 4), classes (N,), scores (N,))})."""
+    magic, seq, server_ms, count = RESULT.unpack_from(payload)
+    _check_magic(magic, RESULT_MAGIC)
+    pos = RESULT.size
+    results = {}
+    for _ in range(count):
+        name, pos = _unpack_name(payload, pos)
+        status, n = MODEL_RESULT.unpack_from(payload, pos)
+        pos += MODEL_RESULT.size
+        arrays = np.frombuffer(payload, '<f4', 6 * n, pos)
+        pos += 24 * n
+        results[name] = (status, arrays[:4 * n].reshape(n, 4), arrays[4 * n:5 * n], arrays[5 * n:])
+    return seq, server_ms, results
+
+
+def _empty():
+    return np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.float32)
+
+
+class Robot:
+    """A connected client; replies from the batchers share its socket."""
+
+    def __init__(self, robot_id, priority, conn):
+        self.id = robot_id
+        self.priority = priority
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(['frames'] + list(STATUS_NAMES.values()), 0)
+        self.server_ms = 0.0
+
+    def send(self, payload):
+        try:
+            with self.lock:
+                write_message(self.conn, payload)
+        except OSError:
+            # Gone; its reader thread cleans up
+            pass
+
+
+class Job:
+    """One frame of one robot, answered once every requested model is done."""
+
+    def __init__(self, robot, seq, models, deadline, arrival):
+        self.robot = robot
+        self.seq = seq
+        self.models = models
+        self.deadline = deadline
+        self.arrival = arrival
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def finish(self, name, status, boxes=None, classes=None, scores=None):
+        if boxes is None:
+            boxes, classes, scores = _empty()
+        with self.lock:
+            self.results[name] = (status, boxes, classes, scores)
+            if len(self.results) < len(self.models):
+                return
+        server_ms = (time.monotonic() - self.arrival) * 1000
+        robot = self.robot
+        with robot.lock:
+            for status, _, _, _ in self.results.values():
+                robot.counts[STATUS_NAMES[status]] += 1
+            robot.server_ms += server_ms
+        robot.send(pack_result(self.seq, server_ms, self.results))
+
+
+class ModelBatcher:
+    """Collects frames for one model from every robot and runs them in batches."""
+
+    SMOOTHING = 0.2
+
+    def __init__(self, server, name, model):
+        self.server = server
+        self.name = name
+        self.detector = BatchDetector(model, workers=server.workers, max_batch=server.max_batch)
+        self.size = TensorBinding.of(model.interpreter).size
+        self.pending = []
+        self.cond = threading.Condition()
+        # Smoothed seconds per image, used to tell frames that cannot make it
+        self.per_image = 0.0
+        self.batches = 0
+        self.images = 0
+        self.thread = threading.Thread(target=self._run, name='batcher-' + name, daemon=True)
+        self.thread.start()
+
+    def put(self, job, image):
+        with self.cond:
+            mine = [item for item in self.pending if item[0].robot is job.robot]
+            superseded = mine[:max(0, len(mine) + 1 - self.server.max_pending)]
+            for item in superseded:
+                self.pending.remove(item)
+            self.pending.append((job, image))
+            self.cond.notify()
+        for old, _ in superseded:
+            old.finish(self.name, SUPERSEDED)
+
+    def _next_batch(self):
+        with self.cond:
+            while self.server.running and not self.pending:
+                self.cond.wait()
+            # Give other robots' frames a moment to join, unless a deadline is near
+            while self.server.running and len(self.pending) < self.server.max_batch:
+                fill_by = min(job.arrival for job, _ in self.pending) + self.server.max_wait
+                latest_start = min(job.deadline for job, _ in self.pending) - self.per_image
+                wait = min(fill_by, latest_start) - time.monotonic()
+                if wait <= 0:
+                    break
+                self.cond.wait(wait)
+            now = time.monotonic()
+            late = [item for item in self.pending if item[0].deadline < now + self.per_image]
+            ready = [item for item in self.pending if item[0].deadline >= now + self.per_image]
+            ready.sort(key=lambda item: (-item[0].robot.priority, item[0].deadline))
+            # Grow the batch while every frame in it still makes its deadline
+            batch = ready[:1]
+            deadline = batch[0][0].deadline if batch else now
+            for item in ready[1:self.server.max_batch]:
+                deadline = min(deadline, item[0].deadline)
+                if now + self.per_image * (len(batch) + 1) > deadline:
+                    break
+                batch.append(item)
+            self.pending = ready[len(batch):]
+        for job, _ in late:
+            job.finish(self.name, LATE)
+        return batch
+
+    def _run(self):
+        while self.server.running:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            start = time.monotonic()
+            threshold = min(job.models[self.name] for job, _ in batch)
+            try:
+                boxes, classes, scores, counts = self.detector.detect(
+                    np.stack([image for _, image in batch]), threshold)
+            except (RuntimeError, ValueError) as e:
+                print("Detection with %s failed: %s" % (self.name, e))
+                for job, _ in batch:
+                    job.finish(self.name, FAILED)
+                continue
+            elapsed = (time.monotonic() - start) / len(batch)
+            self.per_image += self.SMOOTHING * (elapsed - self.per_image) if self.batches else elapsed
+            self.batches += 1
+            self.images += len(batch)
+            for i, (job, _) in enumerate(batch):
+                n = counts[i]
+                keep = scores[i, :n] >= job.models[self.name]
+                job.finish(self.name, OK, boxes[i, :n][keep], classes[i, :n][keep], scores[i, :n][keep])
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+
+class VisionServer:
+    MAX_BATCH = 8
+    MAX_WAIT = 0.01  # seconds a batch may wait to fill up
+    MAX_PENDING = 2  # frames per robot waiting on one model
+    RETURN_MARGIN = 0.005  # seconds kept for sending the reply back
+
+    def __init__(self, host='0.0.0.0', port=PORT, registry=None, workers=4,
+                 max_batch=MAX_BATCH, max_wait=MAX_WAIT, max_pending=MAX_PENDING):
+        self.registry = registry or default_registry()
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.batchers = {}
+        self.batchers_lock = threading.Lock()
+        self.robots = {}
+        self.running = False
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen()
+        self.port = self.socket.getsockname()[1]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._accept_loop, name='vision-accept', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.socket.close()
+        for robot in list(self.robots.values()):
+            robot.conn.close()
+        for batcher in self.batchers.values():
+            batcher.wake()
+            batcher.thread.join()
+            batcher.detector.close()
+
+    def batcher(self, name):
+        """The batcher of a registry model, created on first use."""
+        with self.batchers_lock:
+            if name not in self.batchers:
+                self.batchers[name] = ModelBatcher(self, name, self.registry.get(name))
+            return self.batchers[name]
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, addr = self.socket.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve, args=(conn, addr), daemon=True).start()
+
+    def _serve(self, conn, addr):
+        robot = None
+        try:
+            robot_id, priority = unpack_hello(read_message(conn))
+            robot = Robot(robot_id, priority, conn)
+            self.robots[robot_id] = robot
+            print("Robot %s connected from %s, priority %d" % (robot_id, addr[0], priority))
+            while self.running:
+                self.submit(robot, *unpack_frame(read_message(conn)))
+        except (OSError, ValueError, struct.error) as e:
+            if self.running:
+                print("Robot %s disconnected: %s" % (robot.id if robot else addr, e))
+        finally:
+            conn.close()
+            if robot is not None and self.robots.get(robot.id) is robot:
+                del self.robots[robot.id]
+
+    def submit(self, robot, seq, budget_ms, models, jpeg):
+        arrival = time.monotonic()
+        job = Job(robot, seq, models, arrival + budget_ms / 1000 - self.RETURN_MARGIN, arrival)
+        with robot.lock:
+            robot.counts['frames'] += 1
+        try:
+            image = Image.open(io.BytesIO(jpeg)).convert('RGB')
+        except (OSError, ValueError):
+            image = None
+        for name in models:
+            try:
+                batcher = self.batcher(name)
+            except ModelError as e:
+                print(e)
+                batcher = None
+            if image is None or batcher is None:
+                job.finish(name, FAILED)
+                continue
+            batcher.put(job, np.asarray(image.resize(batcher.size, Image.BILINEAR)))
+
+    def stats(self):
+        """Per model batch counts and per robot reply counts."""
+        return {
+            'models': {name: {'batches': b.batches, 'images': b.images,
+                              'mean_batch': b.images / max(b.batches, 1),
+                              'image_ms': b.per_image * 1000}
+                       for name, b in self.batchers.items()},
+            'robots': {robot.id: dict(robot.counts, priority=robot.priority,
+                                      server_ms=robot.server_ms / max(robot.counts['frames'], 1))
+                       for robot in list(self.robots.values())}
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        for name, model in stats['models'].items():
+            print("Model %s: %d batches, mean batch %.1f, %.0fms per image"
+                  % (name, model['batches'], model['mean_batch'], model['image_ms']))
+        for robot_id, robot in stats['robots'].items():
+            print("Robot %s (priority %d): %d frames, %d ok, %d late, %d superseded, %.0fms on server"
+                  % (robot_id, robot['priority'], robot['frames'], robot['ok'], robot['late'],
+                     robot['superseded'], robot['server_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shared vision server for a fleet of excavators')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=4, help='interpreters per model')
+    parser.add_argument('--max-batch', type=int, default=VisionServer.MAX_BATCH)
+    parser.add_argument('--max-wait-ms', type=float, default=VisionServer.MAX_WAIT * 1000)
+    parser.add_argument('--max-pending', type=int, default=VisionServer.MAX_PENDING)
+    parser.add_argument('--stats-every', type=float, default=10.0, help='seconds')
+    args = parser.parse_args()
+
+    server = VisionServer(args.host, args.port, workers=args.workers, max_batch=args.max_batch,
+                          max_wait=args.max_wait_ms / 1000, max_pending=args.max_pending)
+    server.start()
+    print("Vision server listening on port", server.port)
+    try:
+        while True:
+            time.sleep(args.stats_every)
+            server.print_stats()
+    except KeyboardInterrupt:
+        print("caught keyboard interrupt, exiting")
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
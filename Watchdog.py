@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Safety watchdog for the motor node.
+
+Two things stop the motors, whatever the command path is doing:
+
+* leases  - a client that asked for a lease must renew it (with any command
+            or a heartbeat) before it runs out
+* deadlines - no motor may run past its deadline, which is the duration of
+              the command that started it (plus a grace period) or MAX_RUN
+
+The check runs on its own thread, raised to real-time priority when the
+process is allowed to, and only touches the hardware through
+Excavator.emergency_stop, which issues one batched shift-register stop.
+"""
+
+import os
+import threading
+import time
+
+
+class Watchdog:
+    PERIOD = 0.02  # seconds between checks
+    PRIORITY = 50  # SCHED_FIFO priority, needs CAP_SYS_NICE or root
+
+    def __init__(self, excavator):
+        self.excavator = excavator
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='watchdog', daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def renew(self, client, lease):
+        """Extends a client's lease by `lease` seconds from now."""
+        with self.lock:
+            self.leases[client] = time.monotonic() + lease
+
+    def release(self, client, stop=False):
+        """Forgets a client's lease, stopping the motors if asked to."""
+        with self.lock:
+            self.leases.pop(client, None)
+        if stop:
+            self.trip("client %s released" % (client,))
+
+    def trip(self, reason):
+        print("Watchdog stopping all motors:", reason)
+        self.excavator.emergency_stop()
+
+    def _raise_priority(self):
+        try:
+            os.sched_setscheduler(threading.get_native_id(), os.SCHED_FIFO,
+                                  os.sched_param(self.PRIORITY))
+        except (AttributeError, OSError) as e:
+            print("Watchdog runs at normal priority:", e)
+
+    def check(self, now):
+        """Trips on an expired lease or a motor past its deadline at time `now`."""
+        with self.lock:
+            expired = [client for client, until in self.leases.items() if until < now]
+            for client in expired:
+                del self.leases[client]
+        if expired:
+            self.trip("lease of %s expired" % (expired,))
+            return
+        for motor, state in self.excavator.motor_states.items():
+            deadline = state.get('deadline')
+            if state['running'] and deadline is not None and deadline < now:
+                self.trip("motor %d ran past its deadline" % motor)
+                return
+
+    def _run(self):
+        self._raise_priority()
+        while not self.stopped.wait(self.PERIOD):
+            self.check(time.monotonic())
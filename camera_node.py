@@ -1,53 +1,102 @@
 #!/usr/bin/env python3
 
-import socket
+import argparse
 from Camera import Camera
+from concurrent.futures import ThreadPoolExecutor
+from Explorer import Explorer
+from Planner import bearing_from_box
+from Profiler import Profiler, stage
+from Telemetry import TelemetrySubscriber
+from Transport import connect
 import json
+import time
 
 class CameraNode:
     HOST = "127.0.0.1"  # The server's hostname or IP address
     PORT = 65432  # The port used by the server
+    TELEMETRY_PORT = 65433  # The port streaming motor state
+    PROFILER_PORT = 65434  # Local port switching the profiler on and off
+    # Farthest target worth driving to, further ranges are too noisy
+    APPROACH_RANGE = 1150
+    # pixel_metric of the target once it is within about 40mm beyond the
+    # shovel's reach; smaller ones are approached first and measured again
+    GRAB_SIZE = 3.5
     
     def __init__(self) -> None:
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket = None
 
     def __enter__(self):
         return self
 
     def __exit__(self):
         try:
-            self.socket.close()
+            if self.socket is not None:
+                self.socket.close()
         except RuntimeWarning:
             return True
 
     def _dict_to_bytes(self, dict):
-        return json.dumps(dict, ensure_ascii=False).encode('utf-8')
-
-    def connect_to_host(self):
-        self.socket.connect((self.HOST, self.PORT))
+        # The newline ends the message in the motor node's TCP stream
+        return (json.dumps(dict, ensure_ascii=False) + '\n').encode('utf-8')
+
+    def connect_to_host(self, timeout=30):
+        # Uses shared memory when the motor node runs on this host, TCP otherwise.
+        # Retries for a while so both nodes can be (re)started in any order.
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.socket = connect(self.HOST, self.PORT)
+                return
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
 
     def send_command(self, data):
-        self.socket.sendall(self._dict_to_bytes(data))
-        resp = self.socket.recv(1024)
+        with stage('send'):
+            self.socket.sendall(self._dict_to_bytes(data))
+            resp = self.socket.recv(1024)
         print("Received", repr(resp))
 
 cnode = CameraNode()
-cnode.connect_to_host()
+telemetry = TelemetrySubscriber(CameraNode.HOST, CameraNode.TELEMETRY_PORT)
+# Track followed by find_object, kept while the tracker still reports it
+locked_track = None
+# Remembers which directions were already searched
+explorer = Explorer()
 
 def find_object(results, labels, sizes, distances, obj_name):
+    global locked_track
     score = 0
     obj_name_test = 'person'
+
+    # Frames taken while the chains or body move are blurred and the last
+    # command is still being executed, so they only feed the search map
+    explorer.sync(telemetry.state)
+    moving = telemetry.chains_moving() or telemetry.is_running('body')
+    explorer.update(results, labels, obj_name_test, moving=moving)
+    if moving:
+        return
+
     # print("Result: ", repr(results), "Labels:", repr(labels))
 
     for obj in results:
         print("Found object: ", labels[obj['class_id']])
-        if labels[obj['class_id']] == obj_name_test:
-            score = obj['score']
 
-    obj_size = next((size['pixel_metric']
-                    for size in sizes if size["name"] == obj_name_test), 0)
-    obj_dist = next((dist['focal_distance']
-                    for dist in distances if dist["name"] == obj_name_test), 0)
+    # Stay on the locked track, otherwise lock onto the best scoring one
+    candidates = [i for i, obj in enumerate(results) if labels[obj['class_id']] == obj_name_test]
+    locked = [i for i in candidates if results[i].get('track_id') == locked_track]
+    chosen = locked[0] if locked else max(candidates, key=lambda i: results[i]['score'], default=None)
+    obj_size = obj_dist = 0
+    if chosen is not None:
+        target = results[chosen]
+        score = target['score']
+        locked_track = target.get('track_id')
+        # sizes and distances are in the same order as results
+        obj_size = sizes[chosen]['pixel_metric']
+        obj_dist = distances[chosen]['range']
+    else:
+        locked_track = None
 
     print(obj_name_test, " is located far from ", round(obj_dist, 1), " and size is", round(obj_size, 1))
     print("Score is ", score)
@@ -55,37 +104,100 @@ def find_object(results, labels, sizes, distances, obj_name):
     if score < 0.5:
         print("Finding", obj_name_test, "that detected 50 % more percents: ", score)
         # cnode.send_command({"action": "left", "value": "4"}) # Have some issue with left side gear
-        cnode.send_command({"action": "right", "value": "4"})
+        # Turn towards the least recently seen directions, without blocking
+        # on the turn; sweep on the spot when everything was seen lately
+        cnode.send_command(explorer.next_command() or {"action": "right", "value": "4"})
     elif score > 0.5:
         print("Stopping all movements")
         cnode.send_command({"action": "stop", "value": "0"})
 
-    if score > 0.5 and obj_dist < 1150:
-        print("Trying to reach near as possible: ", obj_dist)
-        cnode.send_command({"action": "forward", "value": "1"})
-    elif score > 0.5 and obj_dist < 1150:
-        print("Stopping all movements")
-        cnode.send_command({"action": "stop", "value": "0"})
-
-    if score > 0.5 and obj_dist < 1150 and obj_size > 7:
-        print("Try to catch with shovel")
-        cnode.send_command({"action": "shovel-down", "value": "5"})
+    if score > 0.5 and not telemetry.is_running('shovel', clockwise=False):
+        # Turning, approaching and digging run as one plan on the motor node.
+        # Only dig once the target looks big enough to be within reach,
+        # otherwise drive up to it and look again
+        bearing = bearing_from_box(target['bounding_box'])
+        dig = obj_size > CameraNode.GRAB_SIZE
+        distance = min(obj_dist, CameraNode.APPROACH_RANGE)
+        print("Trying to", "grab" if dig else "approach", "at", round(distance, 1),
+              "bearing", round(bearing, 1))
+        cnode.send_command({"action": "grab",
+                            "value": {"distance": float(distance), "bearing": float(bearing),
+                                      "dig": dig}})
 
 tl_models = [
     {
         'name': 'shovel',
-        'model_path': './trained_model/shovel_model/model.tflite',
-        'label_path': './trained_model/shovel_model/model-dict.txt',
-        'function': None
+        'model': 'shovel_model',
+        'function': None,
+        # Gate for the COCO model below, a lower score keeps its recall up
+        'threshold': 0.4
     },
     {
         'name': 'person',
-        'model_path': './trained_model/object/detect.tflite',
-        'label_path': './trained_model/object/coco_labels.txt',
-        'function': find_object
+        'model': 'object',
+        'function': find_object,
+        # Small and far away targets are searched for in tiles
+        'tiling': {'target': 'person', 'grid': (2, 2)},
+        # Only worth running once the shovel model found something
+        'cascade': {'after': 'shovel', 'mode': 'frame'}
     }
 ]
 
-camera = Camera(tl_models)
-camera.execute_command()
-cnode.__exit__()
+
+def priority(value):
+    value = int(value)
+    if not 0 <= value <= 255:
+        raise argparse.ArgumentTypeError('must be 0 to 255')
+    return value
+
+
+def robot_id(value):
+    if not value or len(value.encode('utf-8')) > 255:
+        raise argparse.ArgumentTypeError('must be 1 to 255 bytes')
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Camera node of the excavator')
+    parser.add_argument('--vision-server', metavar='HOST[:PORT]',
+                        help='shared VisionServer to detect on, on board when it cannot keep up')
+    parser.add_argument('--robot-id', type=robot_id, default='excavator')
+    parser.add_argument('--priority', type=priority, default=0,
+                        help='0 to 255, higher is served first')
+    parser.add_argument('--budget-ms', type=float, default=100.0,
+                        help='wait for the vision server per frame')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile from the start; SIGUSR2 or Profiler.py switch it any time')
+    args = parser.parse_args()
+
+    profiler = Profiler('camera_node')
+    profiler.install_signal()
+    profiler.serve(CameraNode.PROFILER_PORT)
+    if args.profile:
+        profiler.start()
+
+    start = time.monotonic()
+    # Connect to the motor node while the camera warms up and models load
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        connected = pool.submit(cnode.connect_to_host)
+        camera = Camera(tl_models)
+        connected.result()
+    telemetry.start()
+    # Replaced model files are swapped in without restarting
+    camera.watch_models()
+    if args.vision_server:
+        host, _, port = args.vision_server.partition(':')
+        camera.use_server(host, int(port) if port else None, args.robot_id, args.priority,
+                          args.budget_ms)
+    # Trade quality for latency when the Pi gets hot or busy. No model has a
+    # 'light_model' variant, so the first level only cuts batch workers
+    camera.govern(budget_ms=200)
+    print("Ready to send commands after %.0fms" % ((time.monotonic() - start) * 1000))
+    camera.execute_command()
+    profiler.close()
+    telemetry.close()
+    cnode.__exit__()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 学習データの水増し (Roboflow の代わりにローカルで行う)
+#
+# 使い方:
+#   python3 helper/augment_dataset.py --xml-dir <VOC folder> --img-dir <VOC folder> \
+#       --output augmented --count 10000
+#   python3 helper/augment_dataset.py --index dataset.npz --output augmented --count 10000
+#
+# 元画像を出力サイズに揃えてからバッチ (N, H, W, 3) ごとに NumPy で変換する:
+# 拡大・切り抜き・左右反転 (バイリニア補間)、明るさ・コントラスト、ぼかし、
+# 4枚を並べるモザイク。バウンディングボックスも同じ変換で動かし、はみ出して
+# ほとんど見えなくなったものは捨てる。バッチはワーカープロセスで作り、各ワーカーが
+# JPEG と VOC XML を直接書き出す。親プロセスは CSV の行だけを受け取って一行ずつ
+# 書くので、枚数が増えてもメモリは増えない。
+# 出力は voc_to_csv.py / voc_dataset.py でそのまま読める
+# (<output>/images/augNNNNNN.jpg と <output>/annotations/augNNNNNN.xml)。
+
+import argparse
+import functools
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from PIL import Image
+
+from voc_dataset import AnnotationIndex, build_index
+
+# Sources kept decoded per worker, at the output size
+CACHE_SIZE = 128
+# A box is kept when this much of it is still in the image...
+MIN_VISIBLE = 0.4
+# ...and it is at least this many pixels wide and high
+MIN_SIZE = 4
+
+OPTIONS = {
+    'flip': 0.5,  # probability of a horizontal flip
+    'scale': (0.6, 1.0),  # side of the crop as a share of the image
+    'aspect': 0.2,  # log aspect ratio jitter of the crop
+    'brightness': 0.2,  # +- share of the full range
+    'contrast': 0.3,  # +- share around the image mean
+    'blur': 0.2,  # probability of a box blur
+    'blur_radius': (1, 2),  # pixels
+    'mosaic': 0.25,  # probability of a 2x2 mosaic of four sources
+    'quality': 90  # JPEG quality
+}
+
+
+#---------------------------------------------------------------------
+# ワーカープロセス (索引と元画像のキャッシュを持つ)
+#---------------------------------------------------------------------
+_index = None
+_offsets = None
+_size = None
+_options = None
+_output = None
+
+
+def _init_worker(index, size, options, output):
+    global _index, _offsets, _size, _options, _output
+    _index = index
+    _offsets = np.concatenate([[0], np.cumsum(index.box_counts)])
+    _size = size
+    _options = options
+    _output = output
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def load_source(i):
+    """Image i resized to the output size, with its boxes and labels scaled along."""
+    width, height = _size
+    with Image.open(str(_index.image_paths[i])) as image:
+        # JPEG is decoded at a reduced scale straight away when much larger
+        image.draft('RGB', (width, height))
+        pixels = np.asarray(image.convert('RGB').resize((width, height), Image.BILINEAR))
+    scale = np.array([width / max(_index.widths[i], 1), height / max(_index.heights[i], 1)] * 2,
+                     np.float32)
+    boxes = _index.boxes[_offsets[i]:_offsets[i + 1]] * scale
+    return pixels, boxes, _index.labels[_offsets[i]:_offsets[i + 1]]
+
+
+#---------------------------------------------------------------------
+# 幾何変換 (切り抜き・拡大・反転をバッチでまとめて補間する)
+#---------------------------------------------------------------------
+def sample_crops(rng, n, width, height, options, aspect=None):
+    """
+    Random crops (x0, y0, crop width, crop height) of a width x height image.
+    `aspect` is the wanted width/height of the crop, the image's by default.
+    """
+    side = rng.uniform(*options['scale'], n)
+    jitter = np.exp(rng.uniform(-options['aspect'], options['aspect'], n))
+    ratio = (width / height if aspect is None else np.asarray(aspect)) * jitter
+    area = side ** 2 * width * height
+    crop_w = np.minimum(np.sqrt(area * ratio), width)
+    crop_h = np.minimum(crop_w / ratio, height)
+    x0 = rng.uniform(0, 1, n) * (width - crop_w)
+    y0 = rng.uniform(0, 1, n) * (height - crop_h)
+    return np.stack([x0, y0, crop_w, crop_h], axis=1).astype(np.float32)
+
+
+def crop_resize(images, crops, out_w, out_h, flips):
+    """
+    Bilinear crop and resize of a batch: images (N, H, W, 3) uint8, crops
+    (N, 4) as from sample_crops, flips (N,) bool. Returns (N, out_h, out_w, 3)
+    float32.
+    """
+    n, height, width, _ = images.shape
+    x0, y0, crop_w, crop_h = crops.T
+    ys = y0[:, None] + (np.arange(out_h) + 0.5) * (crop_h / out_h)[:, None] - 0.5
+    xs = x0[:, None] + (np.arange(out_w) + 0.5) * (crop_w / out_w)[:, None] - 0.5
+    xs = np.where(flips[:, None], xs[:, ::-1], xs)
+    ys = np.clip(ys, 0, height - 1)
+    xs = np.clip(xs, 0, width - 1)
+    # Rows first, whole rows copy fast, then the columns of the smaller result
+    top = np.floor(ys).astype(np.intp)
+    bottom = np.minimum(top + 1, height - 1)
+    wy = (ys - top)[:, :, None, None].astype(np.float32)
+    batch = np.arange(n)[:, None]
+    rows = images[batch, top].astype(np.float32)
+    rows *= 1 - wy
+    rows += images[batch, bottom] * wy
+    left = np.floor(xs).astype(np.intp)
+    right = np.minimum(left + 1, width - 1)
+    wx = (xs - left)[:, None, :, None].astype(np.float32)
+    # take() along one axis per image beats one broadcast gather by far
+    out = np.empty((n, out_h, out_w, 3), np.float32)
+    tap = np.empty((out_h, out_w, 3), np.float32)
+    for i in range(n):
+        np.take(rows[i], left[i], axis=1, out=out[i])
+        out[i] *= 1 - wx[i]
+        np.take(rows[i], right[i], axis=1, out=tap)
+        tap *= wx[i]
+        out[i] += tap
+    return out
+
+
+def transform_boxes(boxes, crop, out_w, out_h, flip, offset=(0, 0)):
+    """
+    Moves source boxes (xmin, ymin, xmax, ymax) through a crop, resize and
+    flip, then clips them. Returns (boxes, keep mask into the input boxes).
+    """
+    x0, y0, crop_w, crop_h = crop
+    scale = np.array([out_w / crop_w, out_h / crop_h] * 2, np.float32)
+    moved = (boxes - np.array([x0, y0, x0, y0], np.float32)) * scale
+    if flip:
+        moved = np.stack([out_w - moved[:, 2], moved[:, 1], out_w - moved[:, 0], moved[:, 3]], axis=1)
+    clipped = np.clip(moved, 0, [out_w, out_h, out_w, out_h])
+    area = np.prod(moved[:, 2:] - moved[:, :2], axis=1)
+    sides = clipped[:, 2:] - clipped[:, :2]
+    keep = (np.prod(np.maximum(sides, 0), axis=1) >= MIN_VISIBLE * area) & \
+        np.all(sides >= MIN_SIZE, axis=1)
+    return clipped[keep] + np.array(offset * 2, np.float32), keep
+
+
+#---------------------------------------------------------------------
+# 色の変換 (バッチ全体にまとめて適用する)
+#---------------------------------------------------------------------
+def adjust_colors(batch, rng, options):
+    """Random brightness and contrast per image, in place on a float32 batch."""
+    n = len(batch)
+    contrast = 1 + rng.uniform(-options['contrast'], options['contrast'], n).astype(np.float32)
+    brightness = rng.uniform(-options['brightness'], options['brightness'], n).astype(np.float32) * 255
+    mean = batch.mean(axis=(1, 2, 3), keepdims=True)
+    batch -= mean
+    batch *= contrast[:, None, None, None]
+    batch += mean + brightness[:, None, None, None]
+    return batch
+
+
+def box_blur(batch, radius):
+    """Separable box blur of a (N, H, W, 3) float32 batch with running sums."""
+    size = 2 * radius + 1
+    for axis in (1, 2):
+        pad = [(0, 0)] * 4
+        pad[axis] = (radius + 1, radius)
+        sums = np.cumsum(np.pad(batch, pad, mode='edge'), axis=axis)
+        length = batch.shape[axis]
+        batch = (np.take(sums, np.arange(size, size + length), axis=axis) -
+                 np.take(sums, np.arange(length), axis=axis)) / size
+    return batch
+
+
+def blur(batch, rng, options):
+    """Blurs a random share of the batch, all images of one radius at once."""
+    chosen = rng.random(len(batch)) < options['blur']
+    radii = rng.integers(options['blur_radius'][0], options['blur_radius'][1] + 1, len(batch))
+    for radius in np.unique(radii[chosen]):
+        selected = np.flatnonzero(chosen & (radii == radius))
+        batch[selected] = box_blur(batch[selected], int(radius))
+    return batch
+
+
+#---------------------------------------------------------------------
+# モザイク (4枚の切り抜きを中心点の周りに並べる)
+#---------------------------------------------------------------------
+def mosaic(rng, sources, width, height, options):
+    """One mosaic of four sources. Returns (image (H, W, 3) float32, boxes, labels)."""
+    cx = int(rng.uniform(0.3, 0.7) * width)
+    cy = int(rng.uniform(0.3, 0.7) * height)
+    canvas = np.empty((height, width, 3), np.float32)
+    all_boxes, all_labels = [], []
+    for (x, y, w, h), i in zip([(0, 0, cx, cy), (cx, 0, width - cx, cy),
+                                (0, cy, cx, height - cy), (cx, cy, width - cx, height - cy)], sources):
+        pixels, boxes, labels = load_source(int(i))
+        crop = sample_crops(rng, 1, width, height, options, aspect=w / h)
+        flip = rng.random(1) < options['flip']
+        canvas[y:y + h, x:x + w] = crop_resize(pixels[None], crop, w, h, flip)[0]
+        moved, keep = transform_boxes(boxes, crop[0], w, h, flip[0], offset=(x, y))
+        all_boxes.append(moved)
+        all_labels.append(labels[keep])
+    return canvas, np.concatenate(all_boxes), np.concatenate(all_labels)
+
+
+def augment_batch(rng, count, options):
+    """
+    Makes `count` variants from random sources. Returns (uint8 images
+    (N, H, W, 3), [(boxes, labels)] per image) with boxes in output pixels.
+    """
+    width, height = _size
+    mosaics = rng.random(count) < options['mosaic']
+    sources = rng.integers(0, len(_index), (count, 4))
+    flips = rng.random(count) < options['flip']
+    batch = np.empty((count, height, width, 3), np.float32)
+    annotations = [None] * count
+
+    plain = np.flatnonzero(~mosaics)
+    if len(plain):
+        loaded = [load_source(int(i)) for i in sources[plain, 0]]
+        crops = sample_crops(rng, len(plain), width, height, options)
+        batch[plain] = crop_resize(np.stack([pixels for pixels, _, _ in loaded]), crops,
+                                   width, height, flips[plain])
+        for j, (_, boxes, labels), crop, flip in zip(plain, loaded, crops, flips[plain]):
+            moved, keep = transform_boxes(boxes, crop, width, height, flip)
+            annotations[j] = (moved, labels[keep])
+    for j in np.flatnonzero(mosaics):
+        batch[j], boxes, labels = mosaic(rng, sources[j], width, height, options)
+        annotations[j] = (boxes, labels)
+
+    batch = blur(adjust_colors(batch, rng, options), rng, options)
+    return np.clip(batch + 0.5, 0, 255).astype(np.uint8), annotations
+
+
+#---------------------------------------------------------------------
+# 書き出し (JPEG と VOC XML はワーカーが書き、CSV の行だけを返す)
+#---------------------------------------------------------------------
+def write_voc(path, filename, width, height, boxes, names):
+    root = ET.Element('annotation')
+    ET.SubElement(root, 'folder').text = 'images'
+    ET.SubElement(root, 'filename').text = filename
+    size = ET.SubElement(root, 'size')
+    for tag, value in (('width', width), ('height', height), ('depth', 3)):
+        ET.SubElement(size, tag).text = str(value)
+    for (xmin, ymin, xmax, ymax), name in zip(boxes, names):
+        obj = ET.SubElement(root, 'object')
+        ET.SubElement(obj, 'name').text = name
+        ET.SubElement(obj, 'pose').text = 'Unspecified'
+        ET.SubElement(obj, 'truncated').text = '0'
+        ET.SubElement(obj, 'difficult').text = '0'
+        bndbox = ET.SubElement(obj, 'bndbox')
+        for tag, value in zip(('xmin', 'ymin', 'xmax', 'ymax'), (xmin, ymin, xmax, ymax)):
+            ET.SubElement(bndbox, tag).text = str(value)
+    ET.ElementTree(root).write(path, encoding='utf-8')
+
+
+def run_job(job, seed):
+    """Worker: makes and writes one batch. Returns its CSV rows."""
+    number, first, count = job
+    rng = np.random.default_rng([seed, number])
+    width, height = _size
+    images, annotations = augment_batch(rng, count, _options)
+    rows = []
+    for k, (image, (boxes, labels)) in enumerate(zip(images, annotations)):
+        stem = 'aug%06d' % (first + k)
+        filename = stem + '.jpg'
+        Image.fromarray(image).save(os.path.join(_output, 'images', filename),
+                                    quality=_options['quality'])
+        boxes = np.round(boxes).astype(np.int32)
+        names = [str(_index.classes[label]) for label in labels]
+        write_voc(os.path.join(_output, 'annotations', stem + '.xml'), filename,
+                  width, height, boxes, names)
+        for (xmin, ymin, xmax, ymax), name in zip(boxes, names):
+            rows.append('%s,%d,%d,%s,%d,%d,%d,%d' % (filename, width, height, name,
+                                                     xmin, ymin, xmax, ymax))
+    return rows
+
+
+#---------------------------------------------------------------------
+# メイン
+#---------------------------------------------------------------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Augment a Pascal VOC dataset locally')
+    parser.add_argument('--index', help='voc_dataset.py index, instead of --xml-dir/--img-dir')
+    parser.add_argument('--xml-dir', default='./')
+    parser.add_argument('--img-dir', default='./')
+    parser.add_argument('--output', default='augmented', help='folder to write to')
+    parser.add_argument('--csv', help='CSV in the tfrecord-csv layout (default: <output>/annotations.csv)')
+    parser.add_argument('--count', type=int, default=1000, help='number of images to make')
+    parser.add_argument('--size', default='640x480', help='output WIDTHxHEIGHT')
+    parser.add_argument('--batch', type=int, default=8, help='images transformed together')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes (default: CPU count)')
+    for name, value in OPTIONS.items():
+        if isinstance(value, tuple):
+            parser.add_argument('--' + name.replace('_', '-'), default=value,
+                                type=lambda text, kind=type(value[0]): tuple(kind(v) for v in text.split(',')),
+                                help='MIN,MAX (default: %s)' % ','.join(str(v) for v in value))
+        else:
+            parser.add_argument('--' + name.replace('_', '-'), type=type(value), default=value,
+                                help='(default: %s)' % value)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {name: getattr(args, name) for name in OPTIONS}
+    try:
+        width, height = (int(v) for v in args.size.lower().split('x'))
+    except ValueError:
+        print('Error | --size は WIDTHxHEIGHT で指定してください: ' + args.size, file=sys.stderr)
+        return 2
+
+    if args.index:
+        index = AnnotationIndex.load(args.index)
+    else:
+        index, _, errors = build_index(args.xml_dir, args.img_dir, workers=args.workers)
+        for path, messages in errors:
+            for message in messages:
+                print('Error | ' + message + ': ' + path, file=sys.stderr)
+    if not len(index):
+        print('Error | 画像とアノテーションの組が見つかりませんでした', file=sys.stderr)
+        return 2
+
+    os.makedirs(os.path.join(args.output, 'images'), exist_ok=True)
+    os.makedirs(os.path.join(args.output, 'annotations'), exist_ok=True)
+    output_csv = args.csv or os.path.join(args.output, 'annotations.csv')
+    jobs = [(number, first, min(args.batch, args.count - first))
+            for number, first in enumerate(range(0, args.count, args.batch))]
+    workers = args.workers or os.cpu_count() or 1
+
+    start = time.perf_counter()
+    done = box_count = 0
+    with open(output_csv, 'w') as f, ProcessPoolExecutor(
+            workers, initializer=_init_worker,
+            initargs=(index, (width, height), options, args.output)) as pool:
+        f.write('filename,width,height,class,xmin,ymin,xmax,ymax\n')
+        for job, rows in zip(jobs, pool.map(functools.partial(run_job, seed=args.seed), jobs)):
+            for row in rows:
+                f.write(row + '\n')
+            done += job[2]
+            box_count += len(rows)
+            if done // 1000 != (done - job[2]) // 1000:
+                print('%d/%d' % (done, args.count))
+
+    elapsed = time.perf_counter() - start
+    print('%d images from %d sources, %d boxes in %.1fs (%.0f images/s)' % (
+        done, len(index), box_count, elapsed, done / max(elapsed, 1e-9)))
+    print('出力フォルダ: ' + os.path.abspath(args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#---------------------------------------------------------------------
+# End
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# TFLite モデルの精度 (mAP) と推論時間の比較
+#
+# 使い方:
+#   python3 helper/evaluate_models.py --xml-dir <VOC folder> --img-dir <VOC folder> --report report.md
+#   python3 helper/evaluate_models.py --index dataset.npz --report report.md
+#   python3 helper/evaluate_models.py --csv AutoMLVision.csv --img-dir <image folder> --set TEST
+#
+# 比較するモデルは ModelRegistry と同じく trained_model の下のフォルダから探す
+# (--models で名前を指定すればそのモデルだけ)。
+# 画像はワーカープロセスに分けて推論し (各プロセスが自分のインタプリタを持つ)、
+# mAP@IoU、スコア 0.5 での適合率・再現率、1枚あたりの推論時間を計算する。
+# データセットの読み込みは voc_dataset.py の索引か、voc_to_csv.py が書いた CSV を使う。
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from PIL import Image
+
+from voc_dataset import AnnotationIndex, build_index
+from voc_to_csv import IMAGE_EXTENSIONS, index_files
+
+# The repository root, so the models and modules of the robot are found from any folder
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from ModelRegistry import ModelRegistry  # noqa: E402
+from Tiling import iou_matrix  # noqa: E402
+
+# Score threshold used by Camera.execute_command
+SCORE_THRESHOLD = 0.5
+
+
+#---------------------------------------------------------------------
+# voc_to_csv.py の CSV の読み込み
+#---------------------------------------------------------------------
+def load_csv(path, img_dir, dataset=None):
+    """
+    AnnotationIndex of an AutoML CSV written by voc_to_csv.py. Images are
+    found in img_dir by file name (the CSV holds their bucket paths) and
+    `dataset` keeps only the rows of TRAIN, VALIDATE or TEST.
+    """
+    images = index_files(img_dir, IMAGE_EXTENSIONS)
+    entries = {}
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 9 or (dataset and row[0] != dataset):
+                continue
+            stem = os.path.splitext(os.path.basename(row[1]))[0]
+            if stem not in images:
+                print('Error | 対応する画像ファイルが見つかりませんでした: ' + row[1], file=sys.stderr)
+                continue
+            box = [float(row[i]) for i in (3, 4, 7, 8)]
+            entries.setdefault(stem, []).append((box, row[2]))
+
+    stems = sorted(entries)
+    sizes = []
+    for stem in stems:
+        with Image.open(images[stem]) as image:
+            sizes.append(image.size)
+    classes = sorted({name for stem in stems for _, name in entries[stem]})
+    class_ids = {name: i for i, name in enumerate(classes)}
+    boxes = [np.asarray([box for box, _ in entries[stem]], np.float32) * (size * 2)
+             for stem, size in zip(stems, sizes)]
+    return AnnotationIndex(
+        stems=stems,
+        image_paths=[images[stem] for stem in stems],
+        mtimes=[os.path.getmtime(images[stem]) for stem in stems],
+        widths=[width for width, _ in sizes],
+        heights=[height for _, height in sizes],
+        box_counts=[len(b) for b in boxes],
+        boxes=np.concatenate(boxes) if boxes else None,
+        labels=[class_ids[name] for stem in stems for _, name in entries[stem]],
+        classes=classes)
+
+
+#---------------------------------------------------------------------
+# ワーカープロセス (モデルごとにインタプリタを一つずつ持つ)
+#---------------------------------------------------------------------
+_interpreters = []
+
+
+def _init_worker(model_dir, names):
+    registry = ModelRegistry(model_dir, num_threads=1)
+    for name in names:
+        interpreter = registry.get(name).interpreter
+        # The first invoke allocates scratch buffers, keep it out of the timings
+        interpreter.invoke()
+        _interpreters.append(interpreter)
+
+
+def _detect(path):
+    """Runs every model over one image. Returns a list of (boxes, classes, scores, ms)."""
+    image = Image.open(path).convert('RGB')
+    results = []
+    for interpreter in _interpreters:
+        detail = interpreter.get_input_details()[0]
+        _, height, width, _ = detail['shape']
+        pixels = np.asarray(image.resize((width, height), Image.LANCZOS))
+        if detail['dtype'] == np.float32:
+            pixels = (pixels.astype(np.float32) - 127.5) / 127.5
+        interpreter.set_tensor(detail['index'], pixels[np.newaxis].astype(detail['dtype']))
+        start = time.perf_counter()
+        interpreter.invoke()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        outputs = interpreter.get_output_details()
+        boxes, classes, scores, count = (np.squeeze(interpreter.get_tensor(o['index']))
+                                         for o in outputs[:4])
+        count = int(count)
+        results.append((boxes[:count].copy(), classes[:count].astype(np.int32),
+                        scores[:count].copy(), elapsed_ms))
+    return results
+
+
+#---------------------------------------------------------------------
+# 評価指標 (IoU は Tiling.iou_matrix、AP はベクトル化して計算)
+#---------------------------------------------------------------------
+def match_detections(det_boxes, det_scores, gt_boxes, iou_threshold):
+    """Greedy matching by score. Returns a boolean true-positive flag per detection."""
+    tp = np.zeros(len(det_boxes), bool)
+    if len(det_boxes) == 0 or len(gt_boxes) == 0:
+        return tp
+    ious = iou_matrix(det_boxes, gt_boxes)
+    taken = np.zeros(len(gt_boxes), bool)
+    for i in np.argsort(-det_scores):
+        candidates = np.where(taken, -1.0, ious[i])
+        j = int(np.argmax(candidates))
+        if candidates[j] >= iou_threshold:
+            tp[i] = True
+            taken[j] = True
+    return tp
+
+
+def average_precision(scores, tp, positives):
+    """All-point interpolated AP from per-detection scores and TP flags."""
+    if positives == 0:
+        return float('nan')
+    if len(scores) == 0:
+        return 0.0
+    order = np.argsort(-scores)
+    tp_cum = np.cumsum(tp[order])
+    fp_cum = np.cumsum(~tp[order])
+    recall = tp_cum / positives
+    precision = tp_cum / np.maximum(tp_cum + fp_cum, 1e-9)
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    recall = np.concatenate([[0], recall])
+    return float(np.sum((recall[1:] - recall[:-1]) * precision))
+
+
+def evaluate(index, detections, labels, iou_threshold):
+    """Computes mAP and precision/recall at SCORE_THRESHOLD for one model."""
+    # Ground truth in the model's [ymin, xmin, ymax, xmax] relative layout
+    size = np.stack([index.widths, index.heights, index.widths, index.heights], axis=1)
+    relative = index.boxes / np.maximum(size[index.files], 1)
+    gt_boxes = relative[:, [1, 0, 3, 2]]
+    name_to_id = {name: class_id for class_id, name in labels.items()}
+    gt_classes = np.array([name_to_id.get(str(index.classes[label]), -1) for label in index.labels])
+    # Images left out with --limit have no detections and must not count as misses
+    gt_classes[index.files >= len(detections)] = -1
+
+    per_class = {}
+    all_tp, all_positives = [], 0
+    for class_id in sorted(set(gt_classes[gt_classes >= 0].tolist())):
+        scores, tp = [], []
+        positives = int(np.count_nonzero(gt_classes == class_id))
+        for i, (boxes, classes, det_scores, _) in enumerate(detections):
+            mask = classes == class_id
+            truth = gt_boxes[(index.files == i) & (gt_classes == class_id)]
+            tp.append(match_detections(boxes[mask], det_scores[mask], truth, iou_threshold))
+            scores.append(det_scores[mask])
+        scores = np.concatenate(scores) if scores else np.zeros(0)
+        tp = np.concatenate(tp) if tp else np.zeros(0, bool)
+        per_class[labels[class_id]] = average_precision(scores, tp, positives)
+        all_tp.append(tp[scores >= SCORE_THRESHOLD])
+        all_positives += positives
+
+    hits = np.concatenate(all_tp) if all_tp else np.zeros(0, bool)
+    aps = [ap for ap in per_class.values() if not np.isnan(ap)]
+    return {
+        'map': float(np.mean(aps)) if aps else float('nan'),
+        'ap_per_class': per_class,
+        'precision': float(hits.mean()) if len(hits) else float('nan'),
+        'recall': float(hits.sum() / all_positives) if all_positives else float('nan')
+    }
+
+
+#---------------------------------------------------------------------
+# レポート
+#---------------------------------------------------------------------
+def write_report(results, path):
+    lines = ['| model | mAP | precision@0.5 | recall@0.5 | mean ms | p90 ms | mAP per 100 ms |',
+             '|---|---|---|---|---|---|---|']
+    for name, r in sorted(results.items(), key=lambda item: -item[1]['map_per_100ms']):
+        lines.append('| %s | %.3f | %.3f | %.3f | %.1f | %.1f | %.3f |' % (
+            name, r['map'], r['precision'], r['recall'],
+            r['latency_ms']['mean'], r['latency_ms']['p90'], r['map_per_100ms']))
+    table = '\n'.join(lines)
+    print(table)
+    if path:
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(results, f, indent=2)
+            else:
+                f.write(table + '\n')
+
+
+#---------------------------------------------------------------------
+# メイン
+#---------------------------------------------------------------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Compare TFLite detection models on a VOC dataset')
+    parser.add_argument('--index', help='index built by voc_dataset.py')
+    parser.add_argument('--csv', help='AutoML CSV written by voc_to_csv.py, images in --img-dir')
+    parser.add_argument('--set', choices=('TRAIN', 'VALIDATE', 'TEST'), default=None,
+                        help='evaluate only this part of the CSV')
+    parser.add_argument('--xml-dir', default='./')
+    parser.add_argument('--img-dir', default='./')
+    parser.add_argument('--model-dir', default=os.path.join(REPO_DIR, 'trained_model'))
+    parser.add_argument('--models', nargs='+', default=None,
+                        help='model folder names, all models under --model-dir by default')
+    parser.add_argument('--iou', type=float, default=0.5, help='IoU threshold for mAP')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--limit', type=int, default=None, help='evaluate only the first N images')
+    parser.add_argument('--report', default=None, help='.md table or .json with all numbers')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.index:
+        index = AnnotationIndex.load(args.index)
+    elif args.csv:
+        index = load_csv(args.csv, args.img_dir, args.set)
+    else:
+        index, _, _ = build_index(args.xml_dir, args.img_dir, workers=args.workers)
+    paths = [str(p) for p in index.image_paths[:args.limit]]
+    registry = ModelRegistry(args.model_dir)
+    names = args.models or sorted(registry.models)
+    # Unknown names fail here, with the list of known models, not in a worker
+    labels = {name: registry.get(name).labels for name in names}
+
+    workers = args.workers or os.cpu_count() or 1
+    chunksize = max(1, min(64, len(paths) // (4 * workers)))
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(args.model_dir, names)) as pool:
+        per_image = list(pool.map(_detect, paths, chunksize=chunksize))
+
+    results = {}
+    for m, name in enumerate(names):
+        detections = [image_results[m] for image_results in per_image]
+        latencies = np.array([d[3] for d in detections])
+        result = evaluate(index, detections, labels[name], args.iou)
+        result['latency_ms'] = {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90))
+        }
+        result['map_per_100ms'] = (0.0 if np.isnan(result['map'])
+                                   else result['map'] / latencies.mean() * 100)
+        results[name] = result
+    write_report(results, args.report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Pascal VOC データセットの索引と各形式への変換
+#
+# 使い方:
+#   python3 voc_dataset.py index  --xml-dir ./ --img-dir ./ --index dataset.npz
+#   python3 voc_dataset.py export --index dataset.npz --format coco --output coco.json
+#   python3 voc_dataset.py stats  --index dataset.npz
+#
+# XMLは一度だけ解析して列形式の索引 (NumPy の .npz) に保存する。二回目以降は
+# 更新日時が変わったファイルだけを解析し直す。変換と統計は索引だけから作るので、
+# XMLや画像を読み直す必要はない。解析エラーも索引に残すので、ファイルを直すまで
+# 毎回報告される (終了コードも 1 のまま)。
+
+import argparse
+import json
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from voc_to_csv import IMAGE_EXTENSIONS, index_files, parse_annotation, split_name
+
+EXPORT_FORMATS = ('automl', 'coco', 'yolo', 'tfrecord-csv')
+
+
+#---------------------------------------------------------------------
+# 索引 (ファイルごとの列と、バウンディングボックスごとの列)
+#---------------------------------------------------------------------
+class AnnotationIndex:
+    """
+    Columnar annotation index.
+
+    Per file: stems, image_paths, mtimes, widths, heights, box_counts and
+    errors (the file's parse errors joined by newlines, empty when none, so
+    an incremental run reports them again until the file is fixed).
+    Per box: boxes (xmin, ymin, xmax, ymax in pixels), labels (index into
+    classes) and files (index into the per-file columns).
+    """
+
+    def __init__(self, stems=(), image_paths=(), mtimes=(), widths=(), heights=(),
+                 box_counts=(), boxes=None, labels=(), classes=(), errors=()):
+        self.stems = np.asarray(stems, dtype=str)
+        self.image_paths = np.asarray(image_paths, dtype=str)
+        self.mtimes = np.asarray(mtimes, dtype=np.float64)
+        self.widths = np.asarray(widths, dtype=np.int32)
+        self.heights = np.asarray(heights, dtype=np.int32)
+        self.box_counts = np.asarray(box_counts, dtype=np.int32)
+        self.boxes = np.zeros((0, 4), np.float32) if boxes is None else \
+            np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.labels = np.asarray(labels, dtype=np.int32)
+        self.classes = np.asarray(classes, dtype=str)
+        # Indexes saved before errors were kept have none
+        self.errors = np.asarray(errors, dtype=str) if len(errors) else \
+            np.full(len(self.stems), '', dtype=str)
+        self.files = np.repeat(np.arange(len(self.stems), dtype=np.int32), self.box_counts)
+
+    def __len__(self):
+        return len(self.stems)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    def save(self, path):
+        np.savez_compressed(path, stems=self.stems, image_paths=self.image_paths,
+                            mtimes=self.mtimes, widths=self.widths, heights=self.heights,
+                            box_counts=self.box_counts, boxes=self.boxes,
+                            labels=self.labels, classes=self.classes, errors=self.errors)
+
+    def file_boxes(self):
+        """Yields (file index, boxes, labels) using the box offsets."""
+        offsets = np.concatenate([[0], np.cumsum(self.box_counts)])
+        for i in range(len(self)):
+            yield i, self.boxes[offsets[i]:offsets[i + 1]], self.labels[offsets[i]:offsets[i + 1]]
+
+
+def _parse(path):
+    """Worker: returns (path, mtime, width, height, boxes, names, errors)."""
+    mtime = os.path.getmtime(path)
+    filename, width, height, objects, errors = parse_annotation(path)
+    try:
+        width, height = int(width), int(height)
+    except (TypeError, ValueError):
+        errors.append('画像サイズが不正です')
+        width = height = 0
+    boxes, names = [], []
+    for j, obj in enumerate(objects):
+        try:
+            xmin, ymin, xmax, ymax = (float(obj[field]) for field in ('xmin', 'ymin', 'xmax', 'ymax'))
+        except (KeyError, ValueError):
+            errors.append('object %d のデータが不正です' % j)
+            continue
+        if not (0 <= xmin < xmax <= width and 0 <= ymin < ymax <= height) or 'name' not in obj:
+            errors.append('object %d の座標が画像の範囲外です' % j)
+            continue
+        boxes.append([xmin, ymin, xmax, ymax])
+        names.append(obj['name'])
+    return path, mtime, width, height, boxes, names, errors
+
+
+def build_index(xml_dir, img_dir, previous=None, workers=None):
+    """
+    Builds an AnnotationIndex, reusing entries of `previous` whose XML file
+    has not been modified since. Returns (index, parsed count, errors).
+    """
+    annotations = index_files(xml_dir, ('.xml',))
+    images = index_files(img_dir, IMAGE_EXTENSIONS)
+    errors = []
+
+    # 前回の索引から変更のないファイルを再利用する
+    reuse = {}
+    if previous is not None:
+        for i, boxes, labels in previous.file_boxes():
+            reuse[str(previous.stems[i])] = (i, boxes, previous.classes[labels])
+
+    entries = {}
+    stale = []
+    for stem, path in annotations.items():
+        if stem not in images:
+            errors.append((path, ['対応する画像ファイルが見つかりませんでした']))
+            continue
+        if stem in reuse and previous.mtimes[reuse[stem][0]] == os.path.getmtime(path):
+            i, boxes, names = reuse[stem]
+            messages = str(previous.errors[i]).split('\n') if previous.errors[i] else []
+            if messages:
+                errors.append((path, messages))
+            entries[stem] = (previous.widths[i], previous.heights[i], boxes, list(names), messages)
+        else:
+            stale.append(path)
+
+    if stale:
+        workers = workers or os.cpu_count() or 1
+        chunksize = max(1, min(256, len(stale) // (4 * workers)))
+        with ProcessPoolExecutor(workers) as pool:
+            for path, mtime, width, height, boxes, names, file_errors in \
+                    pool.map(_parse, stale, chunksize=chunksize):
+                if file_errors:
+                    errors.append((path, file_errors))
+                stem = os.path.splitext(os.path.basename(path))[0]
+                entries[stem] = (width, height, boxes, names, file_errors)
+
+    stems = sorted(entries)
+    classes = sorted({name for stem in stems for name in entries[stem][3]})
+    class_ids = {name: i for i, name in enumerate(classes)}
+    boxes = [np.asarray(entries[stem][2], np.float32).reshape(-1, 4) for stem in stems]
+    index = AnnotationIndex(
+        stems=stems,
+        image_paths=[images[stem] for stem in stems],
+        mtimes=[os.path.getmtime(annotations[stem]) for stem in stems],
+        widths=[entries[stem][0] for stem in stems],
+        heights=[entries[stem][1] for stem in stems],
+        box_counts=[len(b) for b in boxes],
+        boxes=np.concatenate(boxes) if boxes else None,
+        labels=[class_ids[name] for stem in stems for name in entries[stem][3]],
+        classes=classes,
+        errors=['\n'.join(entries[stem][4]) for stem in stems])
+    return index, len(stale), errors
+
+
+#---------------------------------------------------------------------
+# 各形式への書き出し
+#---------------------------------------------------------------------
+def _relative_boxes(index):
+    size = np.stack([index.widths, index.heights, index.widths, index.heights], axis=1)
+    return index.boxes / np.maximum(size[index.files], 1)
+
+
+def export_automl(index, output, gcs_prefix='', digits=2, train=0.8, validate=0.1):
+    relative = np.round(_relative_boxes(index), digits)
+    splits = [split_name(str(stem), train, validate) for stem in index.stems]
+    number = '%.' + str(digits) + 'f'
+    with open(output, 'w') as f:
+        for (xmin, ymin, xmax, ymax), label, i in zip(relative, index.labels, index.files):
+            f.write(('%s,%s%s,%s,' + number + ',' + number + ',,,' + number + ',' + number + ',,\n') % (
+                splits[i], gcs_prefix, os.path.basename(index.image_paths[i]),
+                index.classes[label], xmin, ymin, xmax, ymax))
+
+
+def export_coco(index, output):
+    xy = index.boxes[:, :2]
+    wh = index.boxes[:, 2:] - xy
+    coco = {
+        'images': [{'id': i, 'file_name': os.path.basename(str(path)),
+                    'width': int(w), 'height': int(h)}
+                   for i, (path, w, h) in enumerate(zip(index.image_paths, index.widths, index.heights))],
+        'annotations': [{'id': j, 'image_id': int(i), 'category_id': int(label) + 1,
+                         'bbox': [float(x), float(y), float(w), float(h)],
+                         'area': float(w * h), 'iscrowd': 0}
+                        for j, (i, label, (x, y), (w, h)) in
+                        enumerate(zip(index.files, index.labels, xy, wh))],
+        'categories': [{'id': i + 1, 'name': str(name)} for i, name in enumerate(index.classes)]
+    }
+    with open(output, 'w') as f:
+        json.dump(coco, f)
+
+
+def export_yolo(index, output):
+    """Writes one <stem>.txt per image plus classes.txt into the output folder."""
+    os.makedirs(output, exist_ok=True)
+    relative = _relative_boxes(index)
+    centers = (relative[:, :2] + relative[:, 2:]) / 2
+    sizes = relative[:, 2:] - relative[:, :2]
+    rows = np.column_stack([centers, sizes])
+    offsets = np.concatenate([[0], np.cumsum(index.box_counts)])
+    for i, stem in enumerate(index.stems):
+        with open(os.path.join(output, str(stem) + '.txt'), 'w') as f:
+            for j in range(offsets[i], offsets[i + 1]):
+                f.write('%d %.6f %.6f %.6f %.6f\n' % ((index.labels[j],) + tuple(rows[j])))
+    with open(os.path.join(output, 'classes.txt'), 'w') as f:
+        f.write('\n'.join(str(name) for name in index.classes) + '\n')
+
+
+def export_tfrecord_csv(index, output):
+    """
+    CSV in the layout read by the TensorFlow Object Detection API
+    generate_tfrecord.py script, so no TensorFlow is needed here.
+    """
+    with open(output, 'w') as f:
+        f.write('filename,width,height,class,xmin,ymin,xmax,ymax\n')
+        for (xmin, ymin, xmax, ymax), label, i in zip(index.boxes, index.labels, index.files):
+            f.write('%s,%d,%d,%s,%d,%d,%d,%d\n' % (
+                os.path.basename(index.image_paths[i]), index.widths[i], index.heights[i],
+                index.classes[label], xmin, ymin, xmax, ymax))
+
+
+#---------------------------------------------------------------------
+# 統計 (画像は読まずに索引だけから計算する)
+#---------------------------------------------------------------------
+def statistics(index, bins=(0, 8, 16, 32, 64, 128, 256, 512, 100000)):
+    sizes = np.sqrt(np.prod(np.maximum(index.boxes[:, 2:] - index.boxes[:, :2], 0), axis=1))
+    relative = _relative_boxes(index)
+    aspect = (relative[:, 2] - relative[:, 0]) / np.maximum(relative[:, 3] - relative[:, 1], 1e-6)
+    counts = np.bincount(index.labels, minlength=len(index.classes))
+    return {
+        'images': len(index),
+        'boxes': int(len(index.boxes)),
+        'images_without_boxes': int(np.count_nonzero(index.box_counts == 0)),
+        'class_counts': {str(name): int(c) for name, c in zip(index.classes, counts)},
+        'box_size_histogram': {'bins': list(bins), 'counts': np.histogram(sizes, bins)[0].tolist()},
+        'aspect_ratio_histogram': {
+            'bins': [0, 0.25, 0.5, 1, 2, 4, 1000],
+            'counts': np.histogram(aspect, [0, 0.25, 0.5, 1, 2, 4, 1000])[0].tolist()
+        }
+    }
+
+
+#---------------------------------------------------------------------
+# メイン
+#---------------------------------------------------------------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Pascal VOC dataset index and exporters')
+    parser.add_argument('--index', default='dataset.npz', help='index file')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    index = commands.add_parser('index', help='build or update the index')
+    index.add_argument('--xml-dir', default='./')
+    index.add_argument('--img-dir', default='./')
+    index.add_argument('--workers', type=int, default=None)
+    index.add_argument('--rebuild', action='store_true', help='ignore the existing index')
+
+    export = commands.add_parser('export', help='export the index to another format')
+    export.add_argument('--format', choices=EXPORT_FORMATS, required=True)
+    export.add_argument('--output', required=True, help='file (or folder for yolo)')
+    export.add_argument('--gcs-prefix', default='gs://toy_shovel_car/shovel_pics/')
+    export.add_argument('--split', default='80,10,10', help='TRAIN,VALIDATE,TEST percentages')
+
+    commands.add_parser('stats', help='print class counts and box size histograms')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == 'index':
+        previous = None
+        if os.path.exists(args.index) and not args.rebuild:
+            previous = AnnotationIndex.load(args.index)
+        index, parsed, errors = build_index(args.xml_dir, args.img_dir, previous, args.workers)
+        index.save(args.index)
+        for path, messages in errors:
+            for message in messages:
+                print('Error | ' + message + ': ' + path, file=sys.stderr)
+        print('%d files indexed (%d parsed), %d boxes, %d classes -> %s' % (
+            len(index), parsed, len(index.boxes), len(index.classes), args.index))
+        return 1 if errors else 0
+
+    index = AnnotationIndex.load(args.index)
+    if args.command == 'stats':
+        print(json.dumps(statistics(index), indent=2, ensure_ascii=False))
+    elif args.format == 'automl':
+        train, validate, _ = (float(p) / 100 for p in args.split.split(','))
+        export_automl(index, args.output, args.gcs_prefix, train=train, validate=validate)
+    elif args.format == 'coco':
+        export_coco(index, args.output)
+    elif args.format == 'yolo':
+        export_yolo(index, args.output)
+    else:
+        export_tfrecord_csv(index, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
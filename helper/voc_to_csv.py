@@ -1,221 +1,231 @@
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # オープンデータをGoogle AutoMLで利用できるようにする
 # (PascalVoc形式 XML から Google AutoML 用のCSVを作成する)
-
-#---------------------------------------------------------------------
-# ユーザー設定値
-#---------------------------------------------------------------------
-
-# フォルダパス (ローカルPC内で PascalVoc形式XMLが格納されているフォルダ)
-from tkinter import Tk, messagebox
-import xml.etree.ElementTree as ET
-import itertools
-import glob
-import os.path
+#
+# 使い方:
+#   python3 voc_to_csv.py --xml-dir ./ --img-dir ./ \
+#       --gcs-prefix gs://toy_shovel_car/shovel_pics/ --output AutoMLVision.csv
+#
+# 画像とアノテーションはファイル名(拡張子なし)で対応付け、XMLはプロセスプールで
+# 並列に解析し、CSVは一行ずつディスクへ書き出す。エラーは処理を止めずに最後に報告する。
+
+import argparse
+import functools
+import hashlib
+import os
 import sys
-xmlFolderPath = './'
-
-# フォルダパス (ローカルPC内で 画像ファイルが格納されているフォルダ)
-imgFolderPath = './'
-
-# フォルダパス (GoogleCloudStorage内で、画像ファイルを格納しているフォルダ)
-imgFolderPath_gs = 'gs://toy_shovel_car/shovel_pics/'
+import xml.etree.ElementTree as ET
 
-# CSV出力パス
-outputCSVpath = 'AutoMLVision.csv'
+from concurrent.futures import ProcessPoolExecutor
 
-# CSV出力時の座標の桁数 (小数点以下何桁まで出力するか)
-roundDigit = 2
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+BOX_FIELDS = ('xmin', 'ymin', 'xmax', 'ymax')
 
 
 #---------------------------------------------------------------------
-# ライブラリの読み込み
+# ファイルの索引 (拡張子なしのファイル名 -> パス)
 #---------------------------------------------------------------------
+def index_files(folder, extensions):
+    index = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            if entry.is_file() and ext.lower() in extensions:
+                index[stem] = entry.path
+    return index
 
 
 #---------------------------------------------------------------------
-# メッセージボックスの表示
+# データの区分 (ファイル名のハッシュで決まるので、ファイルの順番に依存しない)
 #---------------------------------------------------------------------
-def MBox(msg):
-
-	# Tkを定義
-	root = Tk()
-	root.withdraw()  # Tkのrootウインドウを表示しない
-
-	# コンソール表示
-	print('\n' + msg + '\n')
-
-	# メッセージボックスの表示
-	messagebox.showerror(os.path.basename(__file__), msg)
+def split_name(stem, train=0.8, validate=0.1):
+    digest = hashlib.md5(stem.encode('utf-8')).digest()
+    position = int.from_bytes(digest[:8], 'big') / 2 ** 64
+    if position < train:
+        return 'TRAIN'
+    if position < train + validate:
+        return 'VALIDATE'
+    return 'TEST'
 
 
 #---------------------------------------------------------------------
-# エラー終了 (コンソールとメッセージボックスでエラー内容を通知して終了)
+# アノテーションファイルの読み取り (iterparseで一回だけ走査する)
 #---------------------------------------------------------------------
-def ErrorEnd(msg):
-
-    # メッセージボックスを表示
-	MBox(msg)
-
-	# プロセス終了
-	sys.exit()
+def parse_annotation(path):
+    """Returns (filename, width, height, objects, errors) of one VOC file."""
+    filename = width = height = None
+    objects = []
+    errors = []
+    stack = []
+    obj = None
+    try:
+        for event, elem in ET.iterparse(path, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem.tag)
+                if elem.tag == 'object':
+                    obj = {}
+                continue
+            stack.pop()
+            parent = stack[-1] if stack else None
+            text = (elem.text or '').strip()
+            if elem.tag == 'filename' and parent == 'annotation':
+                filename = text
+            elif elem.tag in ('width', 'height') and parent == 'size':
+                if elem.tag == 'width':
+                    width = text
+                else:
+                    height = text
+            elif obj is not None and elem.tag == 'name' and parent == 'object':
+                obj['name'] = text
+            elif obj is not None and elem.tag in BOX_FIELDS and parent == 'bndbox':
+                obj[elem.tag] = text
+            elif elem.tag == 'object':
+                objects.append(obj)
+                obj = None
+                elem.clear()
+    except ET.ParseError as e:
+        errors.append('XMLファイルを解析できません (%s)' % e)
+        return filename, width, height, objects, errors
+
+    if filename is None:
+        errors.append('annotation/filename が見つかりませんでした')
+    if width is None:
+        errors.append('annotation/size/width が見つかりませんでした')
+    if height is None:
+        errors.append('annotation/size/height が見つかりませんでした')
+    return filename, width, height, objects, errors
 
 
 #---------------------------------------------------------------------
-# メイン
+# 一つのアノテーションファイルを CSV 行に変換 (ワーカープロセスで実行)
 #---------------------------------------------------------------------
-print('--- Process Start --------------------------------')
-
-# フォルダの存在確認 (アノテーションファイル格納フォルダ)
-xmlFolderPath = os.path.abspath(xmlFolderPath)
-if(os.path.exists(xmlFolderPath) == False):
-    ErrorEnd('Error | 指定された入力フォルダが存在しません: ' + xmlFolderPath)
-
-# フォルダの存在確認 (画像格納フォルダ)
-imgFolderPath = os.path.abspath(imgFolderPath)
-if(os.path.exists(imgFolderPath) == False):
-    ErrorEnd('Error | 指定された入力フォルダが存在しません: ' + imgFolderPath)
-
-# ファイル数の一致を確認 (アノテーションファイルと画像ファイル)
-anoFilePaths = glob.glob(xmlFolderPath + '/*.xml')
-imgFilePaths = glob.glob(imgFolderPath + '/*.jpg')
-if(len(anoFilePaths) != len(imgFilePaths)):
-    s = 'Error | アノテーションファイルと画像ファイルの数が一致していません'
-    s = s + '\n' + str(len(anoFilePaths)) + ' Annotation Files'
-    s = s + '\n' + str(len(anoFilePaths)) + ' Image Files'
-    ErrorEnd(s)
-
-# ファイルの対応を確認 (# アノテーションファイル名が AAA.xml の場合、AAA.jpgという画像があるか確認)
-for i in range(len(anoFilePaths)):
-    n1 = os.path.basename(anoFilePaths[i])
-    n1 = os.path.splitext(n1)[0]
-    for j in range(len(imgFilePaths)):
-        n2 = os.path.basename(imgFilePaths[j])
-        n2 = os.path.splitext(n2)[0]
-        if(n1 == n2):
-            b = True
-            break
-    else:
-        ErrorEnd('Error | アノテーションファイルに対応する画像ファイルが見つかりませんでした: ' + n1 + '.xml')
-
-# アノテーションファイルの読み取り
-outputLines = []
-for i, anoFilePath in enumerate(anoFilePaths):
-
-    # アノテーションファイルのパス取得
-    anoFilePath = os.path.abspath(anoFilePath)
-    print(str(i) + '/' + str(len(anoFilePaths)) + ': ' + anoFilePath)
-
-    # アノテーションファイルを開く
-    anoFile = open(anoFilePath)
-
-    # アノテーションファイル内のデータを取得 (ルート要素)
-    anoRoot = (ET.parse(anoFile)).getroot()
-
-    # アノテーションファイル内のデータを取得 (画像ファイル名、横幅、縦幅)
-    imgFileName = anoRoot.find('filename')
-    width = anoRoot.find('size/width')
-    height = anoRoot.find('size/height')
-
-    if imgFileName is None:
-        ErrorEnd('Error | XMLファイル内で annotation/filename が見つかりませんでした' + anoFilePath)
-    if imgFileName is None:
-        ErrorEnd('Error | XMLファイル内で annotation/size/width が見つかりませんでした' + anoFilePath)
-    if imgFileName is None:
-        ErrorEnd(
-            'Error | XMLファイル内で annotation/size/height が見つかりませんでした' + anoFilePath)
-
-    imgFileName = imgFileName.text
-    width = width.text
-    height = height.text
-
-    # path要素からファイル名を取得するパターン (filenameに拡張子が記載されていない時のための処理)
-    #imgFileName = anoRoot.find('path')
-    #if imgFileName is None :
-    #    ErrorEnd('Error | XMLファイル内で annotation/path が見つかりませんでした' + anoFilePath)
-    #imgFileName = os.path.basename(imgFileName)
+def convert(path, gcs_prefix, digits, train, validate):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    filename, width, height, objects, errors = parse_annotation(path)
+    rows = []
+    if errors:
+        return path, rows, errors
 
     # アノテーションファイル名が AAA.xml の場合、ファイル内にAAA.jpgと書いてあることを確認
-    if(os.path.splitext(os.path.basename(anoFilePath))[0] != os.path.splitext(os.path.basename(imgFileName))[0]):
-        ErrorEnd(
-            'Error | XMLファイル名と XMLファイル内に書き込まれている画像ファイルの名称が一致していません' + anoFilePath)
-
-    # アノテーションファイル内のデータを取得 (オブジェクト)
-    for j, obj in enumerate(anoRoot.iter('object')):
-
-        # アノテーションファイル内のデータを取得 (各オブジェクトのタグ・左上座標・右下座標)
-        label = obj.find('name')
-        xMin = obj.find('bndbox/xmin')
-        yMin = obj.find('bndbox/ymin')
-        xMax = obj.find('bndbox/xmax')
-        yMax = obj.find('bndbox/ymax')
-
-        if label is None:
-            ErrorEnd(
-            	'Error | XMLファイル内に object/name が存在しないオブジェクトが存在します' + anoFilePath)
-        if xMin is None:
-            ErrorEnd(
-            	'Error | XMLファイル内に object/bndbox/xmin が存在しないオブジェクトが存在します' + anoFilePath)
-        if yMin is None:
-            ErrorEnd(
-            	'Error | XMLファイル内に object/bndbox/ymin が存在しないオブジェクトが存在します' + anoFilePath)
-        if xMax is None:
-            ErrorEnd(
-            	'Error | XMLファイル内に object/bndbox/xmax が存在しないオブジェクトが存在します' + anoFilePath)
-        if yMax is None:
-            ErrorEnd(
-            	'Error | XMLファイル内に object/bndbox/ymax が存在しないオブジェクトが存在します' + anoFilePath)
-
-        label = label.text
-        xMin = xMin.text
-        yMin = yMin.text
-        xMax = xMax.text
-        yMax = yMax.text
+    if os.path.splitext(os.path.basename(filename))[0] != stem:
+        return path, rows, ['XMLファイル名と XMLファイル内の画像ファイル名が一致していません: ' + filename]
+    try:
+        width, height = int(width), int(height)
+    except ValueError:
+        return path, rows, ['画像サイズが数値ではありません']
+    if width <= 0 or height <= 0:
+        return path, rows, ['画像サイズが不正です']
+
+    dataset = split_name(stem, train, validate)
+    number = '{0:.' + str(digits) + 'f}'
+    for j, obj in enumerate(objects):
+        missing = [field for field in ('name',) + BOX_FIELDS if not obj.get(field)]
+        if missing:
+            errors.append('object %d に %s が存在しません' % (j, ', '.join(missing)))
+            continue
+        try:
+            xmin, ymin, xmax, ymax = (float(obj[field]) for field in BOX_FIELDS)
+        except ValueError:
+            errors.append('object %d の座標が数値ではありません' % j)
+            continue
 
         # 座標変換 (Pascal Voc形式 から AutoML Vision形式へ)
-        xMinRatio = round(int(xMin) / int(width),  roundDigit)
-        yMinRatio = round(int(yMin) / int(height), roundDigit)
-        xMaxRatio = round(int(xMax) / int(width),  roundDigit)
-        yMaxRatio = round(int(yMax) / int(height), roundDigit)
-
-        # データの区分を設定 (アノテーションファイルの80%はテスト用、10%はバリデーション用、10%はテスト用)
-        datasetName = 'TRAIN'
-        if (0.8 < (i/len(anoFilePaths))):
-            datasetName = 'VALIDATE'
-        if (0.9 < (i/len(anoFilePaths))):
-            datasetName = 'TEST'
-
-        # 出力文字列の作成 (AutoML Vision形式)
-        formatString = '{0:.' + str(roundDigit) + 'f}'
-        sOutput = datasetName
-        sOutput = sOutput + ',' + imgFolderPath_gs + imgFileName
-        sOutput = sOutput + ',' + label
-        sOutput = sOutput + ',' + formatString.format(xMinRatio)
-        sOutput = sOutput + ',' + formatString.format(yMinRatio)
-        sOutput = sOutput + ',,'
-        sOutput = sOutput + ',' + formatString.format(xMaxRatio)
-        sOutput = sOutput + ',' + formatString.format(yMaxRatio)
-        sOutput = sOutput + ',,'
-        outputLines.append(sOutput)
+        ratios = [round(xmin / width, digits), round(ymin / height, digits),
+                  round(xmax / width, digits), round(ymax / height, digits)]
+        if not all(0 <= r <= 1 for r in ratios) or xmin >= xmax or ymin >= ymax:
+            errors.append('object %d の座標が画像の範囲外です' % j)
+            continue
 
         # 出力文字列の例
         # set,path,label,x_min,y_min,,,x_max,y_max,,
-        # TRAIN,gs://cloud-ml-data/img/openimage/2851/11476419305_7b73a0128c_o.jpg,Baked goods,0.56,0.25,,,0.97,0.50,,
-
-    # アノテーションファイルを閉じる
-    anoFile.close()
-
-# ファイル出力 (AutoML Vision形式CSV)
-outputCSVpath = os.path.abspath(outputCSVpath)
-try:
-    with open(outputCSVpath, mode='w') as f:
-        for line in outputLines:
-            f.write(line + '\n')
-except Exception as e:
-    ErrorEnd('Error | ファイル出力に失敗しました: ' + str(e))
-
-# 終了通知
-MBox('正常終了しました。\n出力ファイル: ' + outputCSVpath)
+        rows.append('%s,%s%s,%s,%s,%s,,,%s,%s,,' % (
+            dataset, gcs_prefix, filename, obj['name'],
+            number.format(ratios[0]), number.format(ratios[1]),
+            number.format(ratios[2]), number.format(ratios[3])))
+    return path, rows, errors
+
+
+#---------------------------------------------------------------------
+# メイン
+#---------------------------------------------------------------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert Pascal VOC annotations to a Google AutoML Vision CSV')
+    parser.add_argument('--xml-dir', default='./',
+                        help='folder with the Pascal VOC XML files')
+    parser.add_argument('--img-dir', default='./',
+                        help='folder with the image files')
+    parser.add_argument('--gcs-prefix', default='gs://toy_shovel_car/shovel_pics/',
+                        help='Google Cloud Storage folder holding the images')
+    parser.add_argument('--output', default='AutoMLVision.csv',
+                        help='CSV file to write')
+    parser.add_argument('--digits', type=int, default=2,
+                        help='decimal digits of the coordinates')
+    parser.add_argument('--split', default='80,10,10',
+                        help='TRAIN,VALIDATE,TEST percentages')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of parser processes (default: CPU count)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print('--- Process Start --------------------------------')
+
+    # フォルダの存在確認
+    for folder in (args.xml_dir, args.img_dir):
+        if not os.path.isdir(folder):
+            print('Error | 指定された入力フォルダが存在しません: ' + os.path.abspath(folder))
+            return 2
+
+    train, validate, test = (float(p) / 100 for p in args.split.split(','))
+    if abs(train + validate + test - 1) > 1e-6:
+        print('Error | --split の合計が100になりません: ' + args.split)
+        return 2
+
+    # ファイルの対応を確認 (AAA.xml に対して AAA.jpg があるか)
+    annotations = index_files(args.xml_dir, ('.xml',))
+    images = index_files(args.img_dir, IMAGE_EXTENSIONS)
+    errors = []
+    paths = []
+    for stem, path in sorted(annotations.items()):
+        if stem in images:
+            paths.append(path)
+        else:
+            errors.append((path, ['対応する画像ファイルが見つかりませんでした']))
+    for stem in images.keys() - annotations.keys():
+        errors.append((images[stem], ['対応するアノテーションファイルがありません']))
+
+    # XMLを並列に解析し、結果が届いた順にCSVへ書き出す
+    worker = functools.partial(convert, gcs_prefix=args.gcs_prefix, digits=args.digits,
+                               train=train, validate=validate)
+    row_count = 0
+    output = os.path.abspath(args.output)
+    workers = args.workers or os.cpu_count() or 1
+    chunksize = max(1, min(256, len(paths) // (4 * workers)))
+    with open(output, mode='w') as f, ProcessPoolExecutor(workers) as pool:
+        for i, (path, rows, file_errors) in enumerate(pool.map(worker, paths, chunksize=chunksize)):
+            for row in rows:
+                f.write(row + '\n')
+            row_count += len(rows)
+            if file_errors:
+                errors.append((path, file_errors))
+            if (i + 1) % 1000 == 0:
+                print(str(i + 1) + '/' + str(len(paths)))
+
+    # エラー報告 (処理は止めずに最後にまとめて出力する)
+    for path, messages in errors:
+        for message in messages:
+            print('Error | ' + message + ': ' + path, file=sys.stderr)
+
+    print('%d files, %d rows, %d files with errors' % (len(paths), row_count, len(errors)))
+    print('出力ファイル: ' + output)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
 
 #---------------------------------------------------------------------
 # End
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load, soak and fuzz test for motor_node.
+
+Starts a motor node in a child process, with the motor shield simulated by
+SimGPIO so it runs anywhere, and drives it with a number of clients. Every
+client sends a mix of commands at a fixed rate (or as fast as the acks come
+back) and injects faults into a share of its sends:
+
+    split       one message over several TCP sends
+    coalesce    several messages in one send
+    malformed   garbage, cut off JSON, unknown actions, bad values and leases
+    disconnect  half a message, then the connection is dropped
+
+Every message must get exactly one reply: "ok" for good commands and an
+error for bad ones. Throughput, ack latency percentiles and the node's
+memory (RSS) are reported as it runs; a long --duration makes it a soak
+test. Exits with 1 on a wrong or missing reply, or when the node drops a
+connection or dies.
+
+    python3 load_test.py --clients 4 --rate 50 --duration 60 --faults 0.2
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from SimGPIO import SimGPIO
+from Transport import connect, unix_path
+
+COMMANDS = {
+    'heartbeat': {"action": "heartbeat", "value": "0"},
+    # What Explorer sends: the motor runs until the lease runs out
+    'lease': {"action": "left", "value": "1", "lease": 0.5},
+    # Stopping waits for the motors to settle, so it is slow on purpose
+    'stop': {"action": "stop", "value": "0"}
+}
+
+# Well formed JSON the node must still refuse
+INVALID = [
+    b'[1, 2, 3]',
+    b'"left"',
+    b'{"value": "1"}',
+    b'{"action": "fly", "value": "1"}',
+    b'{"action": ["left"], "value": "1"}',
+    b'{"action": "left", "value": "soon"}',
+    b'{"action": "left", "value": "99999"}',
+    b'{"action": "left", "value": "-1"}',
+    b'{"action": "left", "value": "1", "lease": "NaN"}',
+    b'{"action": "left", "value": "1", "lease": -2}',
+    b'{"action": "grab", "value": {"distance": 500, "speed": 2}}'
+]
+
+FAULTS = ('split', 'coalesce', 'malformed', 'disconnect')
+REPLY_TIMEOUT = 5.0  # seconds, longer than any command in the mix takes
+
+
+def encode(command):
+    return (json.dumps(command) + '\n').encode('utf-8')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss(pid):
+    """Resident memory of a process in bytes, None when it is gone."""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def run_node(port, ready):
+    """Child process: a motor node on the simulated shield."""
+    SimGPIO().install()
+    # The node prints every command it runs
+    sys.stdout = open(os.devnull, 'w')
+    from Excavator import Excavator
+    from motor_node import MotorNode, build_instructions
+    from Watchdog import Watchdog
+
+    excavator = Excavator()
+    watchdog = Watchdog(excavator)
+    watchdog.start()
+    MotorNode.PORT = port
+    node = MotorNode()
+    ready.set()
+    node.listen_commands(build_instructions(excavator), watchdog)
+
+
+class LatencyHistogram:
+    """Log-spaced latency buckets (1% wide), constant memory however long it runs."""
+    RESOLUTION = math.log(1.01)
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = max(seconds * 1e6, 1.0)
+        bucket = int(math.log(micros) / self.RESOLUTION)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Latency in seconds below which a share `q` of the samples fall."""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= q * self.count:
+                return math.exp((bucket + 1) * self.RESOLUTION) / 1e6
+        return 0.0
+
+
+class Client(threading.Thread):
+    def __init__(self, index, port, options, deadline):
+        super().__init__(name='client-%d' % index, daemon=True)
+        self.port = port
+        self.options = options
+        self.deadline = deadline
+        self.rng = random.Random(options.seed * 1000 + index)
+        self.mix = [name for name, weight in options.mix for _ in range(weight)]
+        self.lock = threading.Lock()
+        self.latency = LatencyHistogram()
+        self.counts = dict.fromkeys(('commands', 'ok', 'errors', 'wrong', 'missing',
+                                     'dropped', 'reconnects') + FAULTS, 0)
+        self.conn = None
+        self.buffer = b''
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def take(self):
+        """Counters and latencies since the last call, reset for the next interval."""
+        with self.lock:
+            counts, latency = self.counts, self.latency
+            self.counts = dict.fromkeys(counts, 0)
+            self.latency = LatencyHistogram()
+        return counts, latency
+
+    def connect(self):
+        if self.conn is not None:
+            self.conn.close()
+        if self.options.shm:
+            self.conn = connect('127.0.0.1', self.port)
+        else:
+            self.conn = socket.create_connection(('127.0.0.1', self.port))
+            # Each send goes out as its own segment, so splits stay split
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conn.settimeout(REPLY_TIMEOUT)
+        self.buffer = b''
+
+    def message(self):
+        """(bytes, ok expected) of one good command from the mix."""
+        return encode(COMMANDS[self.rng.choice(self.mix)]), True
+
+    def malformed(self):
+        kind = self.rng.randrange(3)
+        if kind == 0:
+            # Printable and binary garbage, without whitespace or newlines
+            data = bytes(self.rng.randrange(33, 256) for _ in range(self.rng.randrange(1, 200)))
+        elif kind == 1:
+            data = self.message()[0]
+            data = data[:self.rng.randrange(1, len(data) - 1)]
+        else:
+            data = self.rng.choice(INVALID)
+        return data + b'\n', False
+
+    def replies(self, count):
+        """Reads `count` reply lines."""
+        lines = []
+        while len(lines) < count:
+            while b'\n' not in self.buffer:
+                data = self.conn.recv(4096)
+                if not data:
+                    raise ConnectionError("closed by the node")
+                self.buffer += data
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            lines.append(line)
+        return lines
+
+    def send(self):
+        fault = None
+        if self.rng.random() < self.options.faults:
+            fault = self.rng.choice(self.options.fault_types)
+        if fault == 'disconnect':
+            data = self.message()[0]
+            self.conn.sendall(data[:self.rng.randrange(1, len(data) - 1)])
+            self._count('disconnect')
+            self.connect()
+            return 0
+        if fault == 'coalesce':
+            batch = [self.message() if self.rng.random() < 0.8 else self.malformed()
+                     for _ in range(self.rng.randrange(2, 6))]
+        elif fault == 'malformed':
+            batch = [self.malformed()]
+        else:
+            batch = [self.message()]
+        if fault is not None:
+            self._count(fault)
+
+        sent = time.perf_counter()
+        data = b''.join(message for message, _ in batch)
+        if fault == 'split':
+            cuts = sorted(self.rng.sample(range(1, len(data)), min(len(data) - 1, self.rng.randrange(1, 4))))
+            for start, end in zip([0] + cuts, cuts + [len(data)]):
+                self.conn.sendall(data[start:end])
+                time.sleep(0.001)
+        else:
+            self.conn.sendall(data)
+        lines = self.replies(len(batch))
+        latency = time.perf_counter() - sent
+
+        with self.lock:
+            for (_, expect_ok), line in zip(batch, lines):
+                self.counts['commands'] += 1
+                self.latency.record(latency)
+                ok = line == b'ok'
+                self.counts['ok' if ok else 'errors'] += 1
+                if ok != expect_ok or (not ok and not line.startswith(b'error: ')):
+                    self.counts['wrong'] += 1
+                    if self.options.verbose:
+                        print("Wrong reply %r to %r" % (line, batch))
+        return len(batch)
+
+    def run(self):
+        period = 1.0 / self.options.rate if self.options.rate else 0.0
+        next_send = time.perf_counter()
+        self.connect()
+        while time.perf_counter() < self.deadline:
+            try:
+                sent = self.send()
+            except socket.timeout:
+                self._count('missing')
+                self._count('reconnects')
+                self.connect()
+                continue
+            except (ConnectionError, OSError):
+                self._count('dropped')
+                self._count('reconnects')
+                time.sleep(0.1)
+                self.connect()
+                continue
+            if period:
+                next_send += period * max(sent, 1)
+                time.sleep(max(0.0, next_send - time.perf_counter()))
+        self.conn.close()
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in COMMANDS:
+            raise argparse.ArgumentTypeError("unknown command %r, use %s" % (name, ', '.join(COMMANDS)))
+        mix.append((name, int(weight or 1)))
+    return mix
+
+
+def parse_faults(text):
+    faults = [name for name in text.split(',') if name]
+    for name in faults:
+        if name not in FAULTS:
+            raise argparse.ArgumentTypeError("unknown fault %r, use %s" % (name, ', '.join(FAULTS)))
+    return faults
+
+
+def report(elapsed, interval, counts, latency, memory):
+    print("[%5.0fs] %6d commands %7.1f/s  ack p50 %.2fms p99 %.2fms max %.2fms  "
+          "errors %d wrong %d missing %d dropped %d  node RSS %.1f MB"
+          % (elapsed, counts['commands'], counts['commands'] / max(interval, 1e-9),
+             latency.percentile(0.5) * 1000, latency.percentile(0.99) * 1000, latency.max * 1000,
+             counts['errors'], counts['wrong'], counts['missing'], counts['dropped'],
+             (memory or 0) / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--clients', type=int, default=2)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='messages per second per client, 0 sends on every ack')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('heartbeat=7,lease=3'),
+                        help='command=weight list from %s' % ', '.join(COMMANDS))
+    parser.add_argument('--faults', type=float, default=0.1,
+                        help='share of sends with a fault injected')
+    parser.add_argument('--fault-types', type=parse_faults, default=list(FAULTS),
+                        help='comma separated, from %s' % ', '.join(FAULTS))
+    parser.add_argument('--report-every', type=float, default=5.0, help='seconds')
+    parser.add_argument('--shm', action='store_true',
+                        help='connect over shared memory instead of TCP')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    if not args.fault_types:
+        args.faults = 0.0
+
+    port = free_port()
+    ready = multiprocessing.Event()
+    node = multiprocessing.Process(target=run_node, args=(port, ready), daemon=True)
+    node.start()
+    if not ready.wait(10):
+        print("Motor node did not start")
+        return 1
+    # Lets the node get to accept()
+    time.sleep(0.2)
+
+    start = time.perf_counter()
+    clients = [Client(i, port, args, start + args.duration) for i in range(args.clients)]
+    for client in clients:
+        client.start()
+
+    totals = dict.fromkeys(clients[0].counts, 0)
+    latency = LatencyHistogram()
+    first_memory = None
+    last = start
+    while any(client.is_alive() for client in clients):
+        for client in clients:
+            client.join(max(0.0, last + args.report_every - time.perf_counter()))
+        now = time.perf_counter()
+        interval_counts = dict.fromkeys(totals, 0)
+        interval_latency = LatencyHistogram()
+        for client in clients:
+            counts, histogram = client.take()
+            for name, value in counts.items():
+                interval_counts[name] += value
+            interval_latency.merge(histogram)
+        for name, value in interval_counts.items():
+            totals[name] += value
+        latency.merge(interval_latency)
+        memory = rss(node.pid)
+        # The first interval warms up allocators and caches
+        if first_memory is None:
+            first_memory = (memory, totals['commands'])
+        report(now - start, now - last, interval_counts, interval_latency, memory)
+        last = now
+        if not node.is_alive():
+            break
+
+    elapsed = time.perf_counter() - start
+    alive = node.is_alive()
+    memory = rss(node.pid) if alive else None
+    node.terminate()
+    node.join()
+    if os.path.exists(unix_path(port)):
+        os.unlink(unix_path(port))
+
+    print()
+    print("%d clients, %.0fs: %d commands, %.1f/s"
+          % (args.clients, elapsed, totals['commands'], totals['commands'] / elapsed))
+    print("Ack latency: p50 %.2fms, p90 %.2fms, p99 %.2fms, p99.9 %.2fms, max %.2fms"
+          % (tuple(latency.percentile(q) * 1000 for q in (0.5, 0.9, 0.99, 0.999)) + (latency.max * 1000,)))
+    print("Faults: " + ", ".join("%s %d" % (name, totals[name]) for name in FAULTS))
+    print("Replies: ok %d, errors %d, wrong %d, missing %d; dropped connections %d"
+          % (totals['ok'], totals['errors'], totals['wrong'], totals['missing'], totals['dropped']))
+    if memory is not None and first_memory[0] is not None:
+        growth = memory - first_memory[0]
+        commands = totals['commands'] - first_memory[1]
+        print("Node memory: %.1f MB after the first interval, %.1f MB at the end (%+.1f KB%s)"
+              % (first_memory[0] / 1e6, memory / 1e6, growth / 1024,
+                 ", %+.1f bytes per 1000 commands" % (growth / commands * 1000)
+                 if commands >= 1000 else ""))
+
+    failed = not alive or totals['wrong'] or totals['missing'] or totals['dropped']
+    if not alive:
+        print("The motor node died")
+    print("FAILED" if failed else "OK")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,107 @@
 #!/usr/bin/env python3
 
 from Excavator import Excavator
+from Profiler import Profiler, stage
+from Telemetry import TelemetryPublisher
+from Transport import Listener
+from Watchdog import Watchdog
+import inspect
 import json
-import socket
 import io
+import threading
+
+# Longest run time in seconds a command may ask for
+MAX_RUN_TIME = max(Excavator.MAX_RUN.values())
+# Longest lease in seconds a client may take
+MAX_LEASE = 60.0
+
+
+class CommandError(ValueError):
+    """A command that cannot be run; the client gets an error reply."""
+
+
+class CommandDecoder:
+    """
+    Splits the byte stream of a connection into commands. TCP may split one
+    message over several reads or merge several into one read. Clients end
+    every message with a newline; objects from clients that do not are
+    still picked up once they are complete.
+    """
+    MAX_MESSAGE = 4096
+
+    def __init__(self):
+        self.buffer = b''
+
+    @staticmethod
+    def parse(line):
+        """The command in one message, or a CommandError if it is not JSON."""
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            return CommandError("malformed message: %s" % e)
+
+    def feed(self, data):
+        """Returns the commands (or CommandErrors) completed by `data`."""
+        self.buffer += data
+        messages = []
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            if line.strip():
+                messages.append(self.parse(line))
+        if self.buffer:
+            messages += self._unterminated()
+        return messages
+
+    def _unterminated(self):
+        messages = []
+        try:
+            text = self.buffer.decode('utf-8')
+        except UnicodeDecodeError:
+            # May end inside a character, wait for the rest
+            text = None
+        if text is not None:
+            decoder = json.JSONDecoder()
+            pos = 0
+            while True:
+                while pos < len(text) and text[pos].isspace():
+                    pos += 1
+                # An object cannot look complete before its closing brace
+                if pos == len(text) or text[pos] != '{':
+                    break
+                try:
+                    obj, pos = decoder.raw_decode(text, pos)
+                except ValueError:
+                    break
+                messages.append(obj)
+            self.buffer = text[pos:].encode('utf-8')
+        if len(self.buffer) > self.MAX_MESSAGE:
+            self.buffer = b''
+            messages.append(CommandError("message longer than %d bytes" % self.MAX_MESSAGE))
+        return messages
+
 
 class MotorNode:
     HOST = "127.0.0.1"  # Standard loopback interface address (localhost)
     PORT = 65432  # Port to listen on (non-privileged ports are > 1023)
-    def __init__(self) -> None:
-        print("Opening socket")
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind((self.HOST, self.PORT))
-        print("Start to listen")
-        self.socket.listen()
-        print("Accepting socket")
+    TELEMETRY_PORT = 65433  # Port streaming motor state back to clients
+    PROFILER_PORT = 65435  # Local port switching the profiler on and off
+    def __init__(self, listen=True) -> None:
+        self.socket = None
+        # One command at a time drives the excavator, whichever client sent it
+        self.lock = threading.Lock()
+        if listen:
+            print("Opening socket")
+            # Listens on TCP and, for clients on this host, on shared memory
+            self.socket = Listener(self.HOST, self.PORT)
+            print("Accepting socket")
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
-            self.socket.close()
+            if self.socket is not None:
+                self.socket.close()
         except RuntimeWarning:
             return True
 
@@ -38,42 +118,167 @@ class MotorNode:
         tiow.close()
         return obj
 
-    def listen_commands(self, instructions):
+    def listen_commands(self, instructions, watchdog=None):
         print("Waiting instructions")
         try:
-            conn, addr = self.socket.accept()
-            print("Connected by", addr)
-            with conn:
-                while True:
-                    self.data = conn.recv(1024)
-                    if not self.data:
-                        break
-                    dict_data = self._binary_to_dict(self.data)        
-                    action = dict_data.get("action")
-                    query = dict_data.get("value")
-                    print("Got instruction from client and going to execute it: ", action)
-                    instructions.get(action)['cmd']()
-                    if bool(instructions.get(action)['exec']):
-                        instructions.get(action)['exec'](int(query))
-                    conn.sendall(b"ok")
+            while True:
+                try:
+                    conn, addr = self.socket.accept()
+                except OSError as e:
+                    # One client failing its handshake must not stop the node
+                    print("Accept failed:", e)
+                    continue
+                print("Connected by", addr)
+                # A client that hangs or reconnects must not lock the others out
+                threading.Thread(target=self._client, args=(conn, addr, instructions, watchdog),
+                                 daemon=True).start()
 
         except KeyboardInterrupt:
             print("caught keyboard interrupt, exiting")
         finally:
             self.socket.close()
 
-excavator = Excavator()
-instructions = {
-    "forward": {'cmd': excavator.move_forward, 'exec': excavator.execute},
-    "backward": {'cmd': excavator.move_backward, 'exec': excavator.execute},
-    "left": {'cmd': excavator.forward_left_chain, 'exec': excavator.execute},
-    "right": {'cmd': excavator.forward_right_chain, 'exec': excavator.execute},
-    "shovel-left": {'cmd': excavator.turn_left_body, 'exec': excavator.execute},
-    "shovel-right": {'cmd': excavator.turn_right_body, 'exec': excavator.execute},
-    "shovel-up": {'cmd': excavator.move_up_shovel, 'exec': excavator.execute},
-    "shovel-down": {'cmd': excavator.move_down_shovel, 'exec': excavator.execute},
-    "stop": {'cmd': excavator.stop_all_motors, 'exec': None}
-}
-
-motor_node = MotorNode()
-motor_node.listen_commands(instructions)
+    def _client(self, conn, addr, instructions, watchdog):
+        try:
+            with conn:
+                self._serve(conn, addr, instructions, watchdog)
+        except OSError as e:
+            print("Connection lost:", e)
+        finally:
+            # Nothing may keep running on behalf of a client that is gone
+            if watchdog is not None:
+                watchdog.release(addr, stop=True)
+
+    def _serve(self, conn, addr, instructions, watchdog):
+        decoder = CommandDecoder()
+        while True:
+            with stage('receive'):
+                data = conn.recv(1024)
+            if not data:
+                break
+            with stage('parse'):
+                commands = decoder.feed(data)
+            # One write for all replies to a read; small writes in a row
+            # wait on Nagle and delayed ACKs
+            replies = [self.reply(command, addr, instructions, watchdog) for command in commands]
+            if replies:
+                with stage('send'):
+                    conn.sendall(b''.join(replies))
+
+    def handle(self, data, addr, instructions, watchdog=None):
+        """Runs one whole command message from client `addr` and returns the reply."""
+        return self.reply(CommandDecoder.parse(data), addr, instructions, watchdog)
+
+    def reply(self, command, addr, instructions, watchdog=None):
+        """Runs a decoded command; bad ones get an error reply instead of an ack."""
+        try:
+            if isinstance(command, CommandError):
+                raise command
+            self.execute(command, addr, instructions, watchdog)
+        except CommandError as e:
+            print("Rejected command from", addr, e)
+            return ("error: %s\n" % e).encode('utf-8')
+        return b"ok\n"
+
+    def _check(self, command, instructions, watchdog):
+        """Validates a command before anything moves. Returns (instruction, value, lease)."""
+        if not isinstance(command, dict):
+            raise CommandError("command must be a JSON object")
+        action = command.get("action")
+        instruction = instructions.get(action) if isinstance(action, str) else None
+        if instruction is None:
+            raise CommandError("unknown action %r" % (action,))
+        query = command.get("value")
+        lease = command.get("lease")
+        if lease is not None:
+            try:
+                lease = float(lease)
+            except (TypeError, ValueError):
+                raise CommandError("lease must be a number")
+            # NaN would never expire
+            if not 0 < lease <= MAX_LEASE:
+                raise CommandError("lease must be within (0, %g] seconds" % MAX_LEASE)
+        if instruction['exec'] and (lease is None or watchdog is None):
+            if isinstance(query, dict):
+                try:
+                    inspect.signature(instruction['exec']).bind(**query)
+                except TypeError as e:
+                    raise CommandError("bad parameters for %s: %s" % (action, e))
+            else:
+                try:
+                    query = int(query)
+                except (TypeError, ValueError):
+                    raise CommandError("value must be whole seconds")
+                if not 0 <= query <= MAX_RUN_TIME:
+                    raise CommandError("value must be within [0, %d] seconds" % MAX_RUN_TIME)
+        return instruction, query, lease
+
+    def execute(self, command, addr, instructions, watchdog=None):
+        """Runs one command dictionary. Raises CommandError for an invalid one."""
+        instruction, query, lease = self._check(command, instructions, watchdog)
+        leased = lease is not None and watchdog is not None
+        if leased:
+            # Renewed before waiting for the lock, so a client queued behind
+            # another one's blocking command keeps its motors' lease
+            watchdog.renew(addr, lease)
+        if not instruction['cmd'] and not instruction['exec']:
+            # A heartbeat drives nothing and never waits for the lock
+            return
+        with self.lock, stage('execute'):
+            if leased:
+                # Leased commands start the motors and return at once, the
+                # client keeps them running by renewing the lease; the wait
+                # for the lock does not count against it
+                watchdog.renew(addr, lease)
+            print("Got instruction from client and going to execute it: ", command["action"])
+            if bool(instruction['cmd']):
+                instruction['cmd']()
+            if bool(instruction['exec']) and (lease is None or watchdog is None):
+                if isinstance(query, dict):
+                    # Plans carry their parameters as an object
+                    instruction['exec'](**query)
+                else:
+                    instruction['exec'](query)
+
+
+def build_instructions(excavator):
+    """Maps command actions to the excavator calls that start and run them."""
+    return {
+        "forward": {'cmd': excavator.move_forward, 'exec': excavator.execute},
+        "backward": {'cmd': excavator.move_backward, 'exec': excavator.execute},
+        "left": {'cmd': excavator.forward_left_chain, 'exec': excavator.execute},
+        "right": {'cmd': excavator.forward_right_chain, 'exec': excavator.execute},
+        "shovel-left": {'cmd': excavator.turn_left_body, 'exec': excavator.execute},
+        "shovel-right": {'cmd': excavator.turn_right_body, 'exec': excavator.execute},
+        "shovel-up": {'cmd': excavator.move_up_shovel, 'exec': excavator.execute},
+        "shovel-down": {'cmd': excavator.move_down_shovel, 'exec': excavator.execute},
+        "grab": {'cmd': None, 'exec': excavator.grab},
+        "heartbeat": {'cmd': None, 'exec': None},
+        "stop": {'cmd': excavator.stop_all_motors, 'exec': None}
+    }
+
+
+def main():
+    excavator = Excavator()
+    instructions = build_instructions(excavator)
+
+    telemetry = TelemetryPublisher(excavator, MotorNode.HOST, MotorNode.TELEMETRY_PORT)
+    telemetry.start()
+
+    watchdog = Watchdog(excavator)
+    watchdog.start()
+
+    # SIGUSR2 or `Profiler.py --port 65435 start` samples the running node
+    profiler = Profiler('motor_node')
+    profiler.install_signal()
+    profiler.serve(MotorNode.PROFILER_PORT)
+
+    motor_node = MotorNode()
+    motor_node.listen_commands(instructions, watchdog)
+    profiler.close()
+    watchdog.stop()
+    telemetry.stop()
+
+
+if __name__ == '__main__':
+    main()
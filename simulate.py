@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch runs grab scenarios in the closed-loop simulator (see Simulator.py).
+
+Every scenario places the target at a random distance and bearing and runs
+the real camera_node and motor_node code on a virtual clock until the
+target is grabbed or the timeout passes. Scenarios run in worker processes
+and are reproducible from --seed.
+
+    python3 simulate.py --scenarios 200 --jobs 4 --csv runs.csv
+"""
+
+import argparse
+import contextlib
+import csv
+import os
+import random
+import statistics
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+_simulator = None
+
+
+def _init(options):
+    global _simulator
+    from Simulator import Simulator
+    _simulator = Simulator(timeout=options['timeout'], latency=options['latency'],
+                           miss_rate=options['miss_rate'], rate_error=options['rate_error'],
+                           real_models=options['real_models'], sprite=options['sprite'])
+
+
+def _run(scenario):
+    # The nodes print on every frame
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return _simulator.run(*scenario)
+
+
+def scenarios(count, seed, min_distance, max_distance, max_bearing):
+    """(seed, distance, bearing) of every scenario."""
+    rng = random.Random(seed)
+    return [(seed * 100000 + i, rng.uniform(min_distance, max_distance),
+             rng.uniform(-max_bearing, max_bearing)) for i in range(count)]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(results, wall_seconds):
+    grabbed = [r for r in results if r['grabbed']]
+    print("Scenarios: %d, grabbed: %d (%.0f%%)"
+          % (len(results), len(grabbed), 100.0 * len(grabbed) / max(len(results), 1)))
+    if grabbed:
+        times = [r['time_to_grab'] for r in grabbed]
+        print("Time to grab: mean %.1fs, median %.1fs, p90 %.1fs, max %.1fs"
+              % (statistics.mean(times), statistics.median(times),
+                 percentile(times, 0.9), max(times)))
+    errors = [r['best_error'] for r in results if r['best_error'] is not None]
+    print("Digs per scenario: %.1f, closest dig: median %s"
+          % (statistics.mean(r['attempts'] for r in results),
+             "%.0fmm" % statistics.median(errors) if errors else "-"))
+    simulated = sum(r['sim_seconds'] for r in results)
+    print("Simulated %.0fs in %.1fs (%.0fx real time)"
+          % (simulated, wall_seconds, simulated / max(wall_seconds, 1e-9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--scenarios', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--timeout', type=float, default=120.0,
+                        help='virtual seconds before a scenario counts as failed')
+    parser.add_argument('--min-distance', type=float, default=250.0, help='mm')
+    parser.add_argument('--max-distance', type=float, default=1500.0, help='mm')
+    parser.add_argument('--max-bearing', type=float, default=180.0, help='degrees')
+    parser.add_argument('--latency', type=float, default=0.12,
+                        help='virtual seconds per model inference')
+    parser.add_argument('--miss-rate', type=float, default=0.1)
+    parser.add_argument('--rate-error', type=float, default=0.05,
+                        help='spread of the real motor rates around the calibration')
+    parser.add_argument('--real-models', action='store_true',
+                        help='run the TFLite models on rendered frames instead of the oracle')
+    parser.add_argument('--sprite', help='image of the target to render, a flat box otherwise')
+    parser.add_argument('--csv', help='writes one row per scenario')
+    args = parser.parse_args()
+
+    options = {'timeout': args.timeout, 'latency': args.latency, 'miss_rate': args.miss_rate,
+               'rate_error': args.rate_error, 'real_models': args.real_models,
+               'sprite': args.sprite}
+    todo = scenarios(args.scenarios, args.seed, args.min_distance, args.max_distance,
+                     args.max_bearing)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init,
+                             initargs=(options,)) as pool:
+        results = list(pool.map(_run, todo))
+    wall_seconds = time.perf_counter() - start
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    summarize(results, wall_seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that the steady-state frame loop does not allocate per frame.
+
+Runs Camera.execute_command on a stub camera replaying the test image, with
+the frame loop as it runs on the robot: pooled capture, resize, inference,
+tracking, sizes and distances, printing. The normal, tiled and cascade crop
+passes are measured with tracemalloc once warmed up, and only the tiled
+one may capture at the tiled size. Also checks Resizer against PIL. Run from the repository root: python3 test_buffer_pool.py
+"""
+
+import contextlib
+import gc
+import os
+import tracemalloc
+
+import numpy as np
+
+from PIL import Image
+
+from BufferPool import DetectionBuffers, Resizer
+from Camera import Camera
+from ModelRegistry import default_registry
+from TensorBinding import TensorBinding
+
+WIDTH, HEIGHT = 640, 480
+# Capture size while a model runs tiled, see Camera.TILED_WIDTH
+TILED_WIDTH, TILED_HEIGHT = 1280, 960
+WARM_UP_FRAMES = 5
+FRAMES = 30
+# Small transient objects (result dicts, tracks, printed lines, the taps of
+# a new crop) come and go; a single new frame or resized image is above these
+MAX_PEAK_BYTES = 128 * 1024
+MAX_GROWTH_PER_FRAME = 256
+
+
+class ReplayCamera:
+    """
+    PiCamera stand-in with settled exposure, capturing the same image over
+    and over. `on_frame(n)` is called before the n-th frame is written.
+    """
+    framerate = 30
+    exposure_speed = 20000
+    analog_gain = 1.0
+    digital_gain = 1.0
+    awb_gains = (1.5, 1.2)
+    # No display, so Camera draws no overlays
+    preview = None
+
+    def __init__(self, image, frames, on_frame):
+        self.image = image
+        self.frames = frames
+        self.on_frame = on_frame
+        self.resolution = (WIDTH, HEIGHT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def capture_continuous(self, output, format='rgb', use_video_port=True):
+        capture = memoryview(np.asarray(self.image.resize(self.resolution)).tobytes())
+        for n in range(self.frames):
+            self.on_frame(n)
+            # picamera writes a frame in chunks
+            for start in range(0, len(capture), 65536):
+                output.write(capture[start:start + 65536])
+            yield output
+
+
+def measure_frame_loop(person, tiled=False):
+    """
+    Per frame growth and peak above the warmed up loop (bytes) with the given
+    person model, started tiled or not, and the capture resolution it ran at.
+    """
+    measured = {}
+
+    def on_frame(n):
+        if n == WARM_UP_FRAMES:
+            # Only what survives a collection counts as growth
+            gc.collect()
+            tracemalloc.start()
+            measured['before'], _ = tracemalloc.get_traced_memory()
+
+    image = Image.open('test/showel_near.jpg').convert('RGB')
+    camera = ReplayCamera(image, WARM_UP_FRAMES + FRAMES, on_frame)
+    models = [{'name': 'shovel', 'model': 'shovel_model', 'function': None, 'threshold': 0.4},
+              dict(person, name='person', model='object', function=None)]
+    try:
+        with open(os.devnull, 'w', buffering=1) as devnull, contextlib.redirect_stdout(devnull):
+            pipeline = Camera(models, camera=camera)
+            entry = next(i for i in pipeline.interpreters if i['name'] == 'person')
+            # Stays tiled when min_box is out of reach
+            entry['tiled'] = tiled
+            pipeline.execute_command()
+        _, peak = tracemalloc.get_traced_memory()
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (after - measured['before']) / FRAMES, peak - measured['before'], camera.resolution
+
+
+def test_steady_state_allocations():
+    passes = {
+        'normal': {},
+        # Tiling configured but never switched on
+        'untiled': {'tiling': {'target': 'person', 'grid': (2, 2), 'patience': 1000}},
+        'tiled': {'tiling': {'target': 'person', 'grid': (2, 2), 'min_box': 2.0}},
+        'crops': {'cascade': {'after': 'shovel', 'mode': 'crops'}}
+    }
+    for name, person in passes.items():
+        growth, peak, resolution = measure_frame_loop(person, tiled=name == 'tiled')
+        print("%s: per frame growth %.0f bytes, peak above start %d bytes at %dx%d"
+              % ((name, growth, peak) + tuple(resolution)))
+        # A model that could tile must not make every frame a large one
+        assert resolution == ((TILED_WIDTH, TILED_HEIGHT) if name == 'tiled' else (WIDTH, HEIGHT))
+        assert growth <= MAX_GROWTH_PER_FRAME, (name, growth)
+        assert peak <= MAX_PEAK_BYTES, (name, peak)
+
+
+def test_resizer_matches_pil():
+    for width, height in ((WIDTH, HEIGHT), (TILED_WIDTH, TILED_HEIGHT)):
+        image = Image.open('test/showel_near.jpg').convert('RGB').resize((width, height))
+        resized = Resizer((height, width, 3), (300, 300)).resize(np.asarray(image))
+        reference = np.asarray(image.resize((300, 300), Image.BOX))
+        error = np.abs(resized.astype(int) - reference)
+        print("%dx%d: mean difference to PIL box %.2f, max %d"
+              % (width, height, error.mean(), error.max()))
+        # Only block edges rounded to whole pixels differ from PIL's area filter
+        assert error.mean() < 0.5, error.mean()
+        assert error.max() <= 2, error.max()
+
+
+def test_detections_match_pil_at_tiled_size():
+    image = Image.open('test/showel_near.jpg').convert('RGB').resize((TILED_WIDTH, TILED_HEIGHT))
+    frame = np.asarray(image)
+    registry = default_registry()
+    for name, threshold in (('object', 0.5), ('shovel_model', 0.4)):
+        binding = TensorBinding.of(registry.get(name).interpreter)
+        detections = []
+        for model_input in (Resizer(frame.shape, binding.size).resize(frame),
+                            np.asarray(image.resize(binding.size, Image.BOX))):
+            binding.set_input(model_input)
+            binding.invoke()
+            buffers = DetectionBuffers(len(binding.output(2)))
+            detections.append([(result['class_id'], result['score'], result['bounding_box'].copy())
+                               for result in binding.detections_into(buffers, threshold)])
+        pooled, reference = detections
+        print("%s: %d detections with Resizer, %d with PIL" % (name, len(pooled), len(reference)))
+        assert len(pooled) == len(reference) > 0
+        for (class_id, score, box), (ref_class, ref_score, ref_box) in zip(pooled, reference):
+            assert class_id == ref_class
+            assert abs(score - ref_score) < 0.1, (score, ref_score)
+            assert np.allclose(box, ref_box, atol=0.03), (box, ref_box)
+
+
+def main():
+    test_resizer_matches_pil()
+    test_detections_match_pil_at_tiled_size()
+    test_steady_state_allocations()
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,14 +7,12 @@ def main():
     tl_models = [
         {
             'name': 'shovel',
-            'model_path': './trained_model/shovel_model/model.tflite',
-            'label_path': './trained_model/shovel_model/model-dict.txt',
+            'model': 'shovel_model',
             'function': None
         },
         {
             'name': 'person',
-            'model_path': './trained_model/object/detect.tflite',
-            'label_path': './trained_model/object/coco_labels.txt',
+            'model': 'object',
             'function': None
         }
     ]
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Drives the quality Governor with fixture sensor files and a fake clock.
+Checks it steps down on heat, throttling and latency over the budget, no
+faster than SETTLE, and back up only after HOLD seconds of good conditions.
+Run from the repository root: python3 test_governor.py
+"""
+
+import os
+import tempfile
+
+from Governor import LEVELS, Governor, SystemSensors
+
+BUDGET_MS = 100.0
+FRAME = 0.1  # seconds between two frames on the fake clock
+
+
+class QualityCamera:
+    """Camera stand-in recording every quality level applied, with its time."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.applied = []
+
+    def apply_quality(self, quality):
+        self.applied.append((self.clock(), LEVELS.index(quality)))
+
+
+class Fixture:
+    """Folder laid out like / with the files SystemSensors reads."""
+
+    def __init__(self, root):
+        self.root = root
+        self.set(temperature=50.0, throttled=0x0, load=0.5)
+
+    def write(self, path, text):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+
+    def set(self, temperature, throttled, load):
+        self.write(SystemSensors.TEMPERATURE, '%d' % (temperature * 1000))
+        self.write(SystemSensors.THROTTLED, '%x' % throttled)
+        self.write(SystemSensors.LOADAVG, '%.2f 0.40 0.30 1/200 1234' % load)
+
+
+def run(governor, now, seconds, total_ms):
+    """Feeds `seconds` of frames taking `total_ms` each."""
+    for _ in range(int(round(seconds / FRAME))):
+        now[0] += FRAME
+        governor.frame_done({'invoke': total_ms * 0.8}, total_ms)
+
+
+def steps(camera, since):
+    return [(at, level) for at, level in camera.applied if at > since]
+
+
+def check_spacing(applied, gap):
+    times = [at for at, _ in applied]
+    for earlier, later in zip(times, times[1:]):
+        assert later - earlier >= gap - 1e-9, applied
+
+
+def test_governor_levels():
+    now = [0.0]
+
+    def clock():
+        return now[0]
+
+    camera = QualityCamera(clock)
+    with tempfile.TemporaryDirectory() as root:
+        fixture = Fixture(root)
+        sensors = SystemSensors(root)
+        governor = Governor(camera, BUDGET_MS, sensors, clock=clock)
+        assert sensors.read()['temperature'] == 50.0
+
+        # Cool and fast enough: full quality
+        run(governor, now, 3, 50)
+        assert camera.applied == [], camera.applied
+
+        # Hot: one step down at the next sample, another only after SETTLE
+        start = now[0]
+        fixture.set(temperature=80.0, throttled=0x0, load=0.5)
+        run(governor, now, 1.5, 50)
+        hot = steps(camera, start)
+        print("Hot:", hot)
+        assert [level for _, level in hot] == [1, 2], hot
+        assert hot[0][0] - start <= Governor.SAMPLE_PERIOD + FRAME, hot
+        check_spacing(hot, Governor.SETTLE)
+
+        # Throttled while cool
+        start = now[0]
+        fixture.set(temperature=60.0, throttled=0x50005, load=0.5)
+        run(governor, now, 1.5, 50)
+        throttled = steps(camera, start)
+        print("Throttled:", throttled)
+        assert [level for _, level in throttled] == [3], throttled
+
+        # Over the latency budget on a cool, unthrottled CPU
+        start = now[0]
+        fixture.set(temperature=60.0, throttled=0x50000, load=0.5)
+        run(governor, now, 1.5, 2 * BUDGET_MS)
+        slow = steps(camera, start)
+        print("Over budget:", slow)
+        assert [level for _, level in slow] == [4], slow
+        check_spacing(camera.applied, Governor.SETTLE)
+
+        # Good again: no step up before HOLD, then one level per HOLD
+        start = now[0]
+        run(governor, now, Governor.HOLD - 1, 30)
+        assert steps(camera, start) == [], steps(camera, start)
+        run(governor, now, 4 * Governor.HOLD + 1, 30)
+        recovered = steps(camera, start)
+        print("Recovered:", recovered)
+        assert [level for _, level in recovered] == [3, 2, 1, 0], recovered
+        assert recovered[0][0] - start >= Governor.HOLD, recovered
+        check_spacing(recovered, Governor.HOLD)
+        assert governor.level == 0
+
+
+def main():
+    test_governor_levels()
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs motor_node's command handler on the simulated motor shield and checks
+that a client holding a lease keeps it, with heartbeats answered at once,
+while another client's blocking command holds the node. Run from the
+repository root: python3 test_motor_node.py
+"""
+
+import json
+import threading
+import time
+
+from SimGPIO import SimGPIO
+
+# AMSpi binds RPi.GPIO when imported, so the simulated one goes in first
+SimGPIO().install()
+
+from Excavator import Excavator  # noqa: E402
+from Watchdog import Watchdog  # noqa: E402
+from motor_node import MotorNode, build_instructions  # noqa: E402
+
+LEASE = 0.3
+BLOCKING = 1  # seconds the other client's command runs
+# Far below LEASE, a heartbeat must not wait for the blocking command
+MAX_HEARTBEAT_MS = 50
+
+
+def message(command):
+    return json.dumps(command).encode('utf-8')
+
+
+def test_heartbeat_during_blocking_command():
+    excavator = Excavator()
+    instructions = build_instructions(excavator)
+    node = MotorNode(listen=False)
+    with Watchdog(excavator) as watchdog:
+        leased = ('leased', 1)
+        reply = node.handle(message({"action": "shovel-up", "value": "1", "lease": LEASE}),
+                            leased, instructions, watchdog)
+        assert reply == b"ok\n", reply
+
+        blocking = threading.Thread(target=node.handle, args=(
+            message({"action": "forward", "value": str(BLOCKING)}), ('blocking', 2),
+            instructions, watchdog))
+        blocking.start()
+        time.sleep(0.05)
+
+        slowest = 0.0
+        end = time.monotonic() + BLOCKING * 0.8
+        while time.monotonic() < end:
+            start = time.monotonic()
+            reply = node.handle(message({"action": "heartbeat", "value": "0", "lease": LEASE}),
+                                leased, instructions, watchdog)
+            slowest = max(slowest, (time.monotonic() - start) * 1000)
+            assert reply == b"ok\n", reply
+            time.sleep(LEASE / 3)
+        # The lease was kept, so the watchdog left both clients' motors running
+        running = {motor: state['running'] for motor, state in excavator.motor_states.items()}
+        watchdog.release(leased)
+        blocking.join()
+    print("Slowest heartbeat %.1fms, running before the blocking command ended: %s"
+          % (slowest, running))
+    assert slowest < MAX_HEARTBEAT_MS, slowest
+    assert running[Excavator.SHOVEL_MOTOR], running
+    assert running[Excavator.RIGHT_CHAIN_MOTOR], running
+
+
+def main():
+    test_heartbeat_during_blocking_command()
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs a fixed set of grab scenarios in the closed-loop simulator and checks
+the share of targets grabbed, so changes to detection, planning or motor
+control that stop the excavator from grabbing are caught. Run from the
+repository root: python3 test_simulator.py
+"""
+
+import contextlib
+import os
+
+from Simulator import Simulator
+from simulate import scenarios
+
+SCENARIOS = 20
+SEED = 1
+# Every scenario is grabbed at the time of writing; leaves room for the
+# odd unlucky target
+MIN_GRAB_RATE = 0.9
+
+
+def test_grab_rate():
+    simulator = Simulator()
+    # The nodes print on every frame
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = [simulator.run(*scenario)
+                   for scenario in scenarios(SCENARIOS, SEED, 250.0, 1500.0, 180.0)]
+    grabbed = [result for result in results if result['grabbed']]
+    rate = len(grabbed) / len(results)
+    print("Grabbed %d of %d targets (%.0f%%)" % (len(grabbed), len(results), 100 * rate))
+    for result in results:
+        if not result['grabbed']:
+            print("Missed: distance %.0fmm, bearing %.0f, closest dig %s"
+                  % (result['distance'], result['bearing'], result['best_error']))
+    assert rate >= MIN_GRAB_RATE, rate
+
+
+def main():
+    test_grab_rate()
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs tiled and crop detection through Camera on the test image, at the
+capture size used while a model runs tiled, and a batch of PIL images.
+Checks the cascade gate defaults to the gating model's threshold, that a
+gated stage still switches to tiles when the gate misses the target and
+that tiled and crop stages stay on board with a vision server. Run from the
+repository root: python3 test_tiling.py
+"""
+
+import numpy as np
+
+from PIL import Image
+
+from Camera import Camera
+
+
+class StillCamera:
+    """PiCamera stand-in whose exposure has already settled."""
+    exposure_speed = 20000
+    analog_gain = 1.0
+    digital_gain = 1.0
+    awb_gains = (1.5, 1.2)
+    preview = None
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+
+class RecordingClient:
+    """VisionClient stand-in recording the models each frame asks for."""
+
+    def __init__(self):
+        self.requests = []
+
+    def detect(self, frame, models):
+        self.requests.append(dict(models))
+        return None
+
+
+def make_camera():
+    return Camera([
+        {'name': 'shovel', 'model': 'shovel_model', 'function': None, 'threshold': 0.4},
+        {'name': 'person', 'model': 'object', 'function': None,
+         'tiling': {'target': 'person', 'grid': (2, 2)},
+         'cascade': {'after': 'shovel', 'mode': 'crops'}}
+    ], exportLog=False, camera=StillCamera())
+
+
+def tiled_frame(camera):
+    return np.asarray(Image.open('test/showel_near.jpg').convert('RGB').resize(
+        (camera.TILED_WIDTH, camera.TILED_HEIGHT)))
+
+
+def check_results(results):
+    for result in results:
+        box = np.asarray(result['bounding_box'])
+        assert box.shape == (4,), box
+        assert np.all(box >= 0) and np.all(box <= 1), box
+        assert box[0] < box[2] and box[1] < box[3], box
+        assert 0 < result['score'] <= 1, result['score']
+
+
+def test_detect_tiled():
+    camera = make_camera()
+    entry = next(i for i in camera.interpreters if i['name'] == 'person')
+    results = camera.detect_tiled(entry, tiled_frame(camera), 0.3)
+    print("Tiled: %d detections" % len(results))
+    check_results(results)
+
+
+def test_detect_crops():
+    camera = make_camera()
+    entry = next(i for i in camera.interpreters if i['name'] == 'person')
+    boxes = [[0.2, 0.2, 0.6, 0.5], [0.5, 0.4, 0.9, 0.8]]
+    results = camera.detect_crops(entry, tiled_frame(camera), boxes, 0.3)
+    print("Crops: %d detections" % len(results))
+    check_results(results)
+
+
+def test_detect_batch_images():
+    camera = make_camera()
+    image = Image.open('test/showel_near.jpg').convert('RGB')
+    # PIL images of any size are resized to the model input
+    boxes, classes, scores, counts = camera.detect_batch(
+        'person', [image, image.crop((0, 0, 200, 150))], 0.3)
+    print("Batch of PIL images: %s detections" % list(counts))
+    assert len(counts) == 2
+
+
+def test_cascade_gate_score():
+    camera = make_camera()
+    entry = next(i for i in camera.interpreters if i['name'] == 'person')
+    # Everything the shovel model reports at its 0.4 threshold opens the stage
+    assert entry['cascade']['score'] == 0.4, entry['cascade']['score']
+
+
+def test_tiling_behind_gate():
+    # camera_node's setup: the person stage tiles and is gated by the shovel model
+    camera = Camera([
+        {'name': 'shovel', 'model': 'shovel_model', 'function': None, 'threshold': 0.4},
+        {'name': 'person', 'model': 'object', 'function': None,
+         'tiling': {'target': 'person', 'grid': (2, 2)},
+         'cascade': {'after': 'shovel', 'mode': 'frame'}}
+    ], exportLog=False, camera=StillCamera())
+    entry = next(i for i in camera.interpreters if i['name'] == 'person')
+    # Nothing for either model to find, so the gate stays shut
+    frame = np.full((camera.TILED_HEIGHT, camera.TILED_WIDTH, 3), 128, np.uint8)
+    for _ in range(entry['tiling']['patience']):
+        assert not entry['tiled']
+        camera.process_frame(frame)
+    counts = camera.cascade_stats.counts['person']
+    assert counts['runs'] == 0, counts
+    # Frames the gate skipped were misses, so the target is searched for in tiles
+    assert entry['tiled']
+    camera.process_frame(frame)
+    print("Tiled behind the gate:", counts)
+    assert counts['runs'] == 1, counts
+
+
+def test_server_skips_on_board_stages():
+    camera = make_camera()
+    camera.vision_client = RecordingClient()
+    entry = next(i for i in camera.interpreters if i['name'] == 'person')
+    frame = tiled_frame(camera)
+    # Cascade crops are not sent
+    camera.remote_detect(frame)
+    camera.cascade_mode = 'frame'
+    # Nor is a tiled stage
+    entry['tiled'] = True
+    camera.remote_detect(frame)
+    entry['tiled'] = False
+    camera.remote_detect(frame)
+    print("Models asked of the server:", camera.vision_client.requests)
+    assert camera.vision_client.requests == [
+        {'shovel_model': 0.4}, {'shovel_model': 0.4}, {'shovel_model': 0.4, 'object': 0.5}]
+
+    # A tiled stage detects on board even when the server answered for its model
+    entry['tiled'] = True
+    served = {'bounding_box': [0.0, 0.0, 1.0, 1.0], 'class_id': 0, 'score': 0.99}
+    gate = {'bounding_box': [0.2, 0.2, 0.6, 0.5], 'class_id': 0, 'score': 0.9}
+    results = camera.run_stage(entry, frame, {'shovel': [gate]}, {'object': [served]})
+    assert results is not None and all(result is not served for result in results)
+    check_results(results)
+
+
+def main():
+    test_cascade_gate_score()
+    test_tiling_behind_gate()
+    test_server_skips_on_board_stages()
+    test_detect_tiled()
+    test_detect_crops()
+    test_detect_batch_images()
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs a VisionServer and several simulated robots on this host.
+
+Every robot is a VisionClient thread streaming the test image. Checks that
+the server's detections match on-board ones, that frames from different
+robots share batches, that priority decides who is served under overload
+and that a robot falls back within its budget once the server is gone.
+Run from the repository root: python3 test_vision_server.py
+"""
+
+import io
+import threading
+import time
+
+import numpy as np
+
+from PIL import Image
+
+from BatchDetector import BatchDetector
+from ModelRegistry import default_registry
+from TensorBinding import TensorBinding
+from VisionClient import VisionClient
+from VisionServer import VisionServer
+
+MODELS = {'object': 0.5, 'shovel_model': 0.4}
+ROBOTS = 6
+FRAMES = 10
+
+
+def make_frame():
+    return np.asarray(Image.open('test/showel_near.jpg').convert('RGB').resize((640, 480)))
+
+
+def start_server(**options):
+    server = VisionServer('127.0.0.1', 0, workers=1, **options)
+    server.start()
+    return server
+
+
+def run_robots(port, robots, frames, budget_ms):
+    """Streams `frames` frames from every (robot_id, priority) at once; returns the clients."""
+    frame = make_frame()
+    clients = [VisionClient('127.0.0.1', port, robot_id, priority, budget_ms)
+               for robot_id, priority in robots]
+    for client in clients:
+        # Keep asking whatever happens, the test counts the misses
+        client.FAILURES = frames + 1
+
+    def stream(client):
+        for _ in range(frames):
+            client.detect(frame, MODELS)
+
+    threads = [threading.Thread(target=stream, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in clients:
+        client.close()
+    return clients
+
+
+def check_results_match_local(server):
+    """Returns the round trip of one frame (ms) when the server is idle."""
+    frame = make_frame()
+    with VisionClient('127.0.0.1', server.port, 'match', budget_ms=10000) as client:
+        remote = client.detect(frame, MODELS)
+        assert remote is not None, client.counts
+        start = time.monotonic()
+        client.detect(frame, MODELS)
+        round_trip_ms = (time.monotonic() - start) * 1000
+        # The server sees the JPEG, so decode the same bytes locally
+        image = Image.open(io.BytesIO(client.encode(frame))).convert('RGB')
+
+    registry = default_registry()
+    for name, threshold in MODELS.items():
+        model = registry.get(name)
+        size = TensorBinding.of(model.interpreter).size
+        local = BatchDetector(model, workers=1).detect(
+            np.asarray(image.resize(size, Image.BILINEAR)), threshold)
+        boxes, classes, scores = remote[name]
+        count = local[3][0]
+        print("%s: %d detections on the server, %d on board" % (name, len(scores), count))
+        assert len(scores) == count
+        assert np.allclose(boxes, local[0][0, :count], atol=1e-5)
+        assert np.array_equal(classes, local[1][0, :count])
+        assert np.allclose(scores, local[2][0, :count], atol=1e-5)
+    return round_trip_ms
+
+
+def check_batches_many_robots(server):
+    clients = run_robots(server.port, [('robot%d' % i, 0) for i in range(ROBOTS)], FRAMES, 10000)
+    ok = sum(client.counts['ok'] for client in clients)
+    stats = server.stats()['models']
+    print("%d of %d frames answered, mean batch %s"
+          % (ok, ROBOTS * FRAMES, {name: round(m['mean_batch'], 1) for name, m in stats.items()}))
+    assert ok == ROBOTS * FRAMES
+    assert all(model['mean_batch'] > 1 for model in stats.values())
+
+
+def check_priority_under_overload(server, round_trip_ms):
+    # Room for about two frames while six robots ask at once
+    budget_ms = 2 * round_trip_ms
+    robots = [('high', 1)] + [('low%d' % i, 0) for i in range(ROBOTS - 1)]
+    clients = run_robots(server.port, robots, FRAMES, budget_ms)
+    rates = [client.counts['ok'] / FRAMES for client in clients]
+    print("Budget %.0fms: high priority answered %.0f%%, low priority %.0f%%"
+          % (budget_ms, 100 * rates[0], 100 * np.mean(rates[1:])))
+    assert rates[0] > 0
+    assert rates[0] >= max(rates[1:])
+
+
+def test_shared_server():
+    """Matching, batching and priority, on one server so the models load once."""
+    server = start_server()
+    try:
+        round_trip_ms = check_results_match_local(server)
+        check_batches_many_robots(server)
+        check_priority_under_overload(server, round_trip_ms)
+    finally:
+        server.stop()
+
+
+def test_falls_back_when_server_stops():
+    server = start_server()
+    frame = make_frame()
+    budget_ms = 100
+    client = VisionClient('127.0.0.1', server.port, 'fallback', budget_ms=budget_ms)
+    # Connected while the server still runs, whether or not it keeps up
+    client.detect(frame, MODELS)
+    server.stop()
+    for _ in range(client.FAILURES + 2):
+        start = time.monotonic()
+        assert client.detect(frame, MODELS) is None
+        elapsed_ms = (time.monotonic() - start) * 1000
+        # Connecting again is bounded by the connect timeout, not the budget
+        assert elapsed_ms < budget_ms + client.CONNECT_TIMEOUT * 1000 + 50, elapsed_ms
+    assert not client.available()
+    print("Fell back to on-board detection:", client.counts)
+    client.close()
+
+
+def test_rejects_bad_hello():
+    # Priority and robot id go into single bytes of the hello message
+    for options in ({'priority': 256}, {'priority': -1}, {'robot_id': 'x' * 256}):
+        try:
+            VisionClient('127.0.0.1', **options)
+        except ValueError as e:
+            print("Rejected %s: %s" % (options, e))
+        else:
+            raise AssertionError("accepted %s" % options)
+
+
+def main():
+    test_rejects_bad_hello()
+    test_shared_server()
+    test_falls_back_when_server_stops()
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()